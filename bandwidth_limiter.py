@@ -0,0 +1,86 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QObject, QTimer
+from datetime import datetime
+
+from calibre_plugins.bookfusion.config import prefs
+
+
+# Token bucket shared by all upload bodies of a sync run.
+#
+# Every tick the bytes allowed by the current rate are split evenly between the
+# bodies being uploaded, so parallel workers get a fair share of the uplink.
+# The rate is looked up on every tick, so schedule and settings changes apply
+# to a running sync. When several processes sync at once, each one gets an
+# equal share of the configured rate.
+class BandwidthLimiter(QObject):
+    TICK_MS = 100
+
+    def __init__(self, parent=None, shares=1):
+        QObject.__init__(self, parent)
+
+        self.shares = shares
+        self.devices = []
+        self.allowance = {}
+        self.waiting = []
+        self.rate = 0
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(self.TICK_MS)
+        self.timer.timeout.connect(self.tick)
+
+    def current_rate(self):
+        hour = datetime.now().hour
+        day_start = prefs['bandwidth_day_start']
+        day_end = prefs['bandwidth_day_end']
+        if day_start <= day_end:
+            is_day = day_start <= hour < day_end
+        else:
+            is_day = hour >= day_start or hour < day_end
+
+        if is_day:
+            limit = prefs['bandwidth_day_limit']
+        else:
+            limit = prefs['bandwidth_night_limit']
+        return limit * 1024 // self.shares
+
+    def register(self, device):
+        self.devices.append(device)
+        self.refill()
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def unregister(self, device):
+        if device in self.devices:
+            self.devices.remove(device)
+        self.allowance.pop(device, None)
+        if device in self.waiting:
+            self.waiting.remove(device)
+        if len(self.devices) == 0:
+            self.timer.stop()
+
+    def acquire(self, device, wanted):
+        if not self.rate:
+            return wanted
+
+        granted = min(wanted, self.allowance.get(device, 0))
+        self.allowance[device] = self.allowance.get(device, 0) - granted
+        if granted == 0 and device not in self.waiting:
+            self.waiting.append(device)
+        return granted
+
+    def refill(self):
+        self.rate = self.current_rate()
+        if self.rate and len(self.devices) > 0:
+            share = max(1, int(self.rate * self.TICK_MS / 1000 / len(self.devices)))
+            for device in self.devices:
+                self.allowance[device] = share
+
+    def tick(self):
+        self.refill()
+
+        waiting = self.waiting
+        self.waiting = []
+        for device in waiting:
+            device.readyRead.emit()
@@ -11,24 +11,33 @@ class BookFormat:
 
     def __init__(self, db, book_id, preferred_fmt=None):
         self.file_path = None
-        self.fmt = None
-
-        fmts = db.formats(book_id)
-        if len(fmts) > 0:
-            fmt = fmts[0]
-
-            preference_list = []
-            if preferred_fmt:
-                preference_list.append(preferred_fmt)
-            for f in self.PREFERRED_FMTS:
-                if f not in preference_list:
-                    preference_list.append(f)
-
-            for pref in preference_list:
-                if pref in fmts:
-                    fmt = pref
-                    break
-
-            if fmt in self.SUPPORTED_FMTS:
-                self.fmt = fmt
-                self.file_path = db.format_abspath(book_id, fmt)
+        self.fmt = self.pick(db.formats(book_id), preferred_fmt)
+
+        if self.fmt:
+            self.file_path = db.format_abspath(book_id, self.fmt)
+
+    @classmethod
+    def pick(cls, fmts, preferred_fmt=None):
+        # Picks the format to sync from the formats a book has, without
+        # touching the filesystem. Returns None if the book has no supported
+        # format.
+        if not fmts:
+            return None
+
+        fmt = fmts[0]
+
+        preference_list = []
+        if preferred_fmt:
+            preference_list.append(preferred_fmt)
+        for f in cls.PREFERRED_FMTS:
+            if f not in preference_list:
+                preference_list.append(f)
+
+        for pref in preference_list:
+            if pref in fmts:
+                fmt = pref
+                break
+
+        if fmt in cls.SUPPORTED_FMTS:
+            return fmt
+        return None
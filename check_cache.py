@@ -0,0 +1,118 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QNetworkRequest
+from datetime import datetime
+from hashlib import sha256
+from os import getpid, path, replace
+import json
+
+
+# Upload check responses with their validators, kept in the library folder,
+# one file per API key. Checks are sent with If-None-Match or
+# If-Modified-Since, so a record that did not change since the last run comes
+# back as an empty 304 and its body is taken from here. Entries not used for
+# the longest time are dropped past MAX_ENTRIES. The shards of a sharded sync
+# send the entries they changed to the parent, the only process writing the
+# file.
+class CheckCache:
+    MAX_ENTRIES = 20000
+
+    def __init__(self, library_path, api_key):
+        account = sha256(api_key.encode('utf-8')).hexdigest()[:16]
+        self.file_path = path.join(library_path, 'bookfusion_check_cache_{}.json'.format(account))
+        self.entries = {}
+        self.changed = set()
+        self.load()
+
+    def load(self):
+        if not path.exists(self.file_path):
+            return
+
+        try:
+            with open(self.file_path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            return
+
+    def save(self):
+        entries = sorted(self.entries.items(), key=lambda item: item[1]['used_at'], reverse=True)
+        self.entries = dict(entries[:self.MAX_ENTRIES])
+
+        # Only a cache: a library that cannot be written to goes without.
+        tmp_path = '{}.{}.tmp'.format(self.file_path, getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(json.dumps(self.entries, sort_keys=True))
+            replace(tmp_path, self.file_path)
+        except OSError:
+            pass
+
+    def to_state(self):
+        # The entries changed in this process, None for those dropped.
+        return dict((key, self.entries.get(key)) for key in self.changed)
+
+    def merge(self, state):
+        for key, entry in state.items():
+            if entry is None:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = entry
+
+    @staticmethod
+    def key(req):
+        return req.url().toString()
+
+    def prepare(self, req):
+        # Makes req conditional if a response to it is cached.
+        entry = self.entries.get(self.key(req))
+        if entry is None:
+            return
+        if entry['etag']:
+            req.setRawHeader(b'If-None-Match', entry['etag'].encode('ascii'))
+        if entry['last_modified']:
+            req.setRawHeader(b'If-Modified-Since', entry['last_modified'].encode('ascii'))
+
+    @staticmethod
+    def unconditional(req):
+        # A copy of req without the conditions prepare() added.
+        copy = QNetworkRequest(req.url())
+        for name in req.rawHeaderList():
+            if bytes(name) not in (b'If-None-Match', b'If-Modified-Since'):
+                copy.setRawHeader(name, req.rawHeader(name))
+        return copy
+
+    def hit(self, req):
+        # Returns the cached body for a 304 answer to req, or None.
+        entry = self.entries.get(self.key(req))
+        if entry is None:
+            return None
+        entry['used_at'] = datetime.now().isoformat()
+        self.changed.add(self.key(req))
+        return entry['body'].encode('utf-8')
+
+    def put(self, req, reply, body):
+        # Only responses carrying a validator are kept.
+        etag = reply.rawHeader(b'ETag').data().decode('ascii', 'replace')
+        last_modified = reply.rawHeader(b'Last-Modified').data().decode('ascii', 'replace')
+        if not etag and not last_modified:
+            self.forget(req)
+            return
+
+        try:
+            body = body.decode('utf-8')
+        except UnicodeDecodeError:
+            self.forget(req)
+            return
+
+        self.entries[self.key(req)] = {
+            'etag': etag,
+            'last_modified': last_modified,
+            'body': body,
+            'used_at': datetime.now().isoformat()
+        }
+        self.changed.add(self.key(req))
+
+    def forget(self, req):
+        if self.entries.pop(self.key(req), None) is not None:
+            self.changed.add(self.key(req))
@@ -2,12 +2,15 @@ __copyright__ = '2018, BookFusion <legal@bookfusion.com>'
 __license__ = 'GPL v3'
 
 from PyQt5.Qt import QObject, pyqtSignal, QNetworkAccessManager, QNetworkReply
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from os.path import getsize
 import json
 
 from calibre_plugins.bookfusion.config import prefs
 from calibre_plugins.bookfusion import api
 from calibre_plugins.bookfusion.book_format import BookFormat
+from calibre_plugins.bookfusion.reply_timeout import ReplyTimeout
 
 
 class CheckWorker(QObject):
@@ -17,13 +20,22 @@ class CheckWorker(QObject):
     progress = pyqtSignal(int)
     limitsAvailable = pyqtSignal(dict)
     resultsAvailable = pyqtSignal(int, list)
+    booksFound = pyqtSignal(list)
 
-    def __init__(self, db, logger, book_ids):
+    POOL_SIZE = 8
+
+    # Valid books are also sent with booksFound while the check goes on, so
+    # syncing can start before it is done; in batches that double in size up
+    # to this many books, and never more books than the account limit.
+    MAX_FOUND_BATCH = 50
+
+    def __init__(self, db, logger, book_ids, limits=None):
         QObject.__init__(self)
 
         self.db = db
         self.logger = logger
         self.book_ids = book_ids
+        self.limits = limits
         self.api_key = prefs['api_key']
         self.reply = None
         self.canceled = False
@@ -37,8 +49,16 @@ class CheckWorker(QObject):
         self.count = 0
         self.books_count = 0
         self.valid_ids = []
+        self.found = []
+        self.found_count = 0
 
-        self.fetch_limits()
+        # Limits fetched recently by the sync service are used as they are.
+        if self.limits is not None:
+            self.logger.info('Limits: cached')
+            self.limitsAvailable.emit(self.limits)
+            self.readyToRunCheck.emit()
+        else:
+            self.fetch_limits()
 
     def cancel(self):
         self.canceled = True
@@ -55,6 +75,7 @@ class CheckWorker(QObject):
         self.req = api.build_request('/limits')
 
         self.reply = self.network.get(self.req)
+        self.reply_timeout = ReplyTimeout(self.reply, prefs['request_timeout'], prefs['stall_timeout'])
         self.reply.finished.connect(self.finish_fetch_limits)
 
     def finish_fetch_limits(self):
@@ -64,7 +85,11 @@ class CheckWorker(QObject):
         abort = False
 
         error = self.reply.error()
-        if error == QNetworkReply.NetworkError.AuthenticationRequiredError:
+        if self.reply_timeout.reason is not None:
+            abort = True
+            self.aborted.emit('BookFusion did not respond in time.')
+            self.logger.info('Fetch limits: {} timeout'.format(self.reply_timeout.reason))
+        elif error == QNetworkReply.NetworkError.AuthenticationRequiredError:
             abort = True
             self.aborted.emit('Invalid API key.')
             self.logger.info('Fetch limits: AuthenticationRequiredError')
@@ -90,27 +115,92 @@ class CheckWorker(QObject):
             self.readyToRunCheck.emit()
 
     def run_check(self):
-        for book_id in self.pending_book_ids:
-            if self.canceled:
-                return
-
-            self.progress.emit(self.count)
-            self.count += 1
-
-            self.logger.info('File: book_id={}'.format(book_id))
+        # Format lookups and file stats are run concurrently in a bounded pool,
+        # since on network shares each stat is a round trip. Results are
+        # consumed in submission order so valid_ids keeps the original order.
+        # Once enough valid books have been found to fill the account limit no
+        # more files are stat'ed; the remaining books are only counted.
+        total_books = self.limits['total_books']
+        book_ids = iter(self.pending_book_ids)
+        pending = deque()
+        limit_reached = False
+
+        with ThreadPoolExecutor(max_workers=self.POOL_SIZE) as pool:
+            while True:
+                if self.canceled:
+                    for _, future in pending:
+                        future.cancel()
+                    return
+
+                while not limit_reached and len(pending) < self.POOL_SIZE * 2:
+                    book_id = next(book_ids, None)
+                    if book_id is None:
+                        break
+                    pending.append((book_id, pool.submit(self.check_file, book_id)))
+
+                if len(pending) == 0:
+                    break
+
+                book_id, future = pending.popleft()
+
+                self.progress.emit(self.count)
+                self.count += 1
+
+                self.logger.info('File: book_id={}'.format(book_id))
+
+                has_format, filesize = future.result()
+
+                if has_format:
+                    self.books_count += 1
+
+                    if filesize <= self.limits['filesize']:
+                        self.valid_ids.append(book_id)
+                        self.found.append(book_id)
+                        self.logger.info('File ok: book_id={}'.format(book_id))
+                        if len(self.found) >= min(self.MAX_FOUND_BATCH, self.found_count + 1):
+                            self.send_found()
+                    else:
+                        self.logger.info('Filesize exceeded: book_id={}'.format(book_id))
+                else:
+                    self.logger.info('Unsupported format: book_id={}'.format(book_id))
 
-            book_format = BookFormat(self.db, book_id, prefs['preferred_format'])
+                if total_books and len(self.valid_ids) >= total_books:
+                    limit_reached = True
 
-            if book_format.file_path:
-                self.books_count += 1
+        self.send_found()
 
-                if getsize(book_format.file_path) <= self.limits['filesize']:
-                    self.valid_ids.append(book_id)
-                    self.logger.info('File ok: book_id={}'.format(book_id))
-                else:
-                    self.logger.info('Filesize exceeded: book_id={}'.format(book_id))
-            else:
-                self.logger.info('Unsupported format: book_id={}'.format(book_id))
+        if limit_reached:
+            self.count_remaining(list(book_ids))
 
         self.resultsAvailable.emit(self.books_count, self.valid_ids)
         self.finished.emit()
+
+    def send_found(self):
+        found, self.found = self.found, []
+        total_books = self.limits['total_books']
+        if total_books:
+            found = found[:max(0, total_books - self.found_count)]
+        if found:
+            self.found_count += len(found)
+            self.booksFound.emit(found)
+
+    def check_file(self, book_id):
+        # Runs in the pool.
+        book_format = BookFormat(self.db, book_id, prefs['preferred_format'])
+        if book_format.file_path:
+            return (True, getsize(book_format.file_path))
+        return (False, None)
+
+    def count_remaining(self, book_ids):
+        # Books past the limit are not synced, but they still count towards
+        # books_count so the limits message is shown when it applies.
+        self.logger.info('Book limit reached: skipping file checks for {} books'.format(len(book_ids)))
+
+        preferred_fmt = prefs['preferred_format']
+        for fmts in self.db.all_field_for('formats', book_ids).values():
+            if BookFormat.pick(fmts, preferred_fmt):
+                self.books_count += 1
+
+        self.count += len(book_ids)
+        if len(book_ids) > 0:
+            self.progress.emit(self.count - 1)
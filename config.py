@@ -1,9 +1,11 @@
 __copyright__ = '2018, BookFusion <legal@bookfusion.com>'
 __license__ = 'GPL v3'
 
-from PyQt5.Qt import QWidget, QHBoxLayout, QVBoxLayout, QFormLayout, QLabel, QLineEdit, QCheckBox, QComboBox
+from PyQt5.Qt import Qt, QWidget, QHBoxLayout, QVBoxLayout, QFormLayout, QLabel, QLineEdit, QCheckBox, QComboBox, \
+    QSpinBox, QListWidget, QListWidgetItem
 from calibre.utils.config import JSONConfig
-from calibre.gui2 import get_current_db
+from calibre.gui2 import get_current_db, gprefs
+from os import path
 import sys
 if sys.version_info[0] >= 3:
     unicode = str
@@ -15,8 +17,24 @@ prefs.defaults['api_base'] = 'https://www.bookfusion.com/calibre-api/v1'
 prefs.defaults['debug'] = True
 prefs.defaults['update_metadata'] = False
 prefs.defaults['threads'] = 2
+prefs.defaults['check_threads'] = 4
+prefs.defaults['hash_threads'] = 2
+prefs.defaults['shards'] = 1
+prefs.defaults['disk_order'] = False
+prefs.defaults['disk_readers'] = 0
 prefs.defaults['bookshelves_custom_column'] = ''
 prefs.defaults['preferred_format'] = ''
+prefs.defaults['bandwidth_day_limit'] = 0
+prefs.defaults['bandwidth_night_limit'] = 0
+prefs.defaults['bandwidth_day_start'] = 8
+prefs.defaults['bandwidth_day_end'] = 18
+prefs.defaults['throughput'] = {}
+prefs.defaults['libraries'] = []
+prefs.defaults['metrics_textfile_dir'] = ''
+prefs.defaults['profile'] = False
+prefs.defaults['trace'] = False
+prefs.defaults['request_timeout'] = 60
+prefs.defaults['stall_timeout'] = 60
 
 
 class ConfigWidget(QWidget):
@@ -51,6 +69,30 @@ class ConfigWidget(QWidget):
         self.debug.setChecked(prefs['debug'])
         self.form.addRow('Debug Logging:', self.debug)
 
+        self.profile_layout = QHBoxLayout()
+        self.profile_layout.setContentsMargins(0, 0, 0, 0)
+
+        self.profile = QCheckBox(self)
+        self.profile.setChecked(prefs['profile'])
+        self.profile_layout.addWidget(self.profile)
+
+        self.profile_hint = QLabel('(write CPU and memory profiles of each sync to the library folder)')
+        self.profile_layout.addWidget(self.profile_hint)
+
+        self.form.addRow('Profiling:', self.profile_layout)
+
+        self.trace_layout = QHBoxLayout()
+        self.trace_layout.setContentsMargins(0, 0, 0, 0)
+
+        self.trace = QCheckBox(self)
+        self.trace.setChecked(prefs['trace'])
+        self.trace_layout.addWidget(self.trace)
+
+        self.trace_hint = QLabel('(write a per-book timeline of each sync to the library folder)')
+        self.trace_layout.addWidget(self.trace_hint)
+
+        self.form.addRow('Tracing:', self.trace_layout)
+
         self.update_metadata_layout = QHBoxLayout()
         self.update_metadata_layout.setContentsMargins(0, 0, 0, 0)
 
@@ -67,7 +109,49 @@ class ConfigWidget(QWidget):
         for n in range(3):
             self.threads.addItem(str(pow(2, n)))
         self.threads.setCurrentText(str(prefs['threads']))
-        self.form.addRow('Sync Threads:', self.threads)
+        self.threads.setToolTip('Book files uploaded at the same time')
+        self.form.addRow('Upload Threads:', self.threads)
+
+        self.check_threads = QComboBox(self)
+        for n in range(5):
+            self.check_threads.addItem(str(pow(2, n)))
+        self.check_threads.setCurrentText(str(prefs['check_threads']))
+        self.check_threads.setToolTip('Checks and metadata requests sent at the same time')
+        self.form.addRow('Request Threads:', self.check_threads)
+
+        self.hash_threads = QComboBox(self)
+        for n in range(3):
+            self.hash_threads.addItem(str(pow(2, n)))
+        self.hash_threads.setCurrentText(str(prefs['hash_threads']))
+        self.hash_threads.setToolTip('Book files read to compute their digest at the same time')
+        self.form.addRow('Hashing Threads:', self.hash_threads)
+
+        self.shards = QComboBox(self)
+        for n in range(4):
+            self.shards.addItem(str(pow(2, n)))
+        self.shards.setCurrentText(str(prefs['shards']))
+        self.shards.setToolTip('Processes a full sync of a very large library is split over, each with the threads above')
+        self.form.addRow('Sync Processes:', self.shards)
+
+        self.disk_readers = QComboBox(self)
+        self.disk_readers.addItem('Unlimited', 0)
+        for n in range(3):
+            self.disk_readers.addItem(str(pow(2, n)), pow(2, n))
+        self.disk_readers.setCurrentIndex(max(0, self.disk_readers.findData(prefs['disk_readers'])))
+        self.disk_readers.setToolTip('Book files read from disk at the same time, for hashing or uploading')
+        self.form.addRow('Disk Readers:', self.disk_readers)
+
+        self.disk_order_layout = QHBoxLayout()
+        self.disk_order_layout.setContentsMargins(0, 0, 0, 0)
+
+        self.disk_order = QCheckBox(self)
+        self.disk_order.setChecked(prefs['disk_order'])
+        self.disk_order_layout.addWidget(self.disk_order)
+
+        self.disk_order_hint = QLabel('(read books in library folder order, for hard disks and network shares)')
+        self.disk_order_layout.addWidget(self.disk_order_hint)
+
+        self.form.addRow('Disk Order:', self.disk_order_layout)
 
         self.bookshelves_custom_column = QComboBox(self)
         self.bookshelves_custom_column.addItem('')
@@ -90,14 +174,102 @@ class ConfigWidget(QWidget):
         self.preferred_format.setCurrentIndex(index if index >= 0 else 0)
         self.form.addRow('Preferred Format:', self.preferred_format)
 
+        self.bandwidth_day_limit = self.build_bandwidth_limit(prefs['bandwidth_day_limit'])
+        self.form.addRow('Upload Limit (day):', self.bandwidth_day_limit)
+
+        self.bandwidth_night_limit = self.build_bandwidth_limit(prefs['bandwidth_night_limit'])
+        self.form.addRow('Upload Limit (night):', self.bandwidth_night_limit)
+
+        self.bandwidth_hours_layout = QHBoxLayout()
+        self.bandwidth_hours_layout.setContentsMargins(0, 0, 0, 0)
+
+        self.bandwidth_day_start = self.build_hour(prefs['bandwidth_day_start'])
+        self.bandwidth_hours_layout.addWidget(self.bandwidth_day_start)
+        self.bandwidth_hours_layout.addWidget(QLabel('to'))
+        self.bandwidth_day_end = self.build_hour(prefs['bandwidth_day_end'])
+        self.bandwidth_hours_layout.addWidget(self.bandwidth_day_end)
+        self.bandwidth_hours_layout.addStretch()
+
+        self.form.addRow('Daytime Hours:', self.bandwidth_hours_layout)
+
+        self.request_timeout = self.build_timeout(prefs['request_timeout'])
+        self.request_timeout.setToolTip('Longest time an API request without a book file may take')
+        self.form.addRow('Request Timeout:', self.request_timeout)
+
+        self.stall_timeout = self.build_timeout(prefs['stall_timeout'])
+        self.stall_timeout.setToolTip('Longest time a request may go without sending or receiving any data')
+        self.form.addRow('Stall Timeout:', self.stall_timeout)
+
+        self.metrics_textfile_dir = QLineEdit(self)
+        self.metrics_textfile_dir.setText(prefs['metrics_textfile_dir'])
+        self.metrics_textfile_dir.setPlaceholderText('(optional, Prometheus textfile collector folder)')
+        self.form.addRow('Metrics Folder:', self.metrics_textfile_dir)
+
+        # Other libraries calibre knows about, which can be synced together
+        # with the current one.
+        self.libraries = QListWidget(self)
+        current_library_path = path.normcase(path.abspath(get_current_db().library_path))
+        for library_path in sorted(gprefs.get('library_usage_stats', {})):
+            if path.normcase(path.abspath(library_path)) == current_library_path:
+                continue
+            item = QListWidgetItem(library_path, self.libraries)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if library_path in prefs['libraries'] else Qt.Unchecked)
+        self.libraries.setMaximumHeight(80)
+        if self.libraries.count() > 0:
+            self.form.addRow('Other Libraries:', self.libraries)
+
         # Ensure the dialog opens tall enough to show every row (including the
-        # last "Preferred Format" field) without the user needing to scroll.
+        # last field) without the user needing to scroll.
         self.setMinimumHeight(self.sizeHint().height())
 
+    def build_bandwidth_limit(self, value):
+        limit = QSpinBox(self)
+        limit.setRange(0, 1048576)
+        limit.setSingleStep(64)
+        limit.setSuffix(' KB/s')
+        limit.setSpecialValueText('Unlimited')
+        limit.setValue(value)
+        return limit
+
+    def build_hour(self, value):
+        hour = QSpinBox(self)
+        hour.setRange(0, 23)
+        hour.setSuffix(':00')
+        hour.setValue(value)
+        return hour
+
+    def build_timeout(self, value):
+        timeout = QSpinBox(self)
+        timeout.setRange(0, 3600)
+        timeout.setSingleStep(10)
+        timeout.setSuffix(' s')
+        timeout.setSpecialValueText('None')
+        timeout.setValue(value)
+        return timeout
+
     def save_settings(self):
         prefs['api_key'] = unicode(self.api_key.text())
         prefs['debug'] = self.debug.isChecked()
+        prefs['profile'] = self.profile.isChecked()
+        prefs['trace'] = self.trace.isChecked()
         prefs['update_metadata'] = self.update_metadata.isChecked()
         prefs['threads'] = int(self.threads.currentText())
+        prefs['check_threads'] = int(self.check_threads.currentText())
+        prefs['hash_threads'] = int(self.hash_threads.currentText())
+        prefs['shards'] = int(self.shards.currentText())
+        prefs['disk_readers'] = self.disk_readers.currentData()
+        prefs['disk_order'] = self.disk_order.isChecked()
         prefs['bookshelves_custom_column'] = unicode(self.bookshelves_custom_column.currentText())
         prefs['preferred_format'] = self.preferred_format.currentData()
+        prefs['bandwidth_day_limit'] = self.bandwidth_day_limit.value()
+        prefs['bandwidth_night_limit'] = self.bandwidth_night_limit.value()
+        prefs['bandwidth_day_start'] = self.bandwidth_day_start.value()
+        prefs['bandwidth_day_end'] = self.bandwidth_day_end.value()
+        prefs['request_timeout'] = self.request_timeout.value()
+        prefs['stall_timeout'] = self.stall_timeout.value()
+        prefs['metrics_textfile_dir'] = unicode(self.metrics_textfile_dir.text()).strip()
+        prefs['libraries'] = [
+            self.libraries.item(i).text() for i in range(self.libraries.count())
+            if self.libraries.item(i).checkState() == Qt.Checked
+        ]
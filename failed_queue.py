@@ -0,0 +1,86 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from datetime import datetime
+from os import path, remove
+import json
+
+
+# Books that failed to sync, kept across runs in bookfusion_failed.json in the
+# library folder so they can be retried without syncing the whole library. A
+# book leaves the queue as soon as it is uploaded, updated or skipped.
+class FailedQueue:
+    FILENAME = 'bookfusion_failed.json'
+
+    # Rejected by the server, e.g. a 422 with a validation message.
+    VALIDATION = 'validation'
+    # Any other client error reported by the server.
+    REQUEST = 'request'
+    FORMAT = 'format'
+    FILESIZE = 'filesize'
+    # The book file could not be read.
+    FILE = 'file'
+    # The server answered with something that could not be parsed.
+    RESPONSE = 'response'
+    SERVER = 'server'
+    NETWORK = 'network'
+
+    # Failures worth retrying on their own a little later.
+    TRANSIENT = [RESPONSE, SERVER, NETWORK]
+
+    # A transient failure is retried within the same run after RETRY_DELAY
+    # seconds, doubled for every further retry.
+    RETRY_DELAY = 15
+    MAX_RETRIES = 2
+
+    def __init__(self, library_path):
+        self.file_path = path.join(library_path, self.FILENAME)
+        self.books = {}
+        self.load()
+
+    def __len__(self):
+        return len(self.books)
+
+    def load(self):
+        if not path.exists(self.file_path):
+            return
+
+        try:
+            with open(self.file_path) as f:
+                books = json.load(f)['books']
+        except (OSError, ValueError, KeyError):
+            return
+
+        self.books = dict((int(book_id), entry) for book_id, entry in books.items())
+
+    def save(self):
+        if not self.books:
+            if path.exists(self.file_path):
+                remove(self.file_path)
+            return
+
+        with open(self.file_path, 'w') as f:
+            f.write(json.dumps({'books': self.books}, indent=2, sort_keys=True))
+
+    def record(self, book_id, reason, category):
+        now = datetime.now().isoformat()
+        entry = self.books.setdefault(book_id, {'attempts': 0, 'first_failed_at': now})
+        entry['attempts'] += 1
+        entry['reason'] = reason
+        entry['category'] = category
+        entry['last_failed_at'] = now
+        return entry
+
+    def resolve(self, book_id):
+        self.books.pop(book_id, None)
+
+    def book_ids(self):
+        return sorted(self.books)
+
+    @classmethod
+    def is_transient(cls, category):
+        return category in cls.TRANSIENT
+
+    @classmethod
+    def retry_delay(cls, retries):
+        return cls.RETRY_DELAY * 2 ** retries
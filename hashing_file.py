@@ -0,0 +1,98 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QIODevice, QIODeviceBase, QFile
+from os import path
+from hashlib import sha256
+
+
+ZEROS = bytes(65536)
+
+
+def update_zeros(h, count):
+    # Same as h.update(bytes(count)), without holding count bytes in memory.
+    zeros = memoryview(ZEROS)
+    while count > 0:
+        h.update(zeros[:min(count, len(ZEROS))])
+        count -= len(ZEROS)
+
+
+def new_file_hash(size):
+    # Digests must stay identical to the ones already stored on the server, so
+    # the prefix used by earlier releases is kept as is: size zero bytes, then
+    # one more zero byte.
+    h = sha256()
+    update_zeros(h, size)
+    h.update(b'\0')
+    return h
+
+
+def file_digest(file_path):
+    h = new_file_hash(path.getsize(file_path))
+    with open(file_path, 'rb') as file:
+        block = file.read(65536)
+        while len(block) > 0:
+            h.update(block)
+            block = file.read(65536)
+    return h.hexdigest()
+
+
+# Read-only file device that computes the upload digest while the file is being
+# read, so a file streamed as a request body only needs to be read from disk
+# once.
+class HashingFile(QIODevice):
+    def __init__(self, file_path, parent=None):
+        QIODevice.__init__(self, parent)
+
+        self.file = QFile(file_path)
+        self.hash = None
+        self.hashed = 0
+        self.bytes_read = 0
+
+    def fileName(self):
+        return self.file.fileName()
+
+    def open(self, mode):
+        if not self.file.open(mode):
+            return False
+        self.hash = new_file_hash(self.file.size())
+        self.hashed = 0
+        return QIODevice.open(self, mode | QIODeviceBase.OpenModeFlag.Unbuffered)
+
+    def close(self):
+        self.file.close()
+        QIODevice.close(self)
+
+    def size(self):
+        return self.file.size()
+
+    def isSequential(self):
+        return False
+
+    def seek(self, pos):
+        if not self.file.seek(pos):
+            return False
+        return QIODevice.seek(self, pos)
+
+    def readData(self, maxlen):
+        pos = self.file.pos()
+        data = self.file.read(maxlen)
+        self.bytes_read += len(data)
+
+        # Only bytes that extend the hashed prefix are fed to the hash, so a
+        # body that gets rewound and resent is not hashed twice.
+        end = pos + len(data)
+        if pos <= self.hashed < end:
+            self.hash.update(data[self.hashed - pos:])
+            self.hashed = end
+
+        return data
+
+    def writeData(self, data):
+        return -1
+
+    def digest(self):
+        # Returns None unless the whole file has been read in order.
+        if self.hash is None or self.hashed != self.file.size():
+            return None
+        return self.hash.hexdigest()
@@ -0,0 +1,96 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from calibre.utils.config import config_dir
+from datetime import datetime, timedelta
+from hashlib import sha256
+from os import path, replace
+import json
+
+
+# Results of /uploads?isbn=... searches, shared by the workers of a run and
+# kept across runs in the calibre config folder, one file per API key. A book
+# found on BookFusion is remembered for POSITIVE_TTL, an ISBN nothing was found
+# for only for NEGATIVE_TTL, as it may be uploaded from elsewhere any time.
+# Only the id of the book found is kept: its metadata digest changes with every
+# update, so it is asked for with a check of the id. The shards of a sharded
+# sync send the entries they changed to the parent, the only process writing
+# the file.
+class IsbnCache:
+    POSITIVE_TTL = timedelta(days=7)
+    NEGATIVE_TTL = timedelta(days=1)
+    MAX_ENTRIES = 10000
+
+    def __init__(self, api_key):
+        account = sha256(api_key.encode('utf-8')).hexdigest()[:16]
+        self.file_path = path.join(config_dir, 'plugins', 'bookfusion_isbn_cache_{}.json'.format(account))
+        self.entries = {}
+        self.searching = set()
+        self.waiting = {}
+        self.changed = set()
+        self.load()
+
+    def load(self):
+        if not path.exists(self.file_path):
+            return
+
+        try:
+            with open(self.file_path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            return
+
+    def save(self):
+        # Expired entries are dropped, then the oldest ones past MAX_ENTRIES.
+        now = datetime.now()
+        entries = [(isbn, entry) for isbn, entry in list(self.entries.items()) if not self.is_expired(entry, now)]
+        entries.sort(key=lambda item: item[1]['cached_at'], reverse=True)
+        self.entries = dict(entries[:self.MAX_ENTRIES])
+
+        with open(self.file_path + '.tmp', 'w') as f:
+            f.write(json.dumps(self.entries, sort_keys=True))
+        replace(self.file_path + '.tmp', self.file_path)
+
+    def to_state(self):
+        # The entries changed in this process.
+        return dict((isbn, self.entries[isbn]) for isbn in self.changed if isbn in self.entries)
+
+    def merge(self, state):
+        self.entries.update(state)
+
+    def is_expired(self, entry, now):
+        ttl = self.NEGATIVE_TTL if entry['result'] is None else self.POSITIVE_TTL
+        return datetime.fromisoformat(entry['cached_at']) + ttl < now
+
+    def lookup(self, isbn, found, retry):
+        # Returns False if the caller has to search for the ISBN itself, and
+        # then must call put() or forget() once the search is over. Otherwise
+        # found(result) is called with the cached result, either right away or
+        # once the search another worker is running is over; if that search
+        # fails, retry() is called instead.
+        entry = self.entries.get(isbn)
+        if entry is not None and not self.is_expired(entry, datetime.now()):
+            found(entry['result'])
+            return True
+
+        if isbn in self.searching:
+            self.waiting.setdefault(isbn, []).append((found, retry))
+            return True
+
+        self.searching.add(isbn)
+        return False
+
+    def put(self, isbn, result):
+        if result is not None:
+            result = {'id': result['id']}
+        self.entries[isbn] = {'result': result, 'cached_at': datetime.now().isoformat()}
+        self.changed.add(isbn)
+
+        self.searching.discard(isbn)
+        for found, retry in self.waiting.pop(isbn, []):
+            found(result)
+
+    def forget(self, isbn):
+        self.searching.discard(isbn)
+        for found, retry in self.waiting.pop(isbn, []):
+            retry()
@@ -0,0 +1,123 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QObject, pyqtSignal, QThread
+from calibre.library import db as open_library
+from os import path
+
+from calibre_plugins.bookfusion.logger import Logger
+from calibre_plugins.bookfusion.check_worker import CheckWorker
+from calibre_plugins.bookfusion.upload_manager import UploadManager
+
+
+# Syncs all books of a library other than the one open in calibre, alongside
+# the main UploadManager. The library gets its own check phase, log file and
+# identifier writes, while uploads go through the main manager's network
+# access manager, bandwidth limiter, worker budget and stages.
+class LibrarySync(QObject):
+    finished = pyqtSignal(str, str)
+
+    def __init__(self, manager, library_path):
+        QObject.__init__(self, manager)
+
+        self.manager = manager
+        self.library_path = library_path
+        self.canceled = False
+        self.done = False
+        self.error = None
+        self.check_worker = None
+        self.upload_manager = None
+        self.limits = None
+        self.valid_book_ids = None
+
+        self.counts = {'uploaded': 0, 'updated': 0, 'skipped': 0, 'failed': 0}
+
+    def start(self):
+        self.legacy_db = open_library(self.library_path)
+        self.db = self.legacy_db.new_api
+        self.logger = Logger(path.join(self.library_path, 'bookfusion_sync.log'))
+        self.logger.info('Start sync: library_path={}'.format(self.library_path))
+
+        self.check_thread = QThread(self)
+
+        self.check_worker = CheckWorker(self.db, self.logger, list(self.db.all_book_ids()))
+        self.check_worker.finished.connect(self.check_thread.quit)
+        self.check_worker.finished.connect(self.finish_check)
+        self.check_worker.limitsAvailable.connect(self.apply_limits)
+        self.check_worker.resultsAvailable.connect(self.apply_results)
+        self.check_worker.aborted.connect(self.abort)
+        self.check_worker.moveToThread(self.check_thread)
+
+        self.check_thread.started.connect(self.check_worker.start)
+        self.check_thread.start()
+
+    def cancel(self):
+        self.canceled = True
+        if self.upload_manager:
+            self.upload_manager.cancel()
+        elif self.check_worker:
+            self.check_worker.cancel()
+
+    def apply_limits(self, limits):
+        self.limits = limits
+
+    def apply_results(self, books_count, valid_ids):
+        self.logger.info('Check results: books_count={}; valid_ids={}'.format(books_count, valid_ids))
+        self.valid_book_ids = valid_ids
+
+    def finish_check(self):
+        if self.canceled or self.error:
+            self.finish()
+            return
+
+        book_ids = self.valid_book_ids
+        if not book_ids:
+            self.finish()
+            return
+
+        # There is nobody to ask about exceeding the account limits here, so
+        # books past the limit are left out, as when the prompt is accepted.
+        # The limit is shared with the main library and the other libraries,
+        # so this library gets what they left of it.
+        book_ids = self.manager.take_library_books(book_ids)
+        if len(book_ids) < len(self.valid_book_ids):
+            self.logger.info('Total books exceeded: left_out={}'.format(len(self.valid_book_ids) - len(book_ids)))
+        if not book_ids:
+            self.finish()
+            return
+
+        self.upload_manager = UploadManager(self.db, self.logger, book_ids, False, self.limits)
+        self.upload_manager.network = self.manager.network
+        self.upload_manager.limiter = self.manager.limiter
+        self.upload_manager.budget = self.manager.budget
+        self.upload_manager.stages = self.manager.stages
+        self.upload_manager.isbn_cache = self.manager.isbn_cache
+        self.upload_manager.uploaded.connect(lambda book_id: self.count('uploaded'))
+        self.upload_manager.updated.connect(lambda book_id: self.count('updated'))
+        self.upload_manager.skipped.connect(lambda book_id: self.count('skipped'))
+        self.upload_manager.failed.connect(lambda book_id, msg, category: self.count('failed'))
+        self.upload_manager.aborted.connect(self.abort)
+        self.upload_manager.finished.connect(self.finish)
+        self.upload_manager.run()
+
+    def count(self, key):
+        self.counts[key] += 1
+
+    def abort(self, error):
+        self.error = error
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+
+        if self.error:
+            summary = self.error
+        elif self.canceled:
+            summary = 'Canceled.'
+        else:
+            summary = '{uploaded} uploaded, {updated} updated, {skipped} skipped, {failed} failed'.format(**self.counts)
+        self.logger.info('Finish sync: {}'.format(summary))
+
+        self.legacy_db.close()
+        self.finished.emit(self.library_path, summary)
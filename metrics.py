@@ -0,0 +1,207 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from datetime import datetime
+from math import ceil
+from os import path, replace
+import json
+import re
+
+
+# Performance record of one sync run. When the run ends it is appended as a
+# JSON line to bookfusion_sync_metrics.jsonl in the library folder and can
+# also be written in the Prometheus textfile format.
+class SyncMetrics:
+    HISTORY_FILENAME = 'bookfusion_sync_metrics.jsonl'
+
+    ACTIONS = ['uploaded', 'updated', 'skipped', 'failed', 'duplicate']
+    QUANTILES = [0.5, 0.9, 0.99]
+
+    def __init__(self, library_path, workers, dry_run=False):
+        self.library_path = library_path
+        self.workers = workers
+        self.dry_run = dry_run
+        self.started_at = datetime.now()
+        self.books = dict((action, 0) for action in self.ACTIONS)
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+        self.retries = 0
+        self.errors = {}
+        self.latencies = {}
+        self.lookups = {}
+        self.faults = None
+        self.saved = False
+
+    def count(self, action):
+        self.books[action] += 1
+
+    def record_latency(self, phase, seconds):
+        self.latencies.setdefault(phase, []).append(seconds)
+
+    def record_bytes(self, size):
+        self.bytes_sent += size
+
+    def record_delta(self, file_size, delta_size):
+        # Book file bytes a re-upload did not send thanks to a delta.
+        self.bytes_saved += max(0, file_size - delta_size)
+
+    def record_retry(self):
+        self.retries += 1
+
+    def record_error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def record_lookup(self, cache, hit):
+        lookups = self.lookups.setdefault(cache, {'hits': 0, 'misses': 0})
+        lookups['hits' if hit else 'misses'] += 1
+
+    def record_faults(self, profile, injected, violations):
+        # Only for soak runs with fault injection, see tools/soak.py.
+        self.faults = {'profile': profile, 'injected': dict(injected), 'violations': list(violations)}
+
+    def cache_stats(self):
+        stats = {}
+        for cache, lookups in self.lookups.items():
+            total = lookups['hits'] + lookups['misses']
+            stats[cache] = dict(lookups, hit_rate=round(lookups['hits'] / total, 4) if total else None)
+        return stats
+
+    def cache_summary(self):
+        # For the end of run message, e.g. 'cache hits: check 85%, isbn 40%'.
+        rates = [
+            '{} {:.0%}'.format(cache, stats['hit_rate'])
+            for cache, stats in sorted(self.cache_stats().items()) if stats['hit_rate'] is not None
+        ]
+        return 'cache hits: {}'.format(', '.join(rates)) if rates else None
+
+    def to_state(self):
+        # Raw measurements, for merging runs of several processes.
+        return {
+            'books': self.books,
+            'bytes_sent': self.bytes_sent,
+            'bytes_saved': self.bytes_saved,
+            'retries': self.retries,
+            'errors': self.errors,
+            'latencies': self.latencies,
+            'lookups': self.lookups,
+            'faults': self.faults
+        }
+
+    def merge(self, state):
+        for action, count in state['books'].items():
+            self.books[action] += count
+        self.bytes_sent += state['bytes_sent']
+        self.bytes_saved += state.get('bytes_saved', 0)
+        self.retries += state['retries']
+        for kind, count in state['errors'].items():
+            self.errors[kind] = self.errors.get(kind, 0) + count
+        for phase, values in state['latencies'].items():
+            self.latencies.setdefault(phase, []).extend(values)
+        for cache, lookups in state['lookups'].items():
+            merged = self.lookups.setdefault(cache, {'hits': 0, 'misses': 0})
+            merged['hits'] += lookups['hits']
+            merged['misses'] += lookups['misses']
+        if state.get('faults'):
+            if self.faults is None:
+                self.faults = {'profile': state['faults']['profile'], 'injected': {}, 'violations': []}
+            for fault, count in state['faults']['injected'].items():
+                self.faults['injected'][fault] = self.faults['injected'].get(fault, 0) + count
+            self.faults['violations'].extend(state['faults']['violations'])
+
+    def percentiles(self, values):
+        values = sorted(values)
+        result = {}
+        for q in self.QUANTILES:
+            index = max(0, int(ceil(q * len(values))) - 1)
+            result['p{}'.format(int(q * 100))] = round(values[index], 4)
+        result['max'] = round(values[-1], 4)
+        result['count'] = len(values)
+        return result
+
+    def to_record(self, canceled=False):
+        finished_at = datetime.now()
+        record = {
+            'started_at': self.started_at.isoformat(),
+            'finished_at': finished_at.isoformat(),
+            'duration': round((finished_at - self.started_at).total_seconds(), 3),
+            'canceled': canceled,
+            'dry_run': self.dry_run,
+            'workers': self.workers,
+            'books': self.books,
+            'bytes_sent': self.bytes_sent,
+            'bytes_saved': self.bytes_saved,
+            'retries': self.retries,
+            'errors': self.errors,
+            'caches': self.cache_stats(),
+            'latency': dict((phase, self.percentiles(values)) for phase, values in self.latencies.items() if values)
+        }
+        if self.faults is not None:
+            record['faults'] = self.faults
+        return record
+
+    def save(self, textfile_dir=None, canceled=False):
+        # Only the first call of a run is recorded.
+        if self.saved:
+            return
+        self.saved = True
+
+        record = self.to_record(canceled)
+        with open(path.join(self.library_path, self.HISTORY_FILENAME), 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+        if textfile_dir:
+            self.write_textfile(textfile_dir, record)
+
+    def write_textfile(self, textfile_dir, record):
+        library = path.basename(path.normpath(self.library_path))
+        labels = 'library="{}"'.format(library.replace('\\', '\\\\').replace('"', '\\"'))
+        finished_at = datetime.fromisoformat(record['finished_at']).timestamp()
+
+        lines = []
+
+        def gauge(name, value, extra_labels='', help_text=None):
+            if help_text:
+                lines.append('# HELP bookfusion_sync_{} {}'.format(name, help_text))
+                lines.append('# TYPE bookfusion_sync_{} gauge'.format(name))
+            label_str = labels + (',' + extra_labels if extra_labels else '')
+            lines.append('bookfusion_sync_{}{{{}}} {}'.format(name, label_str, value))
+
+        gauge('last_run_timestamp_seconds', finished_at, help_text='End of the last sync run.')
+        gauge('last_run_duration_seconds', record['duration'], help_text='Duration of the last sync run.')
+        gauge('last_run_workers', record['workers'], help_text='Sync threads used by the last run.')
+        gauge('last_run_bytes_sent', record['bytes_sent'], help_text='Book file bytes sent by the last run.')
+        gauge('last_run_bytes_saved', record['bytes_saved'],
+              help_text='Book file bytes not sent thanks to deltas in the last run.')
+        gauge('last_run_retries', record['retries'], help_text='Requests retried in the last run.')
+
+        for index, action in enumerate(self.ACTIONS):
+            gauge('last_run_books', record['books'][action], 'action="{}"'.format(action),
+                  'Books per outcome in the last run.' if index == 0 else None)
+
+        for index, (kind, count) in enumerate(sorted(record['errors'].items())):
+            gauge('last_run_errors', count, 'type="{}"'.format(kind),
+                  'Request errors per type in the last run.' if index == 0 else None)
+
+        first = True
+        for cache, stats in sorted(record['caches'].items()):
+            if stats['hit_rate'] is None:
+                continue
+            gauge('last_run_cache_hit_ratio', stats['hit_rate'], 'cache="{}"'.format(cache),
+                  'Share of lookups answered from a cache in the last run.' if first else None)
+            first = False
+
+        first = True
+        for phase, stats in sorted(record['latency'].items()):
+            for q in self.QUANTILES:
+                gauge('last_run_latency_seconds', stats['p{}'.format(int(q * 100))],
+                      'phase="{}",quantile="{}"'.format(phase, q),
+                      'Request latency per phase in the last run.' if first else None)
+                first = False
+
+        # Written to a temporary file first so a collector never reads a
+        # partial file.
+        slug = re.sub(r'[^A-Za-z0-9_-]+', '_', library) or 'library'
+        file_path = path.join(textfile_dir, 'bookfusion_{}.prom'.format(slug))
+        with open(file_path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        replace(file_path + '.tmp', file_path)
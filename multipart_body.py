@@ -0,0 +1,127 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QIODevice, QIODeviceBase, QNetworkRequest, QFileInfo
+from uuid import uuid4
+
+
+def escape_quotes(value):
+    return value.replace('"', '\\"')
+
+
+def form_data_disposition(name, filename=None):
+    if filename is None:
+        return 'form-data; name="{}"'.format(escape_quotes(name))
+    return 'form-data; name="{}"; filename="{}"'.format(escape_quotes(name), escape_quotes(filename))
+
+
+# multipart/form-data request body used for requests that carry a book file.
+#
+# Unlike QHttpMultiPart, reads can be throttled by a BandwidthLimiter: when the
+# limiter grants no bytes, readData() returns nothing and the limiter emits
+# readyRead once bytes are available again, which resumes the upload.
+class MultipartBody(QIODevice):
+    def __init__(self, limiter=None, parent=None):
+        QIODevice.__init__(self, parent)
+
+        self.limiter = limiter
+        self.boundary = uuid4().hex
+        self.segments = []
+        self.offsets = []
+        self.total = 0
+        self.offset = 0
+
+    def add_part(self, name, value):
+        if isinstance(value, QIODevice):
+            filename = QFileInfo(value.fileName()).fileName()
+            disposition = form_data_disposition(name, filename)
+        else:
+            disposition = form_data_disposition(name)
+            value = value.encode('utf-8')
+
+        self.segments.append('--{}\r\nContent-Disposition: {}\r\n\r\n'.format(self.boundary, disposition).encode('utf-8'))
+        self.segments.append(value)
+        self.segments.append(b'\r\n')
+
+    def prepare(self, req):
+        self.segments.append('--{}--\r\n'.format(self.boundary).encode('utf-8'))
+
+        self.offsets = []
+        self.total = 0
+        for segment in self.segments:
+            self.offsets.append(self.total)
+            self.total += self.segment_size(segment)
+
+        self.open(QIODeviceBase.OpenModeFlag.ReadOnly | QIODeviceBase.OpenModeFlag.Unbuffered)
+        if self.limiter:
+            self.limiter.register(self)
+
+        req.setHeader(
+            QNetworkRequest.KnownHeaders.ContentTypeHeader,
+            'multipart/form-data; boundary="{}"'.format(self.boundary)
+        )
+        req.setHeader(QNetworkRequest.KnownHeaders.ContentLengthHeader, self.total)
+
+    def close(self):
+        if self.limiter:
+            self.limiter.unregister(self)
+        QIODevice.close(self)
+
+    def segment_size(self, segment):
+        if isinstance(segment, QIODevice):
+            return segment.size()
+        return len(segment)
+
+    def size(self):
+        return self.total
+
+    def isSequential(self):
+        return False
+
+    def seek(self, pos):
+        self.offset = pos
+        return QIODevice.seek(self, pos)
+
+    def readData(self, maxlen):
+        maxlen = min(maxlen, self.total - self.offset)
+        if maxlen <= 0:
+            return b''
+
+        if self.limiter:
+            maxlen = self.limiter.acquire(self, maxlen)
+            if maxlen == 0:
+                return b''
+
+        chunks = []
+        index = self.segment_index(self.offset)
+        while maxlen > 0 and index < len(self.segments):
+            segment = self.segments[index]
+            start = self.offset - self.offsets[index]
+            count = min(maxlen, self.segment_size(segment) - start)
+
+            if isinstance(segment, QIODevice):
+                segment.seek(start)
+                data = segment.read(count)
+            else:
+                data = segment[start:start + count]
+
+            if len(data) == 0:
+                break
+
+            chunks.append(data)
+            self.offset += len(data)
+            maxlen -= len(data)
+            if len(data) < count:
+                break
+            index += 1
+
+        return b''.join(chunks)
+
+    def writeData(self, data):
+        return -1
+
+    def segment_index(self, offset):
+        for index in range(len(self.offsets) - 1, -1, -1):
+            if self.offsets[index] <= offset:
+                return index
+        return 0
@@ -0,0 +1,75 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QObject
+from datetime import datetime
+from os import path
+import cProfile
+import io
+import pstats
+import tracemalloc
+
+
+# Profiles the thread a sync phase runs in. Moved to that thread and connected
+# to its started and finished signals, it runs cProfile and tracemalloc for the
+# lifetime of the thread and then writes bookfusion_profile_<tag>.prof (for
+# pstats or snakeviz) and a readable bookfusion_profile_<tag>.txt report into
+# the library folder.
+class RunProfiler(QObject):
+    TOP_FUNCTIONS = 40
+    TOP_ALLOCATIONS = 25
+
+    def __init__(self, library_path, tag):
+        QObject.__init__(self)
+
+        self.library_path = library_path
+        self.tag = tag
+        self.profile = None
+
+    def attach(self, thread):
+        self.moveToThread(thread)
+        thread.started.connect(self.start)
+        thread.finished.connect(self.stop)
+
+    def start(self):
+        self.started_at = datetime.now()
+        self.owns_tracemalloc = not tracemalloc.is_tracing()
+        if self.owns_tracemalloc:
+            tracemalloc.start(10)
+        self.start_snapshot = tracemalloc.take_snapshot()
+
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self.owns_tracemalloc:
+            tracemalloc.stop()
+
+        base = path.join(self.library_path, 'bookfusion_profile_{}'.format(self.tag))
+        self.profile.dump_stats(base + '.prof')
+
+        report = io.StringIO()
+        report.write('BookFusion {} profile, {} to {}\n\n'.format(self.tag, self.started_at, datetime.now()))
+
+        stats = pstats.Stats(self.profile, stream=report)
+        stats.strip_dirs()
+        report.write('Top functions by cumulative time:\n')
+        stats.sort_stats('cumulative').print_stats(self.TOP_FUNCTIONS)
+        report.write('Top functions by own time:\n')
+        stats.sort_stats('tottime').print_stats(self.TOP_FUNCTIONS)
+
+        report.write('Traced memory: current={} KiB; peak={} KiB\n\n'.format(current // 1024, peak // 1024))
+        report.write('Top allocations since the start of the run:\n')
+        for stat in snapshot.compare_to(self.start_snapshot, 'lineno')[:self.TOP_ALLOCATIONS]:
+            report.write('{}\n'.format(stat))
+
+        with open(base + '.txt', 'w') as f:
+            f.write(report.getvalue())
+
+        self.profile = None
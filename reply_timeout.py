@@ -0,0 +1,58 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QObject, QTimer
+
+
+# Aborts a network reply that takes longer than timeout seconds in total, or
+# that sends and receives nothing for stall_timeout seconds. A zero disables
+# either limit. The aborted reply finishes with OperationCanceledError like a
+# canceled one; reason tells the two apart.
+class ReplyTimeout(QObject):
+    REQUEST = 'request'
+    STALL = 'stall'
+
+    def __init__(self, reply, timeout, stall_timeout):
+        # Owned by the reply, so it goes away with it.
+        QObject.__init__(self, reply)
+
+        self.reply = reply
+        self.reason = None
+
+        self.request_timer = None
+        if timeout:
+            self.request_timer = QTimer(self)
+            self.request_timer.setSingleShot(True)
+            self.request_timer.timeout.connect(self.expire_request)
+            self.request_timer.start(timeout * 1000)
+
+        self.stall_timer = None
+        if stall_timeout:
+            self.stall_timer = QTimer(self)
+            self.stall_timer.setSingleShot(True)
+            self.stall_timer.timeout.connect(self.expire_stall)
+            self.stall_timer.start(stall_timeout * 1000)
+            reply.uploadProgress.connect(self.restart_stall)
+            reply.downloadProgress.connect(self.restart_stall)
+
+        reply.finished.connect(self.stop)
+
+    def restart_stall(self, done, total):
+        self.stall_timer.start()
+
+    def expire_request(self):
+        self.expire(self.REQUEST)
+
+    def expire_stall(self):
+        self.expire(self.STALL)
+
+    def expire(self, reason):
+        if self.reason is None and self.reply.isRunning():
+            self.reason = reason
+            self.reply.abort()
+
+    def stop(self):
+        if self.request_timer:
+            self.request_timer.stop()
+        if self.stall_timer:
+            self.stall_timer.stop()
@@ -0,0 +1,147 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QCoreApplication, QTimer, pyqtSignal
+from calibre.library import db as open_library
+from threading import Thread
+from time import monotonic
+from os import path
+import json
+import sys
+
+from calibre_plugins.bookfusion.logger import Logger
+from calibre_plugins.bookfusion.upload_manager import UploadManager
+
+
+# Command run by calibre's pipe worker for each shard. calibre.customize.ui is
+# imported first so that plugin modules can be imported in the worker process.
+COMMAND = 'from calibre.customize.ui import find_plugin; ' \
+    'from calibre_plugins.bookfusion.shard_worker import main; main()'
+
+
+# UploadManager syncing one shard of a sharded sync, in a calibre worker
+# process of its own. The library is opened read-only: every event is written
+# to the parent process as a JSON line instead, and the parent writes the
+# identifiers and keeps the failed books, metrics, throughput, check cache and
+# ISBN cache.
+class ShardManager(UploadManager):
+    commandReceived = pyqtSignal(dict)
+
+    # Upload progress is reported at most this often per book, in seconds.
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, db, logger, job, events):
+        UploadManager.__init__(
+            self, db, logger, job['book_ids'], job['reupload'], job['limits'], job['selected_book_ids']
+        )
+
+        self.events = events
+        self.bandwidth_shares = job['shards']
+        self.trace_pid = job['shard'] + 1
+        self.progress_sent_at = {}
+
+        self.commandReceived.connect(self.handle_command)
+        self.progress.connect(lambda count: self.send('progress', count=count))
+        self.uploadProgress.connect(self.send_upload_progress)
+        self.started.connect(lambda book_id: self.send('started', book_id=book_id))
+        self.uploaded.connect(lambda book_id: self.send('uploaded', book_id=book_id))
+        self.updated.connect(lambda book_id: self.send('updated', book_id=book_id))
+        self.skipped.connect(lambda book_id: self.send('skipped', book_id=book_id))
+        self.failed.connect(
+            lambda book_id, msg, category: self.send('failed', book_id=book_id, msg=msg, category=category)
+        )
+        self.retryScheduled.connect(
+            lambda book_id, msg, delay: self.send('retry', book_id=book_id, msg=msg, delay=delay)
+        )
+        self.stalled.connect(lambda book_id, seconds: self.send('stalled', book_id=book_id, seconds=seconds))
+        self.duplicate.connect(
+            lambda book_id, primary_id, size: self.send('duplicate', book_id=book_id, primary_id=primary_id, size=size)
+        )
+        self.aborted.connect(lambda msg: self.send('aborted', msg=msg))
+
+    def send(self, event, **data):
+        data['event'] = event
+        self.events.write(json.dumps(data) + '\n')
+        self.events.flush()
+
+    def send_upload_progress(self, book_id, sent, total):
+        now = monotonic()
+        if sent < total and now - self.progress_sent_at.get(book_id, 0) < self.PROGRESS_INTERVAL:
+            return
+        self.progress_sent_at[book_id] = now
+        self.send('upload_progress', book_id=book_id, sent=sent, total=total)
+
+    def send_finished(self):
+        self.send(
+            'finished',
+            canceled=self.canceled,
+            metrics=self.metrics.to_state() if self.metrics else None,
+            throughput=self.throughput.to_state() if self.metrics else None,
+            trace=self.trace.to_state() if self.trace else None,
+            check_cache=self.check_cache.to_state() if self.check_cache else None,
+            isbn_cache=self.isbn_cache.to_state() if self.isbn_cache else None
+        )
+
+    def handle_command(self, command):
+        if command['command'] == 'cancel':
+            if not self.canceled:
+                self.cancel()
+        elif command['command'] == 'enqueue':
+            self.enqueue(command['book_ids'])
+
+    def write_identifier(self, book_id, bookfusion_id):
+        self.send('identifier', book_id=book_id, bookfusion_id=bookfusion_id)
+
+    def save_throughput(self):
+        pass
+
+    def save_metrics(self, canceled=False):
+        pass
+
+    def save_trace(self):
+        pass
+
+    def save_failures(self):
+        pass
+
+    def save_check_cache(self):
+        pass
+
+    def close_stages(self):
+        # The ISBN cache file is shared with the other processes, so it is
+        # left to the parent.
+        if self.owns_stages:
+            self.stages.shutdown()
+
+
+def read_commands(manager):
+    # Runs in its own thread; commands are handled in the manager's thread.
+    for line in sys.stdin:
+        if line.strip():
+            manager.commandReceived.emit(json.loads(line))
+
+
+def main():
+    # Everything else printed, such as log lines, goes to stderr so stdout only
+    # carries events.
+    events = sys.stdout
+    sys.stdout = sys.stderr
+
+    job = json.loads(sys.stdin.readline())
+
+    app = QCoreApplication.instance() or QCoreApplication([])
+
+    legacy_db = open_library(job['library_path'], read_only=True)
+    logger = Logger(path.join(job['library_path'], 'bookfusion_sync_shard{}.log'.format(job['shard'])))
+    logger.info('Start shard: shard={}; books={}'.format(job['shard'], len(job['book_ids'])))
+
+    manager = ShardManager(legacy_db.new_api, logger, job, events)
+    manager.finished.connect(manager.send_finished)
+    manager.finished.connect(app.quit)
+
+    Thread(target=read_commands, args=(manager,), daemon=True).start()
+
+    QTimer.singleShot(0, manager.start)
+    app.exec_()
+
+    legacy_db.close()
@@ -0,0 +1,260 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QObject, pyqtSignal
+from calibre.utils.ipc.simple_worker import start_pipe_worker
+from threading import Thread, Lock
+from os import path
+import json
+
+from calibre_plugins.bookfusion.config import prefs
+from calibre_plugins.bookfusion.check_cache import CheckCache
+from calibre_plugins.bookfusion.failed_queue import FailedQueue
+from calibre_plugins.bookfusion.isbn_cache import IsbnCache
+from calibre_plugins.bookfusion.metrics import SyncMetrics
+from calibre_plugins.bookfusion.shard_worker import COMMAND
+from calibre_plugins.bookfusion.sync_plan import Throughput
+from calibre_plugins.bookfusion.sync_stages import SyncStages
+from calibre_plugins.bookfusion.sync_trace import SyncTrace
+
+
+# One worker process of a sharded sync and the thread reading its events.
+class Shard:
+    def __init__(self, sync, index, book_ids):
+        self.sync = sync
+        self.index = index
+        self.book_ids = book_ids
+        self.done = False
+        self.lock = Lock()
+
+    def start(self, job):
+        self.process = start_pipe_worker(COMMAND)
+        self.write(job)
+
+        self.reader = Thread(target=self.read, daemon=True)
+        self.reader.start()
+
+    def write(self, data):
+        with self.lock:
+            try:
+                self.process.stdin.write((json.dumps(data) + '\n').encode('utf-8'))
+                self.process.stdin.flush()
+            except (OSError, ValueError):
+                # The process is gone already.
+                pass
+
+    def read(self):
+        # Runs in its own thread; events are handled in the sync's thread.
+        for line in self.process.stdout:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            self.sync.eventReceived.emit(self.index, event)
+
+        self.process.wait()
+        self.sync.eventReceived.emit(self.index, {'event': 'exited', 'code': self.process.returncode})
+
+
+# Syncs the current library in several calibre worker processes at once, so
+# parsing, hashing and request building for large libraries are not all bound
+# to one interpreter. The books are dealt out to the shards in turn, so every
+# shard gets a similar share of each priority. Each shard runs a ShardManager
+# against the same library, opened read-only; this object has UploadManager's
+# signals, aggregates the shards' events, and is the only writer of the
+# library's identifiers, failed books, metrics and throughput, and of the
+# check and ISBN caches. The sync service lends it the ISBN cache of its
+# session, if it has one.
+#
+# Duplicate files are only detected within a shard.
+class ShardedSync(QObject):
+    finished = pyqtSignal()
+    enqueueRequested = pyqtSignal(list)
+    cancelRequested = pyqtSignal()
+    eventReceived = pyqtSignal(int, dict)
+    progress = pyqtSignal(int)
+    uploadProgress = pyqtSignal(int, int, int)
+    started = pyqtSignal(int)
+    uploaded = pyqtSignal(int)
+    updated = pyqtSignal(int)
+    skipped = pyqtSignal(int)
+    failed = pyqtSignal(int, str, str)
+    retryScheduled = pyqtSignal(int, str, int)
+    stalled = pyqtSignal(int, int)
+    duplicate = pyqtSignal(int, int, int)
+    planned = pyqtSignal(int, str)
+    planAvailable = pyqtSignal(object)
+    libraryFinished = pyqtSignal(str, str)
+    aborted = pyqtSignal(str)
+
+    def __init__(self, db, logger, book_ids, reupload, limits, selected_book_ids=(), shards=2):
+        QObject.__init__(self)
+
+        self.cancelRequested.connect(self.cancel)
+
+        self.db = db
+        self.logger = logger
+        self.book_ids = book_ids
+        self.selected_book_ids = set(selected_book_ids)
+        self.reupload = reupload
+        self.limits = limits
+        self.shard_count = shards
+        self.canceled = False
+        self.done = False
+
+        self.shards = []
+        self.counts = {}
+        self.isbn_cache = None
+
+    def start(self):
+        library_path = path.dirname(self.logger.path)
+
+        self.failures = FailedQueue(library_path)
+        self.metrics = SyncMetrics(library_path, SyncStages.worker_count() * self.shard_count)
+        self.throughput = Throughput()
+        self.trace = SyncTrace(library_path) if prefs['trace'] else None
+        self.check_cache = CheckCache(library_path, prefs['api_key'])
+        if self.isbn_cache is None:
+            self.isbn_cache = IsbnCache(prefs['api_key'])
+
+        self.eventReceived.connect(self.handle_event)
+        self.enqueueRequested.connect(self.enqueue)
+
+        for index in range(self.shard_count):
+            book_ids = self.book_ids[index::self.shard_count]
+            if not book_ids:
+                continue
+
+            shard = Shard(self, index, book_ids)
+            self.shards.append(shard)
+            self.logger.info('Start shard: shard={}; books={}'.format(index, len(book_ids)))
+            shard.start({
+                'shard': index,
+                'shards': self.shard_count,
+                'library_path': library_path,
+                'book_ids': book_ids,
+                'selected_book_ids': [book_id for book_id in book_ids if book_id in self.selected_book_ids],
+                'reupload': self.reupload,
+                'limits': self.limits
+            })
+
+        if not self.shards:
+            self.complete()
+
+    def cancel(self):
+        if self.canceled or self.done:
+            return
+
+        self.canceled = True
+        for shard in self.shards:
+            if not shard.done:
+                shard.write({'command': 'cancel'})
+        self.save(canceled=True)
+        self.finished.emit()
+
+    def enqueue(self, book_ids):
+        # Goes to the shard with the fewest books that is still running.
+        if self.done or self.canceled:
+            return
+
+        # Each shard only knows its own books, so the book limit is applied
+        # here.
+        total_books = self.limits['total_books']
+        if total_books:
+            run_book_ids = set(book_id for shard in self.shards for book_id in shard.book_ids)
+            new_ids = [book_id for book_id in book_ids if book_id not in run_book_ids]
+            left_out = set(new_ids[max(0, total_books - len(run_book_ids)):])
+            if left_out:
+                self.logger.info('Total books exceeded: book_ids={}'.format(sorted(left_out)))
+                book_ids = [book_id for book_id in book_ids if book_id not in left_out]
+            if not book_ids:
+                return
+
+        running = [shard for shard in self.shards if not shard.done]
+        if running:
+            shard = min(running, key=lambda shard: len(shard.book_ids))
+            shard.book_ids.extend(book_ids)
+            shard.write({'command': 'enqueue', 'book_ids': book_ids})
+
+    def handle_event(self, index, event):
+        shard = next(shard for shard in self.shards if shard.index == index)
+        kind = event['event']
+
+        if kind == 'progress':
+            self.counts[index] = event['count']
+            self.progress.emit(sum(self.counts.values()))
+        elif kind == 'upload_progress':
+            self.uploadProgress.emit(event['book_id'], event['sent'], event['total'])
+        elif kind == 'started':
+            self.started.emit(event['book_id'])
+        elif kind == 'identifier':
+            self.write_identifier(event['book_id'], event['bookfusion_id'])
+        elif kind in ('uploaded', 'updated', 'skipped'):
+            self.failures.resolve(event['book_id'])
+            getattr(self, kind).emit(event['book_id'])
+        elif kind == 'failed':
+            self.failures.record(event['book_id'], event['msg'], event['category'])
+            self.failed.emit(event['book_id'], event['msg'], event['category'])
+        elif kind == 'retry':
+            self.retryScheduled.emit(event['book_id'], event['msg'], event['delay'])
+        elif kind == 'stalled':
+            self.stalled.emit(event['book_id'], event['seconds'])
+        elif kind == 'duplicate':
+            self.duplicate.emit(event['book_id'], event['primary_id'], event['size'])
+        elif kind == 'aborted':
+            self.abort(event['msg'])
+        elif kind == 'finished':
+            shard.done = True
+            if event['metrics'] is not None:
+                self.metrics.merge(event['metrics'])
+                self.throughput.merge(event['throughput'])
+            if event.get('trace') and self.trace is not None:
+                self.trace.merge(event['trace'])
+            if event.get('check_cache'):
+                self.check_cache.merge(event['check_cache'])
+            if event.get('isbn_cache'):
+                self.isbn_cache.merge(event['isbn_cache'])
+            self.maybe_complete()
+        elif kind == 'exited':
+            self.logger.info('Shard exited: shard={}; code={}'.format(index, event['code']))
+            if not shard.done:
+                shard.done = True
+                if not self.canceled:
+                    self.abort('A sync process stopped unexpectedly.')
+
+    def write_identifier(self, book_id, bookfusion_id):
+        identifiers = self.db.get_proxy_metadata(book_id).identifiers
+        identifiers['bookfusion'] = bookfusion_id
+        self.db.set_field('identifiers', {book_id: identifiers})
+
+    def maybe_complete(self):
+        if not self.canceled and all(shard.done for shard in self.shards):
+            self.complete()
+
+    def complete(self):
+        if self.done:
+            return
+        self.done = True
+
+        self.throughput.save()
+        self.save()
+        self.finished.emit()
+
+    def save(self, canceled=False):
+        if self.trace is not None:
+            self.trace.save()
+            self.logger.info('Sync trace: {}'.format(self.trace.file_path))
+
+        self.logger.info('Sync metrics: {}'.format(self.metrics.to_record(canceled)))
+        self.metrics.save(prefs['metrics_textfile_dir'], canceled)
+
+        if len(self.failures) > 0:
+            self.logger.info('Failed books: {}'.format(self.failures.book_ids()))
+        self.failures.save()
+        self.check_cache.save()
+        self.isbn_cache.save()
+
+    def abort(self, msg):
+        if not self.canceled and not self.done:
+            self.cancel()
+        self.aborted.emit(msg)
@@ -9,13 +9,20 @@ from calibre_plugins.bookfusion.config import prefs
 from calibre_plugins.bookfusion.logger import Logger
 from calibre_plugins.bookfusion.check_worker import CheckWorker
 from calibre_plugins.bookfusion.upload_manager import UploadManager
+from calibre_plugins.bookfusion.sharded_sync import ShardedSync
+from calibre_plugins.bookfusion.sync_plan import SyncPlan
 from calibre_plugins.bookfusion import api
 
 
 class SyncWidget(QWidget):
-    def __init__(self, gui, do_user_config, selected_book_ids, is_sync_selected):
+    # Rows the log keeps; past this the oldest finished books are dropped.
+    MAX_LOG_ROWS = 1000
+
+    def __init__(self, gui, do_user_config, selected_book_ids, is_sync_selected, service):
         QWidget.__init__(self, gui)
 
+        self.service = service
+
         api.build_request('/limits')
 
         self.logger = Logger(path.join(gui.current_db.library_path, 'bookfusion_sync.log'))
@@ -25,6 +32,9 @@ class SyncWidget(QWidget):
             is_sync_selected = False
 
         self.worker_thread = None
+        self.worker = None
+        self.profilers = []
+        self.plan = None
 
         self.do_user_config = do_user_config
         self.db = gui.current_db.new_api
@@ -54,17 +64,27 @@ class SyncWidget(QWidget):
         self.sync_selected_radio.setEnabled(len(selected_book_ids) > 0)
         self.radio_layout.addWidget(self.sync_selected_radio)
 
-        self.reupload_possible = len(selected_book_ids) > 0 and len(selected_book_ids) <= 100
-        if self.reupload_possible:
-            for book_id in selected_book_ids:
-                identifiers = self.db.get_proxy_metadata(book_id).identifiers
-                if not identifiers.get('bookfusion'):
-                    self.reupload_possible = False
+        # Re-uploading is offered when every selected book has already been
+        # synced. One bulk field query keeps this fast for large selections.
+        self.reupload_possible = len(selected_book_ids) > 0 and all(
+            identifiers.get('bookfusion')
+            for identifiers in self.db.all_field_for('identifiers', selected_book_ids).values()
+        )
 
         self.reupload_checkbox = QCheckBox('Re-upload book files', self)
         self.reupload_checkbox.setVisible(is_sync_selected and self.reupload_possible)
         self.radio_layout.addWidget(self.reupload_checkbox)
 
+        self.dry_run_checkbox = QCheckBox('Dry run (only plan what would be synced)', self)
+        self.radio_layout.addWidget(self.dry_run_checkbox)
+
+        self.use_plan_checkbox = QCheckBox('Sync according to the last dry run', self)
+        self.use_plan_checkbox.hide()
+        self.radio_layout.addWidget(self.use_plan_checkbox)
+
+        self.libraries_checkbox = QCheckBox(self)
+        self.radio_layout.addWidget(self.libraries_checkbox)
+
         self.btn_layout = QHBoxLayout()
         self.l.addLayout(self.btn_layout)
 
@@ -115,12 +135,27 @@ class SyncWidget(QWidget):
         configured = bool(prefs['api_key'])
         self.start_btn.setEnabled(configured)
 
+        self.library_paths = self.other_library_paths()
+        self.libraries_checkbox.setText('Also sync {} other {}'.format(
+            len(self.library_paths), 'library' if len(self.library_paths) == 1 else 'libraries'
+        ))
+        self.libraries_checkbox.setVisible(self.sync_all_radio.isChecked() and len(self.library_paths) > 0)
+
+    def other_library_paths(self):
+        current_library_path = path.normcase(path.abspath(path.dirname(self.logger.path)))
+        return [
+            library_path for library_path in prefs['libraries']
+            if path.normcase(path.abspath(library_path)) != current_library_path and path.isdir(library_path)
+        ]
+
     def toggle_sync_selected(self, is_sync_selected):
         if hasattr(self, 'reupload_checkbox'):
             self.reupload_checkbox.setVisible(is_sync_selected and self.reupload_possible)
+        if hasattr(self, 'libraries_checkbox'):
+            self.libraries_checkbox.setVisible(not is_sync_selected and len(self.library_paths) > 0)
 
     def start(self):
-        if self.sync_selected_radio.isChecked() and self.reupload_checkbox.isChecked():
+        if self.sync_selected_radio.isChecked() and self.reupload_checkbox.isChecked() and not self.dry_run_checkbox.isChecked():
             reply = QMessageBox.question(
                 self,
                 'BookFusion Sync',
@@ -131,10 +166,7 @@ class SyncWidget(QWidget):
             if reply != QMessageBox.Yes:
                 return
 
-        self.worker = None
-        self.valid_book_ids = None
-        self.book_log_map = {}
-        self.book_progress_map = {}
+        self.reset_run()
 
         if self.sync_selected_radio.isChecked():
             book_ids = list(self.selected_book_ids)
@@ -146,22 +178,67 @@ class SyncWidget(QWidget):
         self.in_progress = True
         self.total = len(book_ids)
         self.update_progress(None)
-        self.start_btn.hide()
-        self.cancel_btn.show()
-        self.config_btn.setEnabled(False)
-        self.sync_all_radio.setEnabled(False)
-        self.sync_selected_radio.setEnabled(False)
+        self.show_running()
+
+        if self.is_plan_used():
+            self.logger.info('Start sync from dry run plan')
+            self.valid_book_ids = self.plan.book_ids()
+            self.start_sync()
+            return
 
         self.worker_thread = QThread(self)
 
-        self.worker = CheckWorker(self.db, self.logger, book_ids)
+        self.worker = CheckWorker(self.db, self.logger, book_ids, self.service.cached_limits())
         self.worker.finished.connect(self.finish_check)
         self.worker.finished.connect(self.worker_thread.quit)
-        self.worker.progress.connect(self.update_progress)
+        self.worker.progress.connect(self.update_check_progress)
         self.worker.limitsAvailable.connect(self.apply_limits)
         self.worker.resultsAvailable.connect(self.apply_results)
         self.worker.aborted.connect(self.abort)
+        if self.can_stream():
+            self.worker.booksFound.connect(self.stream_books)
         self.worker.moveToThread(self.worker_thread)
+        self.check_worker = self.worker
+
+        self.start_worker_thread('check')
+
+    def reset_run(self):
+        self.worker = None
+        self.check_worker = None
+        self.streaming = False
+        self.profilers = []
+        self.valid_book_ids = None
+        self.book_log_map = {}
+        self.book_progress_map = {}
+        self.duplicates_count = 0
+        self.duplicates_bytes = 0
+        self.failed_book_ids = set()
+
+    def show_running(self):
+        self.start_btn.hide()
+        self.cancel_btn.show()
+        self.config_btn.setEnabled(False)
+        self.sync_all_radio.setEnabled(False)
+        self.sync_selected_radio.setEnabled(False)
+        self.dry_run_checkbox.setEnabled(False)
+        self.use_plan_checkbox.setEnabled(False)
+        self.libraries_checkbox.setEnabled(False)
+
+    def create_profiler(self, tag):
+        if not prefs['profile']:
+            return None
+
+        # Kept until the next run as the thread may outlive this phase.
+        from calibre_plugins.bookfusion.profiler import RunProfiler
+        profiler = RunProfiler(path.dirname(self.logger.path), tag)
+        self.profilers.append(profiler)
+        return profiler
+
+    def start_worker_thread(self, tag):
+        # Connected before the worker so the whole phase is profiled.
+        profiler = self.create_profiler(tag)
+        if profiler is not None:
+            profiler.attach(self.worker_thread)
 
         self.worker_thread.started.connect(self.worker.start)
         self.worker_thread.start()
@@ -169,80 +246,282 @@ class SyncWidget(QWidget):
     def apply_limits(self, limits):
         self.logger.info('Limits: {}'.format(limits))
         self.limits = limits
+        self.service.remember_limits(limits)
 
     def apply_results(self, books_count, valid_ids):
         self.logger.info('Check results: books_count={}; valid_ids={}'.format(books_count, valid_ids))
         self.valid_book_ids = valid_ids
         self.books_count = books_count
 
+    def can_stream(self):
+        # Whether syncing may start while the check is still going on. A
+        # sharded sync splits the books between its processes up front.
+        return prefs['shards'] <= 1 and not self.is_plan_used()
+
+    def update_check_progress(self, progress):
+        # Once syncing has started, its progress is shown instead.
+        if not self.is_sync_phase():
+            self.update_progress(progress)
+
+    def stream_books(self, book_ids):
+        # The sync starts with the first books the check finds and is given
+        # the others as the check goes on. The check stops sending books at
+        # the account limit. Limits that come with a message may have to be
+        # accepted first, so then nothing is synced before the check is done
+        # and the message answered.
+        if not self.in_progress or self.limits['message']:
+            return
+
+        if self.is_sync_phase() and not self.streaming:
+            # Joined a sync that was running already, see join_run(); it may
+            # be over by now.
+            self.total += len(book_ids)
+            self.service.sync_books(book_ids)
+        elif self.is_sync_phase():
+            self.total += len(book_ids)
+            self.service.feed(book_ids)
+        else:
+            self.valid_book_ids = book_ids
+            self.start_sync(streaming=True)
+
+    def is_limit_exceeded(self):
+        is_filesize_exceeded = len(self.valid_book_ids) < self.books_count
+        is_total_books_exceeded = self.limits['total_books'] and self.books_count > self.limits['total_books']
+        return is_filesize_exceeded or is_total_books_exceeded
+
+    def accept_limits(self):
+        # Returns whether to sync the books within the limits.
+        if not self.is_limit_exceeded() or not self.limits['message']:
+            return True
+
+        msg_box = QMessageBox(self)
+        msg_box.setWindowTitle('BookFusion Sync')
+        msg_box.addButton(QMessageBox.No)
+        msg_box.addButton(QMessageBox.Yes)
+        msg_box.setText(self.limits['message'])
+        msg_box.setDefaultButton(QMessageBox.Yes)
+        return msg_box.exec_() == QMessageBox.Yes
+
     def finish_check(self):
-        if self.valid_book_ids:
-            is_filesize_exceeded = len(self.valid_book_ids) < self.books_count
-            is_total_books_exceeded = self.limits['total_books'] and self.books_count > self.limits['total_books']
-
-            if is_filesize_exceeded or is_total_books_exceeded:
-                if self.limits['message']:
-                    msg_box = QMessageBox(self)
-                    msg_box.setWindowTitle('BookFusion Sync')
-                    msg_box.addButton(QMessageBox.No)
-                    msg_box.addButton(QMessageBox.Yes)
-                    msg_box.setText(self.limits['message'])
-                    msg_box.setDefaultButton(QMessageBox.Yes)
-                    reply = msg_box.exec_()
-                    if reply == QMessageBox.Yes:
-                        self.start_sync()
-                    else:
-                        self.in_progress = False
-                        self.msg.setText('Canceled.')
-                        self.finish_sync()
-                else:
-                    self.start_sync()
-            else:
+        self.check_worker = None
+        if self.is_sync_phase() and not self.streaming:
+            # The books went to the sync joined meanwhile.
+            return
+        if self.streaming:
+            self.finish_streamed_check()
+        elif self.valid_book_ids:
+            if self.accept_limits():
                 self.start_sync()
+            else:
+                self.in_progress = False
+                self.msg.setText('Canceled.')
+                self.finish_sync()
         else:
             if self.in_progress:
                 self.in_progress = False
                 self.msg.setText('No supported books selected.')
             self.finish_sync()
 
-    def start_sync(self):
+    def finish_streamed_check(self):
+        # Only limits without a message are streamed, so there is nothing to
+        # accept.
+        self.streaming = False
+        self.service.close_intake()
+
+    def start_sync(self, streaming=False):
         self.log_btn.show()
         self.log.setRowCount(0)
         self.log.show()
 
-        self.worker_thread = QThread(self)
-
         book_ids = self.valid_book_ids
         if self.limits['total_books']:
             book_ids = book_ids[:self.limits['total_books']]
 
         self.total = len(book_ids)
 
-        self.worker = UploadManager(self.db, self.logger, book_ids, self.sync_selected_radio.isChecked() and self.reupload_checkbox.isChecked())
-        self.worker.finished.connect(self.finish_sync)
-        self.worker.finished.connect(self.worker_thread.quit)
-        self.worker.progress.connect(self.update_progress)
-        self.worker.uploadProgress.connect(self.update_upload_progress)
-        self.worker.started.connect(self.log_start)
-        self.worker.skipped.connect(self.log_skip)
-        self.worker.failed.connect(self.log_fail)
-        self.worker.uploaded.connect(self.log_upload)
-        self.worker.updated.connect(self.log_update)
-        self.worker.aborted.connect(self.abort)
-        self.worker.moveToThread(self.worker_thread)
+        # The service runs one sync at a time: one started in the background
+        # while this one was checked is joined instead.
+        if self.service.manager is not None:
+            self.join_run(book_ids)
+            return
 
-        self.worker_thread.started.connect(self.worker.start)
-        self.worker_thread.start()
+        if self.sync_selected_radio.isChecked():
+            prioritized_book_ids = ()
+        else:
+            prioritized_book_ids = self.selected_book_ids
+
+        self.dry_run = self.dry_run_checkbox.isChecked()
+        plan = self.plan if self.is_plan_used() else None
+        self.streaming = streaming
+
+        # Other libraries are only synced in full, real runs.
+        library_paths = ()
+        if self.sync_all_radio.isChecked() and self.libraries_checkbox.isChecked() and not self.dry_run and plan is None:
+            library_paths = self.library_paths
+
+        reupload = self.sync_selected_radio.isChecked() and self.reupload_checkbox.isChecked()
+
+        # Large real runs of this library alone can be split over several
+        # processes.
+        if prefs['shards'] > 1 and len(book_ids) > 1 and not self.dry_run and plan is None and not library_paths and \
+                not streaming:
+            self.worker = ShardedSync(
+                self.db, self.logger, book_ids, reupload, self.limits, prioritized_book_ids, prefs['shards']
+            )
+        else:
+            self.worker = UploadManager(
+                self.db, self.logger, book_ids, reupload,
+                self.limits, prioritized_book_ids, self.dry_run, plan, library_paths, streaming
+            )
+        self.connect_run(self.worker)
+
+        # The sync itself runs in the service, which goes on with it if the
+        # dialog is closed.
+        self.service.attach(self)
+        self.service.run(self.worker, self.total, self.create_profiler('sync'))
+
+    def run_connections(self, manager):
+        return [
+            (manager.finished, self.finish_sync),
+            (manager.progress, self.update_progress),
+            (manager.uploadProgress, self.update_upload_progress),
+            (manager.started, self.log_start),
+            (manager.skipped, self.log_skip),
+            (manager.failed, self.log_fail),
+            (manager.retryScheduled, self.log_retry),
+            (manager.stalled, self.log_stall),
+            (manager.duplicate, self.log_duplicate),
+            (manager.planned, self.log_plan),
+            (manager.planAvailable, self.apply_plan),
+            (manager.libraryFinished, self.log_library),
+            (manager.uploaded, self.log_upload),
+            (manager.updated, self.log_update),
+            (manager.aborted, self.abort)
+        ]
+
+    def connect_run(self, manager):
+        for signal, slot in self.run_connections(manager):
+            signal.connect(slot)
+
+    def attach_run(self, manager):
+        # Shows a sync already running in the service, from this point on.
+        self.logger.info('Attach to running sync')
+        self.reset_run()
+        self.worker = manager
+        self.in_progress = True
+        self.total = self.service.total
+        self.dry_run = getattr(manager, 'dry_run', False)
+        self.show_running()
+        self.log_btn.show()
+        self.log.show()
+        self.update_progress(None)
+
+        self.connect_run(manager)
+        self.service.attach(self)
+
+    def join_run(self, book_ids):
+        # A dry run is not mixed into a real one, so it stops here.
+        if self.dry_run_checkbox.isChecked():
+            self.in_progress = False
+            self.msg.setText('Another sync is running, try again once it is done.')
+            self.valid_book_ids = None
+            if self.check_worker is not None:
+                # Finishes through finish_check().
+                self.check_worker.cancel()
+            else:
+                self.finish_sync()
+            return
+
+        check_worker = self.check_worker
+        self.attach_run(self.service.manager)
+        self.check_worker = check_worker
+        self.enqueue(book_ids)
+
+    def wait_for_run(self):
+        # Shows the sync the service is checking books for, once it starts.
+        self.msg.setText('A sync is starting in the background.')
+        self.service.runStarted.connect(self.attach_started_run)
+
+    def attach_started_run(self, manager):
+        self.service.runStarted.disconnect(self.attach_started_run)
+        if not self.in_progress:
+            self.attach_run(manager)
+
+    def detach_run(self):
+        self.logger.info('Detach from sync, it goes on in the background')
+        for signal, slot in self.run_connections(self.worker):
+            signal.disconnect(slot)
+        self.service.detach(self)
+
+    def is_sync_phase(self):
+        return isinstance(self.worker, (UploadManager, ShardedSync))
+
+    def is_syncing(self):
+        return self.is_sync_phase() and self.service.manager is self.worker
+
+    def enqueue(self, book_ids):
+        # Adds books to the running sync, ahead of the books still queued.
+        self.total += len(book_ids)
+        self.service.enqueue(book_ids)
+
+    def is_plan_used(self):
+        return self.plan is not None and self.use_plan_checkbox.isChecked() and not self.dry_run_checkbox.isChecked()
+
+    def apply_plan(self, plan):
+        self.plan = plan
+        self.use_plan_checkbox.setChecked(True)
+        self.use_plan_checkbox.show()
+
+    def plan_message(self):
+        summary = self.plan.summary()
+        actions = summary['actions']
+        msg = 'Plan: {} to upload, {} to update, {} to skip'.format(
+            actions[SyncPlan.UPLOAD], actions[SyncPlan.UPDATE], actions[SyncPlan.SKIP]
+        )
+        if actions[SyncPlan.DUPLICATE] > 0:
+            msg += ', {} duplicates'.format(actions[SyncPlan.DUPLICATE])
+        msg += '; {:.1f} MB to send'.format(summary['bytes'] / 1048576.0)
+        if summary['estimated_seconds'] is not None:
+            msg += '; about {} min'.format(int(round(summary['estimated_seconds'] / 60.0)) or 1)
+        return msg + '. Saved to bookfusion_plan.json.'
 
     def finish_sync(self):
-        if self.in_progress:
-            self.msg.setText('Done.')
+        if self.in_progress and self.is_sync_phase() and self.dry_run and self.plan is not None:
+            self.msg.setText(self.plan_message())
+        elif self.in_progress:
+            msg = 'Done.'
+            if self.duplicates_count > 0:
+                msg += ' {} duplicate {} not uploaded ({:.1f} MB saved).'.format(
+                    self.duplicates_count,
+                    'file' if self.duplicates_count == 1 else 'files',
+                    self.duplicates_bytes / 1048576.0
+                )
+            cache_summary = self.worker.metrics.cache_summary() if self.is_sync_phase() and self.worker.metrics else None
+            if cache_summary:
+                msg += ' {}.'.format(cache_summary.capitalize())
+            if self.failed_book_ids and not self.dry_run:
+                msg += ' {} {} failed, use "Retry failed books" to sync {} again.'.format(
+                    len(self.failed_book_ids),
+                    'book' if len(self.failed_book_ids) == 1 else 'books',
+                    'it' if len(self.failed_book_ids) == 1 else 'them'
+                )
+            self.msg.setText(msg)
         self.cancel_btn.hide()
         self.cancel_btn.setEnabled(True)
         self.start_btn.show()
         self.config_btn.setEnabled(True)
         self.sync_all_radio.setEnabled(True)
         self.sync_selected_radio.setEnabled(len(self.selected_book_ids) > 0)
+        self.dry_run_checkbox.setEnabled(True)
+        self.use_plan_checkbox.setEnabled(True)
+        self.libraries_checkbox.setEnabled(True)
+        self.service.detach(self)
+
+        # A plan describes the library as it was when it was made, so it is
+        # only used for the run right after the dry run.
+        if self.is_sync_phase() and not self.dry_run and self.plan is not None:
+            self.plan = None
+            self.use_plan_checkbox.hide()
 
     def abort(self, error):
         self.in_progress = False
@@ -252,11 +531,20 @@ class SyncWidget(QWidget):
         self.in_progress = False
         self.msg.setText('Canceled.')
         self.cancel_btn.setEnabled(False)
-        self.worker.cancel()
+        # A check is canceled directly, as it does not go back to its event
+        # loop before it is done.
+        if self.is_sync_phase():
+            self.worker.cancelRequested.emit()
+        else:
+            self.worker.cancel()
+        if self.is_sync_phase() and self.check_worker is not None:
+            self.check_worker.cancel()
 
     def update_progress(self, progress):
         if self.in_progress:
-            if isinstance(self.worker, UploadManager):
+            if self.is_sync_phase() and self.dry_run:
+                msg = 'Planning...'
+            elif self.is_sync_phase():
                 msg = 'Synchronizing...'
             else:
                 msg = 'Preparing...'
@@ -279,49 +567,104 @@ class SyncWidget(QWidget):
     def log_start(self, book_id):
         self.update_log(book_id, None)
 
-    def log_fail(self, book_id, msg):
+    def log_fail(self, book_id, msg, category):
+        self.failed_book_ids.add(book_id)
         self.update_log(book_id, msg)
 
+    def log_retry(self, book_id, msg, delay):
+        self.update_log(book_id, '{}, retrying in {}s'.format(msg, delay))
+
+    def log_stall(self, book_id, seconds):
+        self.update_log(book_id, 'no progress for {}s'.format(seconds))
+
+    def log_duplicate(self, book_id, primary_id, size):
+        self.total -= 1
+        self.duplicates_count += 1
+        self.duplicates_bytes += size
+        title = self.db.get_proxy_metadata(primary_id).title
+        self.update_log(book_id, 'duplicate of "{}"'.format(title))
+
+    def log_plan(self, book_id, action):
+        self.update_log(book_id, 'will {}'.format(action) if action != SyncPlan.DUPLICATE else 'duplicate')
+
     def log_skip(self, book_id):
+        self.failed_book_ids.discard(book_id)
         self.update_log(book_id, 'skipped')
 
     def log_upload(self, book_id):
+        self.failed_book_ids.discard(book_id)
         self.update_log(book_id, 'uploaded')
 
     def log_update(self, book_id):
+        self.failed_book_ids.discard(book_id)
         self.update_log(book_id, 'updated')
 
+    def log_library(self, library_path, summary):
+        self.trim_log()
+        index = self.log.rowCount()
+        self.log.insertRow(index)
+
+        for column, text in enumerate(['Library: {}'.format(path.basename(library_path)), summary]):
+            item = QTableWidgetItem(text)
+            item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemNeverHasChildren)
+            self.log.setItem(index, column, item)
+
     def toggle_log(self, _):
         self.log.setVisible(not self.log.isVisible())
 
     def update_log(self, book_id, msg):
         if book_id in self.book_log_map:
-            index = self.book_log_map[book_id]
+            index = self.log.row(self.book_log_map[book_id])
         else:
+            self.trim_log()
             index = self.log.rowCount()
-            self.book_log_map[book_id] = index
 
             self.log.insertRow(index)
 
             title = self.db.get_proxy_metadata(book_id).title
             title_item = QTableWidgetItem(title)
             title_item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemNeverHasChildren)
+            title_item.setData(Qt.UserRole, book_id)
             self.log.setItem(index, 0, title_item)
+            self.book_log_map[book_id] = title_item
 
+        # A retried book is started again after it already got a message.
+        if msg is None and not book_id in self.book_progress_map:
             progress = QProgressBar()
             progress.setMaximum(0)
             self.log.setCellWidget(index, 1, progress)
             self.book_progress_map[book_id] = progress
 
         if not msg is None:
-            del(self.book_progress_map[book_id])
+            self.book_progress_map.pop(book_id, None)
             self.log.setCellWidget(index, 1, None)
 
             msg_item = QTableWidgetItem(msg)
             msg_item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemNeverHasChildren)
             self.log.setItem(index, 1, msg_item)
 
+    def trim_log(self):
+        # Makes room for a new row by dropping the oldest rows of books that
+        # are done, so a sync of a large library does not keep a row for every
+        # book.
+        row = 0
+        while self.log.rowCount() >= self.MAX_LOG_ROWS and row < self.log.rowCount():
+            if self.log.cellWidget(row, 1) is not None:
+                row += 1
+                continue
+
+            book_id = self.log.item(row, 0).data(Qt.UserRole)
+            if book_id is not None:
+                self.book_log_map.pop(book_id, None)
+            self.log.removeRow(row)
+
     def maybe_cancel(self):
+        # A sync still fed by the check of this dialog cannot go on without
+        # it, so it is canceled like a check.
+        if self.is_syncing() and not self.streaming:
+            self.detach_run()
+            return True
+
         if self.worker_thread and self.worker_thread.isRunning():
             reply = QMessageBox.question(
                 self,
@@ -0,0 +1,129 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from datetime import datetime
+import json
+
+from calibre_plugins.bookfusion.config import prefs
+
+
+# Outcome of a dry run: what a real sync would do with every book, without any
+# upload or metadata write having happened. A plan can be exported as JSON and
+# passed to UploadManager so the real run does not check the books again.
+class SyncPlan:
+    UPLOAD = 'upload'
+    UPDATE = 'update'
+    SKIP = 'skip'
+    DUPLICATE = 'duplicate'
+
+    ACTIONS = [UPLOAD, UPDATE, SKIP, DUPLICATE]
+
+    # Requests a real run given this plan sends per action, excluding the file
+    # transfer. The check request is not repeated for planned books.
+    REQUESTS = {UPLOAD: 2, UPDATE: 1, SKIP: 0, DUPLICATE: 0}
+
+    def __init__(self, reupload):
+        self.reupload = reupload
+        self.created_at = datetime.now().isoformat()
+        self.books = {}
+
+    def add(self, book_id, action, fmt, size, transfer_size=0, bookfusion_id=None, metadata_digest=None, digest=None):
+        self.books[book_id] = {
+            'action': action,
+            'format': fmt,
+            'size': size,
+            'transfer_size': transfer_size,
+            'bookfusion_id': bookfusion_id,
+            'calibre_metadata_digest': metadata_digest,
+            'digest': digest
+        }
+
+    def get(self, book_id):
+        return self.books.get(book_id)
+
+    def book_ids(self):
+        return [book_id for book_id, entry in self.books.items() if entry['action'] != self.DUPLICATE]
+
+    def summary(self):
+        actions = dict((action, 0) for action in self.ACTIONS)
+        formats = {}
+        total_bytes = 0
+        requests = 0
+
+        for entry in self.books.values():
+            actions[entry['action']] += 1
+            total_bytes += entry['transfer_size']
+            requests += self.REQUESTS[entry['action']]
+
+            if entry['transfer_size'] > 0:
+                fmt = formats.setdefault(entry['format'], {'books': 0, 'bytes': 0})
+                fmt['books'] += 1
+                fmt['bytes'] += entry['transfer_size']
+
+        return {
+            'actions': actions,
+            'bytes': total_bytes,
+            'formats': formats,
+            'estimated_seconds': Throughput.estimate(total_bytes, requests)
+        }
+
+    def to_json(self, library_path=None):
+        return json.dumps({
+            'library_path': library_path,
+            'created_at': self.created_at,
+            'reupload': self.reupload,
+            'summary': self.summary(),
+            'books': self.books
+        }, indent=2, sort_keys=True)
+
+    def save(self, file_path, library_path=None):
+        with open(file_path, 'w') as f:
+            f.write(self.to_json(library_path))
+
+
+# Transfer rate and request latency measured during real runs, used to
+# estimate how long a plan will take.
+class Throughput:
+    def __init__(self):
+        self.transfer_bytes = 0
+        self.transfer_seconds = 0.0
+        self.requests = 0
+        self.request_seconds = 0.0
+
+    def record_transfer(self, size, seconds):
+        self.transfer_bytes += size
+        self.transfer_seconds += seconds
+
+    def record_request(self, seconds):
+        self.requests += 1
+        self.request_seconds += seconds
+
+    def to_state(self):
+        return [self.transfer_bytes, self.transfer_seconds, self.requests, self.request_seconds]
+
+    def merge(self, state):
+        transfer_bytes, transfer_seconds, requests, request_seconds = state
+        self.record_transfer(transfer_bytes, transfer_seconds)
+        self.requests += requests
+        self.request_seconds += request_seconds
+
+    def save(self):
+        # Keeps the previous measurement for whichever part this run did not
+        # exercise, e.g. a run that only skipped books.
+        throughput = dict(prefs['throughput'])
+        if self.transfer_bytes > 0 and self.transfer_seconds > 0:
+            throughput['bytes_per_second'] = self.transfer_bytes / self.transfer_seconds
+        if self.requests > 0:
+            throughput['seconds_per_request'] = self.request_seconds / self.requests
+        prefs['throughput'] = throughput
+
+    @staticmethod
+    def estimate(total_bytes, requests):
+        throughput = prefs['throughput']
+        if not throughput.get('bytes_per_second') or not throughput.get('seconds_per_request'):
+            return None
+
+        # Transfers and API requests run in separate stages, each with its own
+        # concurrency.
+        return total_bytes / throughput['bytes_per_second'] / prefs['threads'] + \
+            requests * throughput['seconds_per_request'] / prefs['check_threads']
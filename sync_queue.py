@@ -0,0 +1,52 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from heapq import heappush, heappop
+
+
+# Priority queue of book ids waiting to be synced.
+#
+# Books are popped by priority, then by order key (newest book id first unless
+# given), then by insertion order, so the order is fully deterministic. Pushing
+# a book that is already queued only moves it if the new priority is higher.
+class SyncQueue:
+    SELECTED = 0
+    RECENT = 1
+    UPDATE = 2
+    UPLOAD = 3
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, book_id):
+        return book_id in self.entries
+
+    def push(self, book_id, priority, order=None):
+        if order is None:
+            order = -book_id
+
+        entry = self.entries.get(book_id)
+        if entry is not None and entry <= (priority, order):
+            return
+
+        key = (priority, order)
+        self.entries[book_id] = key
+        heappush(self.heap, (priority, order, self.seq, book_id))
+        self.seq += 1
+
+    def pop(self):
+        # Entries replaced by a later push are skipped here.
+        while self.heap:
+            priority, order, _, book_id = heappop(self.heap)
+            if self.entries.get(book_id) == (priority, order):
+                del self.entries[book_id]
+                return book_id
+        raise IndexError('pop from an empty SyncQueue')
+
+    def remove(self, book_id):
+        self.entries.pop(book_id, None)
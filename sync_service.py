@@ -0,0 +1,319 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QObject, QThread, pyqtSignal
+from time import monotonic
+from os import path
+
+from calibre_plugins.bookfusion.config import prefs
+from calibre_plugins.bookfusion.logger import Logger
+from calibre_plugins.bookfusion.check_worker import CheckWorker
+from calibre_plugins.bookfusion.sharded_sync import ShardedSync
+from calibre_plugins.bookfusion.sync_session import SyncSession
+from calibre_plugins.bookfusion.upload_manager import UploadManager
+
+
+# Lives in the service thread and starts the runs handed to it there, each
+# with the session kept from the previous run if the settings allow it.
+class SyncHost(QObject):
+    runRequested = pyqtSignal(object, object)
+
+    def __init__(self):
+        QObject.__init__(self)
+
+        self.session = None
+        self.runRequested.connect(self.start_run)
+
+    def start_run(self, manager, profiler):
+        if isinstance(manager, UploadManager):
+            if self.session is not None and not self.session.is_current():
+                self.session.close()
+                self.session = None
+            if self.session is None:
+                self.session = SyncSession()
+            manager.session = self.session
+            manager.finished.connect(self.session.save)
+        elif isinstance(manager, ShardedSync) and self.session is not None and self.session.is_current():
+            # So that the session does not save its cache over the one the
+            # shards added to.
+            manager.isbn_cache = self.session.isbn_cache
+
+        if profiler is not None:
+            manager.finished.connect(profiler.stop)
+            profiler.start()
+
+        manager.start()
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+# Runs syncs in a thread kept for the whole calibre session, so the sync goes
+# on when the dialog is closed and back-to-back syncs reuse the connections,
+# caches and limits of the previous one. Owned by the interface action.
+#
+# The dialog hands runs to the service and attaches to the one in progress to
+# show it. There is only ever one run: books for another one while it is going
+# on are added to it instead. Other plugins can use sync_books(), is_running() and cancel(); a
+# sync started that way goes without asking anything, books past the account
+# limit are left out.
+class SyncService(QObject):
+    runStarted = pyqtSignal(object)
+    runFinished = pyqtSignal(str)
+
+    # Limits fetched by a check are reused for this many seconds.
+    LIMITS_TTL = 600
+
+    def __init__(self, gui):
+        QObject.__init__(self, gui)
+
+        self.gui = gui
+        self.thread = None
+        self.host = None
+        self.manager = None
+        self.check_thread = None
+        self.check_worker = None
+        self.checking_book_ids = []
+        self.streaming = False
+        self.forwarding = False
+        self.viewers = set()
+
+        self.limits = None
+        self.limits_at = None
+        self.limits_key = None
+
+        self.total = 0
+        self.error = None
+        self.counts = {}
+
+    def start_thread(self):
+        if self.thread is not None:
+            return
+
+        self.thread = QThread(self)
+        self.host = SyncHost()
+        self.host.moveToThread(self.thread)
+        self.thread.start()
+
+    def shutdown(self):
+        self.cancel()
+        if self.thread is not None:
+            self.thread.quit()
+            self.thread.wait()
+            # The thread may have stopped before the cancel reached the run.
+            if self.manager is not None:
+                self.manager.cancel()
+            self.host.close()
+        if self.check_thread is not None:
+            self.check_thread.quit()
+            self.check_thread.wait()
+
+    def is_running(self):
+        return self.manager is not None or self.check_worker is not None
+
+    def cached_limits(self):
+        if self.limits is None or self.limits_key != prefs['api_key']:
+            return None
+        if monotonic() - self.limits_at > self.LIMITS_TTL:
+            return None
+        return self.limits
+
+    def remember_limits(self, limits):
+        self.limits = limits
+        self.limits_at = monotonic()
+        self.limits_key = prefs['api_key']
+
+    def attach(self, viewer):
+        self.viewers.add(viewer)
+
+    def detach(self, viewer):
+        self.viewers.discard(viewer)
+
+    def run(self, manager, total, profiler=None):
+        # Takes over manager, an UploadManager or ShardedSync that has not
+        # been started yet, and starts it in the service thread. Returns False,
+        # leaving manager alone, if another run is going on.
+        if self.manager is not None:
+            return False
+
+        self.start_thread()
+
+        self.manager = manager
+        self.total = total
+        self.error = None
+        self.counts = {'uploaded': 0, 'updated': 0, 'skipped': 0, 'failed': 0}
+
+        manager.uploaded.connect(lambda book_id: self.count('uploaded'))
+        manager.updated.connect(lambda book_id: self.count('updated'))
+        manager.skipped.connect(lambda book_id: self.count('skipped'))
+        manager.failed.connect(lambda book_id, msg, category: self.count('failed'))
+        manager.planAvailable.connect(self.save_plan)
+        manager.aborted.connect(self.abort)
+        manager.finished.connect(lambda: self.finish_run(manager))
+
+        manager.moveToThread(self.thread)
+        if profiler is not None:
+            profiler.moveToThread(self.thread)
+
+        self.runStarted.emit(manager)
+        self.host.runRequested.emit(manager, profiler)
+        return True
+
+    def enqueue(self, book_ids):
+        self.total += len(book_ids)
+        self.manager.enqueueRequested.emit(list(book_ids))
+
+    def feed(self, book_ids):
+        # Books found by the check of a streaming run, synced in their usual
+        # order.
+        if self.manager is None:
+            return
+        self.total += len(book_ids)
+        self.manager.intakeRequested.emit(list(book_ids))
+
+    def close_intake(self):
+        if self.manager is not None:
+            self.manager.intakeClosed.emit()
+
+    def cancel(self):
+        if self.check_worker is not None:
+            self.check_worker.cancel()
+        if self.manager is not None:
+            self.manager.cancelRequested.emit()
+
+    def sync_books(self, book_ids, reupload=False):
+        # Syncs books of the current library in the background. Books sent
+        # while a sync is running are added to it, ahead of its queue. Returns
+        # False if the plugin is not configured yet.
+        if not prefs['api_key']:
+            return False
+
+        book_ids = list(book_ids)
+        if self.manager is not None:
+            self.enqueue(book_ids)
+        elif self.check_worker is not None:
+            # Added to the sync once the check is done.
+            self.checking_book_ids.extend(book_ids)
+        else:
+            self.check(book_ids, reupload)
+        return True
+
+    def check(self, book_ids, reupload):
+        db = self.gui.current_db
+        self.db = db.new_api
+        self.logger = Logger(path.join(db.library_path, 'bookfusion_sync.log'))
+        self.logger.info('Start background sync: book_ids={}'.format(book_ids))
+        self.reupload = reupload
+
+        self.check_thread = QThread(self)
+        self.check_worker = CheckWorker(self.db, self.logger, book_ids, self.cached_limits())
+        self.check_worker.finished.connect(self.check_thread.quit)
+        self.check_worker.finished.connect(self.finish_check)
+        self.check_worker.limitsAvailable.connect(self.remember_limits)
+        self.check_worker.booksFound.connect(self.stream_books)
+        self.check_worker.aborted.connect(self.abort)
+        self.check_worker.moveToThread(self.check_thread)
+
+        self.check_thread.started.connect(self.check_worker.start)
+        self.check_thread.start()
+
+    def stream_books(self, book_ids):
+        # The sync starts with the first books the check finds and is given
+        # the others as the check goes on. The check stops sending books at
+        # the account limit; there is nobody to ask about exceeding it.
+        if self.check_worker is None or self.check_worker.canceled:
+            return
+
+        if self.streaming:
+            self.feed(book_ids)
+            return
+
+        # A run started from the dialog while the check was going on gets the
+        # books instead.
+        if self.manager is not None:
+            self.forwarding = True
+            self.enqueue(book_ids)
+            return
+
+        self.streaming = True
+        manager = UploadManager(self.db, self.logger, book_ids, self.reupload, self.limits, streaming=True)
+        self.run(manager, len(book_ids))
+
+    def finish_check(self):
+        worker, self.check_worker = self.check_worker, None
+        book_ids_added, self.checking_book_ids = self.checking_book_ids, []
+        forwarding, self.forwarding = self.forwarding, False
+
+        if self.streaming:
+            self.streaming = False
+            self.close_intake()
+            return
+
+        if forwarding:
+            if book_ids_added:
+                self.sync_books(book_ids_added, self.reupload)
+            return
+
+        if worker.canceled or self.error or not worker.valid_ids:
+            self.notify(self.error or ('Canceled.' if worker.canceled else 'No supported books to sync.'))
+            self.error = None
+            return
+
+        # There is nobody to ask about exceeding the account limits, so books
+        # past the limit are left out, as when the prompt is accepted.
+        book_ids = worker.valid_ids
+        if worker.limits['total_books']:
+            book_ids = book_ids[:worker.limits['total_books']]
+
+        if self.manager is not None:
+            self.enqueue(book_ids + book_ids_added)
+            return
+
+        manager = UploadManager(self.db, self.logger, book_ids, self.reupload, worker.limits)
+        self.run(manager, len(book_ids))
+        if book_ids_added:
+            self.enqueue(book_ids_added)
+
+    def count(self, key):
+        self.counts[key] += 1
+
+    def save_plan(self, plan):
+        plan_path = path.join(path.dirname(self.manager.logger.path), 'bookfusion_plan.json')
+        plan.save(plan_path, path.dirname(plan_path))
+        self.manager.logger.info('Dry run plan: {}'.format(plan.summary()))
+
+    def abort(self, error):
+        # A sync aborts by canceling itself first, so this may come after the
+        # run has finished already.
+        if self.manager is None and self.check_worker is None:
+            self.notify(error)
+        else:
+            self.error = error
+
+    def finish_run(self, manager):
+        # Only the first finished of the current run counts.
+        if manager is not self.manager:
+            return
+        self.manager = None
+
+        if self.error:
+            summary = self.error
+        elif manager.canceled:
+            summary = 'Canceled.'
+        else:
+            summary = '{uploaded} uploaded, {updated} updated, {skipped} skipped, {failed} failed'.format(**self.counts)
+            cache_summary = manager.metrics.cache_summary() if manager.metrics else None
+            if cache_summary:
+                summary += '; {}'.format(cache_summary)
+        manager.logger.info('Finish sync: {}'.format(summary))
+        self.error = None
+
+        self.runFinished.emit(summary)
+        self.notify(summary)
+
+    def notify(self, summary):
+        # Only syncs nobody is watching are reported in the status bar.
+        if not self.viewers:
+            self.gui.status_bar.show_message('BookFusion sync: {}'.format(summary), 10000)
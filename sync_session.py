@@ -0,0 +1,50 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QNetworkAccessManager
+
+from calibre_plugins.bookfusion.config import prefs
+from calibre_plugins.bookfusion.bandwidth_limiter import BandwidthLimiter
+from calibre_plugins.bookfusion.isbn_cache import IsbnCache
+from calibre_plugins.bookfusion.sync_stages import SyncStages
+from calibre_plugins.bookfusion.worker_budget import WorkerBudget
+
+
+# What syncs share beyond a single book: the network access manager (and its
+# open connections), bandwidth limiter, worker budget, stages and ISBN cache.
+# An UploadManager creates a session of its own, unless the sync service lends
+# it the one it keeps between runs. Must be created in the thread the syncs
+# run in.
+class SyncSession:
+    def __init__(self, parent=None, bandwidth_shares=1):
+        self.key = self.settings_key()
+
+        self.network = QNetworkAccessManager(parent)
+        self.limiter = BandwidthLimiter(parent, bandwidth_shares)
+        self.budget = WorkerBudget(SyncStages.worker_count())
+        self.stages = SyncStages(parent)
+        self.isbn_cache = IsbnCache(prefs['api_key'])
+
+    @staticmethod
+    def settings_key():
+        return (
+            prefs['api_key'], prefs['threads'], prefs['check_threads'], prefs['hash_threads'], prefs['disk_readers']
+        )
+
+    def is_current(self):
+        # A session made with other settings is not reused.
+        return self.key == self.settings_key()
+
+    def lend(self, manager):
+        manager.network = self.network
+        manager.limiter = self.limiter
+        manager.budget = self.budget
+        manager.stages = self.stages
+        manager.isbn_cache = self.isbn_cache
+
+    def save(self):
+        self.isbn_cache.save()
+
+    def close(self):
+        self.stages.shutdown()
+        self.isbn_cache.save()
@@ -0,0 +1,109 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QObject, QTimer, pyqtSignal
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+from calibre_plugins.bookfusion.config import prefs
+from calibre_plugins.bookfusion.hashing_file import file_digest
+
+
+# Limits how many workers are in one stage of the sync at once. Workers wait
+# for a slot in the order they asked for one.
+class StageGate:
+    def __init__(self, name, slots):
+        self.name = name
+        self.free = slots
+        self.waiting = deque()
+
+    def acquire(self, callback):
+        # Calls callback once a slot has been taken, right away if one is free.
+        if self.free > 0:
+            self.free -= 1
+            callback()
+        else:
+            self.waiting.append(callback)
+
+    def release(self):
+        if self.waiting:
+            callback = self.waiting.popleft()
+            QTimer.singleShot(0, callback)
+        else:
+            self.free += 1
+
+
+# Computes file digests in a small thread pool, so hashing a large file does not
+# hold up the requests of the other workers. Callbacks are called in the thread
+# the pool was created in, with None if the file could not be read. Other work
+# reading book files, such as deltas, is run there with submit_call().
+class HashPool(QObject):
+    digested = pyqtSignal(int, str)
+    computed = pyqtSignal(int, object)
+
+    def __init__(self, threads, parent=None):
+        QObject.__init__(self, parent)
+
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.callbacks = {}
+        self.seq = 0
+        self.digested.connect(self.deliver)
+        self.computed.connect(self.deliver)
+
+    def submit(self, file_path, callback):
+        self.seq += 1
+        self.callbacks[self.seq] = callback
+        self.pool.submit(self.run, self.seq, file_path)
+
+    def run(self, key, file_path):
+        # Runs in the pool.
+        try:
+            digest = file_digest(file_path)
+        except OSError:
+            digest = ''
+        self.digested.emit(key, digest)
+
+    def submit_call(self, fn, callback):
+        self.seq += 1
+        self.callbacks[self.seq] = callback
+        self.pool.submit(self.run_call, self.seq, fn)
+
+    def run_call(self, key, fn):
+        # Runs in the pool.
+        try:
+            result = fn()
+        except OSError:
+            result = None
+        self.computed.emit(key, result)
+
+    def deliver(self, key, result):
+        callback = self.callbacks.pop(key)
+        callback(result or None)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+# The stages a book goes through, each with its own concurrency. API requests
+# (checks, upload init and finalize, metadata updates) are latency bound, file
+# transfers are bandwidth bound and hashing is bound by the disk, so a worker
+# busy with a long upload no longer holds up the checks of other books. If a
+# number of disk readers is set, hashing and transfers of book files also
+# share that many slots, as seeks between files are what slows down hard
+# disks and network shares.
+# Identifier writes stay on the sync thread, as calibre's database is not
+# shared across threads.
+class SyncStages:
+    def __init__(self, parent=None):
+        self.api = StageGate('api', prefs['check_threads'])
+        self.transfer = StageGate('transfer', prefs['threads'])
+        self.hashing = HashPool(prefs['hash_threads'], parent)
+        self.disk = StageGate('disk', prefs['disk_readers']) if prefs['disk_readers'] else None
+
+    @staticmethod
+    def worker_count():
+        # Enough books in flight to keep every API and transfer slot busy.
+        return prefs['threads'] + prefs['check_threads']
+
+    def shutdown(self):
+        self.hashing.shutdown()
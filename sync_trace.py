@@ -0,0 +1,79 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from os import path
+from time import monotonic
+import json
+
+
+# Timeline of one sync run: where each book spent its time, per worker. Saved
+# to bookfusion_trace.json in the library folder in the Chrome trace event
+# format, which chrome://tracing and Perfetto open. Each worker is a thread of
+# the trace; the manager's own work is on thread 0.
+class SyncTrace:
+    FILENAME = 'bookfusion_trace.json'
+    MANAGER = 0
+
+    def __init__(self, library_path, pid=0):
+        self.file_path = path.join(library_path, self.FILENAME)
+        self.pid = pid
+        self.origin = monotonic()
+        self.events = []
+        self.threads = []
+        self.name_thread(self.MANAGER, 'manager')
+
+    @staticmethod
+    def worker_tid(index):
+        return index + 1
+
+    def name_worker(self, index):
+        self.name_thread(self.worker_tid(index), 'worker-{}'.format(index))
+
+    def name_thread(self, tid, name):
+        self.threads.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}})
+
+    def span(self, tid, name, started, finished=None, **args):
+        # started and finished are monotonic() times; finished defaults to now.
+        if finished is None:
+            finished = monotonic()
+        self.events.append({
+            'name': name,
+            'ph': 'X',
+            'pid': self.pid,
+            'tid': tid,
+            'ts': round((started - self.origin) * 1000000),
+            'dur': round((finished - started) * 1000000),
+            'args': args
+        })
+
+    def async_span(self, name, key, started, finished=None, **args):
+        # For spans that overlap others on the same thread, e.g. books waiting
+        # in the queue; each is shown on a track of its own.
+        if finished is None:
+            finished = monotonic()
+        for phase, time in (('b', started), ('e', finished)):
+            self.events.append({
+                'name': name,
+                'cat': name,
+                'ph': phase,
+                'id': key,
+                'pid': self.pid,
+                'tid': self.MANAGER,
+                'ts': round((time - self.origin) * 1000000),
+                'args': args if phase == 'b' else {}
+            })
+
+    def to_state(self):
+        # For merging the traces of several processes.
+        return {'origin': self.origin, 'events': self.events, 'threads': self.threads}
+
+    def merge(self, state):
+        # monotonic() is system wide, so only the origins differ.
+        shift = round((state['origin'] - self.origin) * 1000000)
+        for event in state['events']:
+            self.events.append(dict(event, ts=event['ts'] + shift))
+        self.threads.extend(state['threads'])
+
+    def save(self):
+        with open(self.file_path, 'w') as f:
+            f.write(json.dumps({'traceEvents': self.threads + self.events, 'displayTimeUnit': 'ms'}))
@@ -0,0 +1,295 @@
+from hashlib import sha256
+from io import BytesIO
+from os import path, remove
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import json
+import random
+import struct
+import sys
+import tempfile
+import unittest
+import uuid
+import zipfile
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'tools'))
+
+import delta_upload  # noqa: E402
+from stub_api import StubApi, book_digest  # noqa: E402
+
+
+BLOCK_SIZE = 4096
+
+
+def signature(data):
+    # What the server sends for its version of a file.
+    blocks = []
+    for offset in range(0, len(data) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        block = data[offset:offset + BLOCK_SIZE]
+        a, b = delta_upload.block_checksum(block)
+        blocks.append([a | (b << 16), sha256(block).hexdigest()[:16]])
+    return {'block_size': BLOCK_SIZE, 'blocks': blocks}
+
+
+def apply_delta(old, delta):
+    # What the server does with the delta.
+    out = bytearray()
+    pos = 0
+    while pos < len(delta):
+        kind = delta[pos:pos + 1]
+        if kind == delta_upload.COPY:
+            start, count = struct.unpack('>II', delta[pos + 1:pos + 9])
+            out += old[start * BLOCK_SIZE:(start + count) * BLOCK_SIZE]
+            pos += 9
+        elif kind == delta_upload.DATA:
+            length, = struct.unpack('>I', delta[pos + 1:pos + 5])
+            out += delta[pos + 5:pos + 5 + length]
+            pos += 5 + length
+        else:
+            raise ValueError('Unknown record: {!r}'.format(kind))
+    return bytes(out)
+
+
+OPF = '''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="uuid_id" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:title>{title}</dc:title>
+    <dc:creator opf:role="aut" opf:file-as="Author, Some">Some Author</dc:creator>
+    <dc:identifier id="uuid_id" opf:scheme="uuid">0d5e3a4c-4b8e-4a57-9a7e-2b7f3c1e9d10</dc:identifier>
+    <dc:language>en</dc:language>
+{subjects}    <meta name="calibre:timestamp" content="{timestamp}"/>
+  </metadata>
+  <manifest>
+{items}  </manifest>
+  <spine toc="ncx">
+{itemrefs}  </spine>
+</package>
+'''
+
+CONTAINER = '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>
+'''
+
+WORDS = 'the of and to in that was he it his her with as had for on but not at she you by be'.split()
+
+
+def make_epub(rand, chapters=12, images=3):
+    # An EPUB laid out as calibre writes them: mimetype first, then the
+    # container, the OPF and the content.
+    entries = []
+    for index in range(chapters):
+        words = ' '.join(rand.choice(WORDS + ['word{}'.format(rand.randrange(5000))]) for _ in range(6000))
+        entries.append(('text/chapter{}.xhtml'.format(index), '<html><body><p>{}</p></body></html>'.format(words)
+                        .encode('utf-8'), zipfile.ZIP_DEFLATED))
+    for index in range(images):
+        entries.append(('images/image{}.jpg'.format(index), bytes(rand.getrandbits(8) for _ in range(40000)),
+                        zipfile.ZIP_STORED))
+    items = ''.join('    <item id="item{}" href="{}" media-type="application/xhtml+xml"/>\n'.format(index, name)
+                    for index, (name, data, compression) in enumerate(entries))
+    itemrefs = ''.join('    <itemref idref="item{}"/>\n'.format(index) for index in range(chapters))
+    return entries, items, itemrefs
+
+
+def write_epub(entries, items, itemrefs, title, subjects, timestamp):
+    # Rewrites the whole zip, as calibre does when it sets the metadata of a
+    # book file: every entry after the OPF moves, and so does the central
+    # directory.
+    opf = OPF.format(
+        title=title, timestamp=timestamp, items=items, itemrefs=itemrefs,
+        subjects=''.join('    <dc:subject>{}</dc:subject>\n'.format(subject) for subject in subjects)
+    )
+    out = BytesIO()
+    with zipfile.ZipFile(out, 'w') as epub:
+        epub.writestr(zipfile.ZipInfo('mimetype', (2026, 1, 1, 0, 0, 0)), 'application/epub+zip')
+        for name, data, compression in [('META-INF/container.xml', CONTAINER.encode('utf-8'), zipfile.ZIP_DEFLATED),
+                                        ('content.opf', opf.encode('utf-8'), zipfile.ZIP_DEFLATED)] + entries:
+            epub.writestr(zipfile.ZipInfo(name, (2026, 1, 1, 0, 0, 0)), data, compression)
+    return out.getvalue()
+
+
+class FileDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(1)
+        self.paths = []
+
+    def tearDown(self):
+        for file_path in self.paths:
+            remove(file_path)
+
+    def random_bytes(self, size):
+        return bytes(self.random.getrandbits(8) for _ in range(size))
+
+    def write(self, data):
+        fd, file_path = tempfile.mkstemp(prefix='bookfusion_test_')
+        with open(fd, 'wb') as f:
+            f.write(data)
+        self.paths.append(file_path)
+        return file_path
+
+    def delta(self, old, new, max_ratio=0.5):
+        delta_path = delta_upload.file_delta(self.write(new), signature(old), max_ratio)
+        if delta_path is None:
+            return None
+        self.paths.append(delta_path)
+        with open(delta_path, 'rb') as f:
+            return f.read()
+
+    def test_round_trip(self):
+        old = self.random_bytes(300000)
+        new = old[:1000] + b'rewritten metadata' + old[1010:150000] + old[150100:] + b'tail'
+
+        delta = self.delta(old, new)
+
+        self.assertIsNotNone(delta)
+        self.assertEqual(sha256(apply_delta(old, delta)).digest(), sha256(new).digest())
+        self.assertLess(len(delta), len(new) // 20)
+
+    def test_unchanged(self):
+        old = self.random_bytes(BLOCK_SIZE * 25)
+
+        delta = self.delta(old, old)
+
+        self.assertEqual(apply_delta(old, delta), old)
+        self.assertLess(len(delta), 100)
+
+    def test_too_large(self):
+        self.assertIsNone(self.delta(self.random_bytes(100000), self.random_bytes(100000)))
+
+    def test_stops_at_max_size(self):
+        # Unmatched data is given up on once it passes max_size, not at the
+        # end of the data.
+        old = self.random_bytes(BLOCK_SIZE * 4)
+        new = self.random_bytes(BLOCK_SIZE * 4) + old
+
+        class Data(bytes):
+            read_up_to = 0
+
+            def __getitem__(self, key):
+                index = key.stop if isinstance(key, slice) else key
+                Data.read_up_to = max(Data.read_up_to, index or 0)
+                return bytes.__getitem__(self, key)
+
+        writer = delta_upload.DeltaWriter(None, BLOCK_SIZE)
+        with self.assertRaises(delta_upload.DeltaTooLarge):
+            delta_upload.write_delta(Data(new), signature(old), writer)
+        self.assertLess(Data.read_up_to, BLOCK_SIZE * 3)
+
+    def test_epub_metadata_rewrite(self):
+        entries, items, itemrefs = make_epub(self.random)
+        old = write_epub(entries, items, itemrefs, 'A Book', ['Fiction'], '2026-01-01T00:00:00+00:00')
+        new = write_epub(
+            entries, items, itemrefs, 'A Book, Revised Edition', ['Fiction', 'Classics'], '2026-03-14T09:26:53+00:00'
+        )
+
+        delta = self.delta(old, new)
+
+        self.assertIsNotNone(delta)
+        self.assertEqual(sha256(apply_delta(old, delta)).digest(), sha256(new).digest())
+        # The OPF and the central directory change, and the blocks around
+        # them; everything else is copied.
+        self.assertNotEqual(len(old), len(new))
+        self.assertLess(len(delta), 4 * BLOCK_SIZE)
+        self.assertLess(len(delta), len(new) // 25)
+
+    def test_max_file_size(self):
+        old = self.random_bytes(BLOCK_SIZE * 4)
+        max_file_size = delta_upload.MAX_FILE_SIZE
+        delta_upload.MAX_FILE_SIZE = len(old) - 1
+        try:
+            self.assertIsNone(self.delta(old, old))
+        finally:
+            delta_upload.MAX_FILE_SIZE = max_file_size
+
+
+# The delta of a file against the signature of the stand-in server, applied
+# by it, as the worker sends it with PUT /uploads/<id>/delta.
+class StubDeltaTest(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(2)
+        entries, items, itemrefs = make_epub(rand)
+        self.old = write_epub(entries, items, itemrefs, 'A Book', ['Fiction'], '2026-01-01T00:00:00+00:00')
+        self.new = write_epub(entries, items, itemrefs, 'A Book', ['Fiction', 'Read'], '2026-02-01T00:00:00+00:00')
+
+        self.stub = StubApi({'delta_upload': True})
+        self.stub.keep_files = True
+        self.stub.start()
+        self.bookfusion_id = self.stub.add_book(book_digest(self.old), data=self.old)
+        self.paths = []
+
+    def tearDown(self):
+        self.stub.stop()
+        for file_path in self.paths:
+            remove(file_path)
+
+    def request(self, method, route, fields=None, files=None):
+        boundary = uuid.uuid4().hex
+        body = b''
+        for name, value in (fields or {}).items():
+            body += '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+                boundary, name, value
+            ).encode('utf-8')
+        for name, data in (files or {}).items():
+            body += '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n\r\n'.format(
+                boundary, name, name
+            ).encode('utf-8') + data + b'\r\n'
+        body += '--{}--\r\n'.format(boundary).encode('utf-8')
+        req = Request(self.stub.url + route, body if fields or files else None, method=method,
+                      headers={'Content-Type': 'multipart/form-data; boundary=' + boundary})
+        try:
+            with urlopen(req) as resp:
+                return resp.status, resp.read()
+        except HTTPError as e:
+            return e.code, e.read()
+
+    def send_delta(self, new, digest=None):
+        status, resp = self.request('GET', '/uploads/{}/signature'.format(self.bookfusion_id))
+        self.assertEqual(status, 200)
+
+        fd, file_path = tempfile.mkstemp(prefix='bookfusion_test_')
+        with open(fd, 'wb') as f:
+            f.write(new)
+        self.paths.append(file_path)
+        delta_path = delta_upload.file_delta(file_path, json.loads(resp), 0.5)
+        self.assertIsNotNone(delta_path)
+        self.paths.append(delta_path)
+        with open(delta_path, 'rb') as f:
+            delta = f.read()
+
+        return len(delta), self.request(
+            'PUT', '/uploads/{}/delta'.format(self.bookfusion_id),
+            {'digest': digest or book_digest(new)}, {'delta': delta}
+        )
+
+    def test_applied(self):
+        delta_size, (status, resp) = self.send_delta(self.new)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.stub.books[self.bookfusion_id]['data'], self.new)
+        self.assertLess(delta_size, len(self.new) // 25)
+
+    def test_digest_mismatch(self):
+        delta_size, (status, resp) = self.send_delta(self.new, book_digest(self.old))
+
+        self.assertEqual(status, 422)
+        self.assertEqual(self.stub.books[self.bookfusion_id]['data'], self.old)
+
+    def test_conflict(self):
+        self.stub.delta_conflicts = 1
+
+        delta_size, (status, resp) = self.send_delta(self.new)
+
+        self.assertEqual(status, 409)
+
+    def test_no_file(self):
+        self.stub.books[self.bookfusion_id]['data'] = None
+
+        status, resp = self.request('GET', '/uploads/{}/signature'.format(self.bookfusion_id))
+
+        self.assertEqual(status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
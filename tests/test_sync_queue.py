@@ -0,0 +1,109 @@
+from os import path
+import sys
+import unittest
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from sync_queue import SyncQueue  # noqa: E402
+
+
+def pop_all(queue):
+    book_ids = []
+    while len(queue):
+        book_ids.append(queue.pop())
+    return book_ids
+
+
+class SyncQueueTest(unittest.TestCase):
+    def test_priority_order(self):
+        queue = SyncQueue()
+        queue.push(1, SyncQueue.UPLOAD)
+        queue.push(2, SyncQueue.UPDATE)
+        queue.push(3, SyncQueue.SELECTED)
+        queue.push(4, SyncQueue.RECENT)
+
+        self.assertEqual(pop_all(queue), [3, 4, 2, 1])
+
+    def test_newest_first_within_priority(self):
+        queue = SyncQueue()
+        for book_id in [5, 9, 7]:
+            queue.push(book_id, SyncQueue.UPLOAD)
+
+        self.assertEqual(pop_all(queue), [9, 7, 5])
+
+    def test_fifo_within_order(self):
+        # Books with the same priority and order key come out in the order
+        # they were pushed.
+        queue = SyncQueue()
+        for book_id in [5, 9, 7]:
+            queue.push(book_id, SyncQueue.UPDATE, 'Author/Title')
+
+        self.assertEqual(pop_all(queue), [5, 9, 7])
+
+    def test_order_key(self):
+        queue = SyncQueue()
+        queue.push(1, SyncQueue.UPLOAD, 'b')
+        queue.push(2, SyncQueue.UPLOAD, 'a')
+        queue.push(3, SyncQueue.UPDATE, 'c')
+
+        self.assertEqual(pop_all(queue), [3, 2, 1])
+
+    def test_duplicate_push(self):
+        queue = SyncQueue()
+        queue.push(1, SyncQueue.UPLOAD)
+        queue.push(2, SyncQueue.UPLOAD)
+        queue.push(1, SyncQueue.UPLOAD)
+
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(pop_all(queue), [2, 1])
+
+    def test_requeue_higher_priority(self):
+        queue = SyncQueue()
+        queue.push(1, SyncQueue.UPLOAD)
+        queue.push(2, SyncQueue.UPDATE)
+        queue.push(1, SyncQueue.SELECTED)
+
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(pop_all(queue), [1, 2])
+
+    def test_requeue_lower_priority(self):
+        # A queued book keeps its place.
+        queue = SyncQueue()
+        queue.push(1, SyncQueue.SELECTED)
+        queue.push(2, SyncQueue.UPDATE)
+        queue.push(1, SyncQueue.UPLOAD)
+
+        self.assertEqual(pop_all(queue), [1, 2])
+
+    def test_requeue_after_pop(self):
+        # A book synced already, e.g. retried after a failure, is queued
+        # again.
+        queue = SyncQueue()
+        queue.push(1, SyncQueue.UPLOAD)
+        self.assertEqual(queue.pop(), 1)
+
+        queue.push(1, SyncQueue.UPLOAD)
+        self.assertIn(1, queue)
+        self.assertEqual(pop_all(queue), [1])
+
+    def test_remove(self):
+        queue = SyncQueue()
+        queue.push(1, SyncQueue.UPLOAD)
+        queue.push(2, SyncQueue.UPLOAD)
+        queue.remove(2)
+        queue.remove(3)
+
+        self.assertNotIn(2, queue)
+        self.assertEqual(pop_all(queue), [1])
+
+    def test_pop_empty(self):
+        queue = SyncQueue()
+        queue.push(1, SyncQueue.UPLOAD)
+        queue.remove(1)
+
+        with self.assertRaises(IndexError):
+            queue.pop()
+
+
+if __name__ == '__main__':
+    unittest.main()
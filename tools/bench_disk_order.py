@@ -0,0 +1,169 @@
+from __future__ import print_function
+
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+# Benchmarks disk order (prefs['disk_order'] and prefs['disk_readers'])
+# against a simulated slow-seek disk: uploads a synthetic library to a
+# StubApi, with every book file read for its digest first moving a single
+# simulated disk head. Reading the file that lies right after the previous
+# one costs SEQUENTIAL_MS, any other one --seek-ms.
+#
+# How the files lie on the disk is not known to the plugin, so it is run
+# with two layouts:
+#
+#   import  files in the order the books were added, as in a library that
+#           grew over time; book id order is sequential here
+#   folder  files in the order of their folders, as in a library copied or
+#           restored by a tool that walks them in sorted order
+#
+# Disk order sorts by folder, so it can only gain on the second layout and
+# loses on the first. The numbers illustrate that trade-off for a simulated
+# disk; they are no evidence of a gain on a real one.
+#
+# Usage (see `make bench-disk-order`):
+#
+#     calibre-debug tools/bench_disk_order.py -- [--books 500] [--size 262144] [--seek-ms 8]
+
+from argparse import ArgumentParser
+from os import path
+from threading import Lock
+from time import sleep
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from headless_sync import copy_library, make_library, open_sync, use_stub  # noqa: E402
+from stub_api import StubApi  # noqa: E402
+
+from calibre.library import db as open_library  # noqa: E402
+from calibre_plugins.bookfusion.book_format import BookFormat  # noqa: E402
+from calibre_plugins.bookfusion.config import prefs  # noqa: E402
+from calibre_plugins.bookfusion.sync_session import SyncSession  # noqa: E402
+from calibre_plugins.bookfusion.sync_stages import HashPool  # noqa: E402
+from calibre_plugins.bookfusion.upload_manager import UploadManager  # noqa: E402
+
+SEQUENTIAL_MS = 0.5
+DEADLINE = 3600
+
+LAYOUTS = ['import', 'folder']
+
+RUNS = [
+    # name, disk_order, disk_readers
+    ('book id order', False, 0),
+    ('disk order', True, 0),
+    ('disk order, 1 reader', True, 1),
+]
+
+
+class SlowSeekDisk:
+    def __init__(self, file_paths, seek_ms):
+        # file_paths in the order the files lie on the disk.
+        self.ranks = dict((file_path, rank) for rank, file_path in enumerate(file_paths))
+        self.seek_ms = seek_ms
+        self.lock = Lock()
+        self.head = None
+        self.seeks = 0
+        self.seek_time = 0
+
+    def read(self, file_path):
+        # Called from the hash pool's threads, which share the one head.
+        with self.lock:
+            rank = self.ranks.get(file_path)
+            if rank is not None and self.head is not None and rank == self.head + 1:
+                delay = SEQUENTIAL_MS
+            else:
+                delay = self.seek_ms
+                self.seeks += 1
+            self.head = rank
+            self.seek_time += delay / 1000
+            sleep(delay / 1000)
+
+
+class SlowSeekHashPool(HashPool):
+    def __init__(self, disk, threads, parent=None):
+        HashPool.__init__(self, threads, parent)
+        self.disk = disk
+
+    def run(self, key, file_path):
+        self.disk.read(file_path)
+        HashPool.run(self, key, file_path)
+
+
+# UploadManager whose digests are read from the slow-seek disk.
+class BenchManager(UploadManager):
+    def __init__(self, db, logger, book_ids, reupload, limits, disk):
+        UploadManager.__init__(self, db, logger, book_ids, reupload, limits)
+        self.disk = disk
+
+    def start(self):
+        self.session = SyncSession(self)
+        self.session.stages.hashing.shutdown()
+        self.session.stages.hashing = SlowSeekHashPool(self.disk, prefs['hash_threads'], self)
+        self.owns_stages = True
+        UploadManager.start(self)
+
+
+def book_files(library_path, layout):
+    # The book files in the order they lie on the disk with layout.
+    legacy_db = open_library(library_path)
+    db = legacy_db.new_api
+    file_paths = [BookFormat(db, book_id).file_path for book_id in sorted(db.all_book_ids())]
+    legacy_db.close()
+    return sorted(file_paths) if layout == 'folder' else file_paths
+
+
+def run(template_path, layout, name, disk_order, disk_readers, seek_ms):
+    library_path = copy_library(template_path)
+    stub = StubApi().start()
+    try:
+        use_stub(stub, disk_order=disk_order, disk_readers=disk_readers, update_metadata=False, trace=False)
+        disk = SlowSeekDisk(book_files(library_path, layout), seek_ms)
+        legacy_db, sync = open_sync(library_path, manager_class=BenchManager, disk=disk)
+        finished = sync.run(DEADLINE)
+        legacy_db.close()
+    finally:
+        stub.stop()
+        shutil.rmtree(library_path)
+
+    if not finished:
+        print('{:<22} did not finish'.format(name))
+        return None
+    print('{:<22} {:>8.1f}s {:>7} {:>9.1f}s  {}'.format(
+        name, sync.elapsed, disk.seeks, disk.seek_time, sync.summary()
+    ))
+    return sync.elapsed
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ['--']:
+        args = args[1:]
+
+    parser = ArgumentParser(prog='calibre-debug tools/bench_disk_order.py --')
+    parser.add_argument('--books', type=int, default=500)
+    parser.add_argument('--size', type=int, default=262144, help='size of each book file in bytes')
+    parser.add_argument('--seek-ms', type=float, default=8, help='time of a seek to a file that is not the next one')
+    args = parser.parse_args(args)
+
+    template_path = tempfile.mkdtemp(prefix='bookfusion_bench_')
+    try:
+        print('Creating {} books...'.format(args.books))
+        make_library(template_path, args.books, args.size)
+
+        for layout in LAYOUTS:
+            print()
+            print('{:<22} {:>9} {:>7} {:>10}'.format('{} layout'.format(layout), 'time', 'seeks', 'seek time'))
+            times = [
+                run(template_path, layout, name, disk_order, readers, args.seek_ms)
+                for name, disk_order, readers in RUNS
+            ]
+            if None not in times:
+                print('Disk order: {:.0%} of the time of book id order'.format(min(times[1:]) / times[0]))
+    finally:
+        shutil.rmtree(template_path)
+
+
+main()
@@ -0,0 +1,122 @@
+from __future__ import print_function
+
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+# Benchmarks the sharded sync on a skip-heavy library: uploads a synthetic
+# library to a StubApi once, then syncs copies of the synced library against
+# the same stub in 1, 2 and 4 processes, so that nearly every book is checked
+# and skipped. A share of the books is changed first so that some updates go
+# along with the skips. The stub is reset to its books after the upload before
+# every run, so that each run has the same updates to make. Reports the time and books/s of each run.
+#
+# Usage (see `make bench-shards`):
+#
+#     calibre-debug tools/bench_shards.py -- [--books 5000] [--changed 0.02] [--shards 1,2,4]
+#
+# Exits with 1 if a run did not finish or did not account for every book.
+
+from argparse import ArgumentParser
+from copy import deepcopy
+from os import path
+from random import Random
+import shutil
+import sys
+import tempfile
+
+from calibre.library import db as open_library
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from headless_sync import copy_library, make_library, open_sync, use_stub  # noqa: E402
+from stub_api import StubApi  # noqa: E402
+
+from calibre_plugins.bookfusion.sharded_sync import ShardedSync  # noqa: E402
+from calibre_plugins.bookfusion.upload_manager import UploadManager  # noqa: E402
+
+DEADLINE = 1800
+
+
+def upload_library(library_path, count):
+    legacy_db, sync = open_sync(library_path)
+    finished = sync.run(DEADLINE)
+    legacy_db.close()
+    if not finished or sync.error or sync.counts['uploaded'] != count:
+        print('Upload: {}'.format(sync.summary() if finished else 'did not finish'))
+        return False
+    return True
+
+
+def change_books(library_path, share, seed):
+    # Retitles a share of the books, so that their metadata is updated.
+    legacy_db = open_library(library_path)
+    db = legacy_db.new_api
+    book_ids = sorted(db.all_book_ids())
+    changed = Random(seed).sample(book_ids, int(len(book_ids) * share))
+    db.set_field('title', dict((book_id, 'Changed {}'.format(book_id)) for book_id in changed))
+    legacy_db.close()
+
+
+def run(template_path, stub, books, count, shards):
+    with stub.lock:
+        stub.books = deepcopy(books)
+    library_path = copy_library(template_path)
+    try:
+        if shards > 1:
+            legacy_db, sync = open_sync(library_path, manager_class=ShardedSync, shards=shards)
+        else:
+            legacy_db, sync = open_sync(library_path, manager_class=UploadManager)
+        finished = sync.run(DEADLINE)
+        if not finished and sync.manager is not None:
+            sync.manager.cancel()
+        legacy_db.close()
+    finally:
+        shutil.rmtree(library_path)
+
+    if not finished or sync.error or sum(sync.counts.values()) != count:
+        print('{:>6} {}'.format(shards, sync.summary() if finished else 'did not finish'))
+        return False
+
+    print('{:>6} {:>8.1f}s {:>8.1f} {:>8} {:>8} {:>8}'.format(
+        shards, sync.elapsed, count / sync.elapsed,
+        sync.counts['skipped'], sync.counts['updated'], sync.counts['uploaded']
+    ))
+    return True
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ['--']:
+        args = args[1:]
+
+    parser = ArgumentParser(prog='calibre-debug tools/bench_shards.py --')
+    parser.add_argument('--books', type=int, default=5000)
+    parser.add_argument('--size', type=int, default=16384, help='size of each book file in bytes')
+    parser.add_argument('--changed', type=float, default=0.02, help='share of the books changed since the upload')
+    parser.add_argument('--shards', default='1,2,4', help='process counts to compare')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(args)
+
+    stub = StubApi(seed=args.seed).start()
+    template_path = tempfile.mkdtemp(prefix='bookfusion_bench_')
+    try:
+        use_stub(stub, update_metadata=True, trace=False)
+        print('Creating and uploading {} books...'.format(args.books))
+        make_library(template_path, args.books, args.size, args.seed)
+        if not upload_library(template_path, args.books):
+            sys.exit(1)
+        change_books(template_path, args.changed, args.seed)
+        books = deepcopy(stub.books)
+
+        print('{:>6} {:>9} {:>8} {:>8} {:>8} {:>8}'.format('shards', 'time', 'books/s', 'skipped', 'updated', 'uploaded'))
+        results = [
+            run(template_path, stub, books, args.books, int(shards)) for shards in args.shards.split(',')
+        ]
+    finally:
+        stub.stop()
+        shutil.rmtree(template_path)
+
+    sys.exit(0 if all(results) else 1)
+
+
+main()
@@ -0,0 +1,94 @@
+from __future__ import print_function
+
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+# Benchmarks hashing new books while they are uploaded: uploads the same
+# synthetic library to a StubApi without and with digest_on_finalize in its
+# limits, and reports the bytes read from disk per byte of book file uploaded,
+# from the `Upload read` lines of the sync log. Without it, a new book is read
+# once for its digest and once more for the upload.
+#
+# Usage (see `make bench-single-pass`):
+#
+#     calibre-debug tools/bench_single_pass.py -- [--books 200] [--size 1048576]
+#
+# Exits with 1 if a run did not upload every book.
+
+from argparse import ArgumentParser
+from os import path
+import re
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from headless_sync import copy_library, make_library, open_sync, use_stub  # noqa: E402
+from stub_api import StubApi  # noqa: E402
+
+DEADLINE = 1800
+
+UPLOAD_READ = re.compile(r'Upload read: file_size=(\d+); bytes_read=(\d+)')
+
+
+def read_totals(log_path):
+    file_size = 0
+    bytes_read = 0
+    with open(log_path) as f:
+        for line in f:
+            match = UPLOAD_READ.search(line)
+            if match:
+                file_size += int(match.group(1))
+                bytes_read += int(match.group(2))
+    return file_size, bytes_read
+
+
+def run(template_path, count, digest_on_finalize):
+    library_path = copy_library(template_path)
+    stub = StubApi({'digest_on_finalize': digest_on_finalize}).start()
+    try:
+        use_stub(stub, debug=True, update_metadata=False, trace=False)
+        legacy_db, sync = open_sync(library_path)
+        finished = sync.run(DEADLINE)
+        legacy_db.close()
+        file_size, bytes_read = read_totals(sync.logger.path)
+    finally:
+        stub.stop()
+        shutil.rmtree(library_path)
+
+    name = 'digest at finalize' if digest_on_finalize else 'digest up front'
+    if not finished or sync.error or sync.counts['uploaded'] != count:
+        print('{:<20} {}'.format(name, sync.summary() if finished else 'did not finish'))
+        return False
+
+    print('{:<20} {:>8.1f}s {:>10.1f} MB {:>10.1f} MB {:>8.2f}'.format(
+        name, sync.elapsed, file_size / 1048576, bytes_read / 1048576, bytes_read / file_size
+    ))
+    return True
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ['--']:
+        args = args[1:]
+
+    parser = ArgumentParser(prog='calibre-debug tools/bench_single_pass.py --')
+    parser.add_argument('--books', type=int, default=200)
+    parser.add_argument('--size', type=int, default=1048576, help='size of each book file in bytes')
+    args = parser.parse_args(args)
+
+    template_path = tempfile.mkdtemp(prefix='bookfusion_bench_')
+    try:
+        print('Creating {} books...'.format(args.books))
+        make_library(template_path, args.books, args.size)
+
+        print('{:<20} {:>9} {:>13} {:>13} {:>8}'.format('', 'time', 'uploaded', 'read', 'ratio'))
+        results = [run(template_path, args.books, digest_on_finalize) for digest_on_finalize in (False, True)]
+    finally:
+        shutil.rmtree(template_path)
+
+    sys.exit(0 if all(results) else 1)
+
+
+main()
@@ -0,0 +1,129 @@
+from __future__ import print_function
+
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+# Checks batched metadata updates against a StubApi with the batch_update
+# endpoint: uploads a synthetic library, renames a tag on every book, then
+# syncs the update with
+#
+#   - some books rejected by the server, which fail on their own,
+#   - a batch failing as a whole, whose books fall back to one PUT each,
+#   - no batch endpoint, so every book is updated with a PUT.
+#
+# Usage (see `make check-batch-update`):
+#
+#     calibre-debug tools/check_batch_update.py -- [--books 120]
+#
+# Exits with 1 if the books were not updated, failed or sent as expected.
+
+from argparse import ArgumentParser
+from copy import deepcopy
+from os import path
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from headless_sync import copy_library, make_library, open_sync, use_stub  # noqa: E402
+from stub_api import StubApi  # noqa: E402
+
+from calibre.library import db as open_library  # noqa: E402
+
+BATCH_SIZE = 25
+REJECTED = 3
+DEADLINE = 600
+
+
+def sync(library_path):
+    legacy_db, headless = open_sync(library_path)
+    finished = headless.run(DEADLINE)
+    legacy_db.close()
+    return headless if finished else None
+
+
+def rename_tag(library_path):
+    legacy_db = open_library(library_path)
+    db = legacy_db.new_api
+    db.set_field('tags', dict((book_id, ['Renamed']) for book_id in db.all_book_ids()))
+    legacy_db.close()
+
+
+def run_scenario(stub, template_path, books, name, setup, expect):
+    library_path = copy_library(template_path)
+    stub.books = deepcopy(books)
+    stub.counts = {}
+    stub.batch_update = True
+    stub.rejected = set()
+    stub.failed_batches = 0
+    setup(stub)
+    try:
+        headless = sync(library_path)
+    finally:
+        shutil.rmtree(library_path)
+
+    batches = stub.counts.get('POST /uploads/batch_update', 0)
+    puts = stub.counts.get('PUT /uploads/<id>', 0)
+    if headless is None:
+        print('{}: did not finish'.format(name))
+        return False
+
+    print('{}: {}; {} batch requests, {} PUTs'.format(name, headless.summary(), batches, puts))
+    ok = headless.error is None and expect(headless.counts, batches, puts)
+    print('  {}'.format('OK' if ok else 'FAILED'))
+    return ok
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ['--']:
+        args = args[1:]
+
+    parser = ArgumentParser(prog='calibre-debug tools/check_batch_update.py --')
+    parser.add_argument('--books', type=int, default=120)
+    args = parser.parse_args(args)
+    count = args.books
+
+    template_path = tempfile.mkdtemp(prefix='bookfusion_check_')
+    stub = StubApi({'batch_update': BATCH_SIZE}).start()
+    try:
+        make_library(template_path, count, 4096)
+        use_stub(stub, update_metadata=True, trace=False)
+
+        headless = sync(template_path)
+        if headless is None or headless.counts['uploaded'] != count:
+            print('Upload: {}'.format(headless.summary() if headless else 'did not finish'))
+            print('FAILED')
+            sys.exit(1)
+        books = deepcopy(stub.books)
+        rename_tag(template_path)
+
+        max_batches = -(-count // BATCH_SIZE)
+        scenarios = [
+            (
+                'rejected books',
+                lambda stub: stub.rejected.update(sorted(stub.books, key=int)[:REJECTED]),
+                lambda counts, batches, puts: counts['updated'] == count - REJECTED and
+                counts['failed'] == REJECTED and puts == 0 and batches <= max_batches + 2
+            ),
+            (
+                'failed batch',
+                lambda stub: setattr(stub, 'failed_batches', 1),
+                lambda counts, batches, puts: counts['updated'] == count and 0 < puts <= BATCH_SIZE
+            ),
+            (
+                'no batch endpoint',
+                lambda stub: setattr(stub, 'batch_update', False),
+                lambda counts, batches, puts: counts['updated'] == count and puts == count
+            ),
+        ]
+        results = [run_scenario(stub, template_path, books, *scenario) for scenario in scenarios]
+    finally:
+        stub.stop()
+        shutil.rmtree(template_path)
+
+    sys.exit(0 if all(results) else 1)
+
+
+main()
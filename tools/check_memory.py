@@ -0,0 +1,157 @@
+from __future__ import print_function
+
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+# Checks that memory stays flat over a long sync: uploads thousands of
+# synthetic books to a StubApi and compares Python allocations (tracemalloc)
+# and the process RSS once a quarter of the books is synced and at the end.
+# The run is shown in a SyncWidget, off screen, as in the sync dialog, so the
+# log rows it keeps per book are measured too, and checked against
+# SyncWidget.MAX_LOG_ROWS.
+#
+# Usage (see `make check-memory`):
+#
+#     calibre-debug tools/check_memory.py -- [--books 2000] [--size 65536]
+#
+# Exits with 1 if either grew by more than its allowance per book synced
+# after the first quarter, or if the log kept more rows than it may.
+
+from argparse import ArgumentParser
+from os import environ, path
+import gc
+import resource
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from headless_sync import make_library, open_sync, use_stub  # noqa: E402
+from stub_api import StubApi  # noqa: E402
+
+from PyQt5.Qt import QApplication, QWidget  # noqa: E402
+
+from calibre_plugins.bookfusion.sync import SyncWidget  # noqa: E402
+from calibre_plugins.bookfusion.upload_manager import UploadManager  # noqa: E402
+
+# Some state is kept per book on purpose, e.g. its digest and request
+# latencies; a request body, file or reply kept alive costs far more.
+MAX_TRACED_PER_BOOK = 2048
+MAX_RSS_PER_BOOK = 8192
+
+DEADLINE = 3600
+
+
+def rss():
+    # Current RSS where /proc has it, the peak otherwise.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Stands in for calibre's main window as the parent of a SyncWidget.
+class LibraryWindow(QWidget):
+    def __init__(self, legacy_db):
+        QWidget.__init__(self)
+        self.current_db = legacy_db
+
+
+# UploadManager taking a sample of memory use as books are synced, shown in
+# widget the way the sync dialog shows a run.
+class SampledManager(UploadManager):
+    def __init__(self, db, logger, book_ids, reupload, limits, widget):
+        UploadManager.__init__(self, db, logger, book_ids, reupload, limits)
+
+        self.widget = widget
+        self.sample_at = len(book_ids) // 4
+        self.samples = []
+        self.max_log_rows = 0
+        self.progress.connect(self.sample)
+
+        # The widget has no service here, which finishing a run needs.
+        widget.reset_run()
+        widget.in_progress = True
+        widget.total = len(book_ids)
+        for signal, slot in widget.run_connections(self):
+            if slot not in (widget.finish_sync, widget.abort):
+                signal.connect(slot)
+        self.started.connect(self.count_log_rows)
+
+    def count_log_rows(self, book_id):
+        self.max_log_rows = max(self.max_log_rows, self.widget.log.rowCount(), len(self.widget.book_log_map))
+
+    def sample(self, count):
+        if count == self.sample_at:
+            self.take_sample(count)
+
+    def take_sample(self, count):
+        gc.collect()
+        self.samples.append((count, tracemalloc.get_traced_memory()[0], rss()))
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ['--']:
+        args = args[1:]
+
+    parser = ArgumentParser(prog='calibre-debug tools/check_memory.py --')
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=65536, help='size of each book file in bytes')
+    args = parser.parse_args(args)
+
+    library_path = tempfile.mkdtemp(prefix='bookfusion_check_')
+    stub = StubApi().start()
+    try:
+        print('Creating {} books...'.format(args.books))
+        make_library(library_path, args.books, args.size)
+        use_stub(stub, threads=4, update_metadata=False, trace=False)
+
+        # The widget needs a QApplication, which the sync then runs in.
+        environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        app = QApplication([])  # noqa: F841
+
+        tracemalloc.start()
+        legacy_db, sync = open_sync(library_path, manager_class=SampledManager)
+        window = LibraryWindow(legacy_db)
+        sync.manager_args['widget'] = SyncWidget(window, None, [], False, None)
+        finished = sync.run(DEADLINE)
+        if finished and sync.manager is not None:
+            sync.manager.take_sample(sync.manager.count)
+        legacy_db.close()
+        tracemalloc.stop()
+    finally:
+        stub.stop()
+        shutil.rmtree(library_path)
+
+    print('{} in {:.1f}s'.format(sync.summary(), sync.elapsed or 0))
+    samples = sync.manager.samples if sync.manager is not None else []
+    if not finished or sync.error or len(samples) < 2:
+        print('FAILED: the sync did not finish')
+        sys.exit(1)
+
+    (first_count, first_traced, first_rss), (last_count, last_traced, last_rss) = samples[0], samples[-1]
+    books = max(1, last_count - first_count)
+    traced_per_book = (last_traced - first_traced) / books
+    rss_per_book = (last_rss - first_rss) / books
+    for count, traced, rss_bytes in samples:
+        print('  after {:>6} books: traced {:>8.1f} MB, RSS {:>8.1f} MB'.format(
+            count, traced / 1048576, rss_bytes / 1048576
+        ))
+    print('Growth per book: traced {:.0f} bytes (max {}), RSS {:.0f} bytes (max {})'.format(
+        traced_per_book, MAX_TRACED_PER_BOOK, rss_per_book, MAX_RSS_PER_BOOK
+    ))
+    max_log_rows = sync.manager.max_log_rows
+    print('Sync log: at most {} rows (max {})'.format(max_log_rows, SyncWidget.MAX_LOG_ROWS))
+
+    ok = traced_per_book <= MAX_TRACED_PER_BOOK and rss_per_book <= MAX_RSS_PER_BOOK and \
+        max_log_rows <= SyncWidget.MAX_LOG_ROWS
+    print('OK' if ok else 'FAILED')
+    sys.exit(0 if ok else 1)
+
+
+main()
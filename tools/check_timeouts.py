@@ -0,0 +1,66 @@
+from __future__ import print_function
+
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+# Checks that hung requests and stalled uploads are timed out and retried
+# instead of keeping a sync from finishing, against a StubApi that holds some
+# requests without answering them.
+#
+# Usage (see `make check-timeouts`):
+#
+#     calibre-debug tools/check_timeouts.py
+#
+# Exits with 1 if a sync did not finish in time or did not upload every book.
+
+from os import path
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from headless_sync import make_library, open_sync, use_stub  # noqa: E402
+from stub_api import StubApi  # noqa: E402
+
+TIMEOUT = 3
+DEADLINE = 180
+
+SCENARIOS = [
+    # name, books, book size, faults
+    ('hung requests', 6, 65536, {'hang': {'POST /uploads/init': 2, 'POST /uploads/finalize': 2}}),
+    ('stalled upload', 2, 32 * 1048576, {'stall_body': {'POST /storage': 1}}),
+]
+
+
+def run_scenario(name, count, size, faults):
+    library_path = tempfile.mkdtemp(prefix='bookfusion_check_')
+    stub = StubApi().start()
+    try:
+        make_library(library_path, count, size)
+        use_stub(stub, request_timeout=TIMEOUT, stall_timeout=TIMEOUT, threads=2, update_metadata=False)
+        stub.hang.update(faults.get('hang', {}))
+        stub.stall_body.update(faults.get('stall_body', {}))
+
+        legacy_db, sync = open_sync(library_path)
+        finished = sync.run(DEADLINE)
+        legacy_db.close()
+
+        print('{}: {} in {}'.format(
+            name, sync.summary(), '{:.1f}s'.format(sync.elapsed) if finished else 'no time (did not finish)'
+        ))
+        print('  requests: {}'.format(stub.counts))
+        ok = finished and sync.error is None and sync.counts['uploaded'] == count
+        print('  {}'.format('OK' if ok else 'FAILED'))
+        return ok
+    finally:
+        stub.stop()
+        shutil.rmtree(library_path)
+
+
+def main():
+    results = [run_scenario(*scenario) for scenario in SCENARIOS]
+    sys.exit(0 if all(results) else 1)
+
+
+main()
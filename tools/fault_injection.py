@@ -0,0 +1,170 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QNetworkAccessManager, QNetworkReply, QNetworkRequest, QIODeviceBase, QTimer
+from random import Random
+
+
+# Fault injection for soak testing the sync engine against a StubApi, used by
+# tools/soak.py. A profile is a comma separated list of fault=rate pairs, e.g.
+#
+#   drop=0.02,server_error=0.05,rate_limit=0.02,latency=0.05
+#
+# and every request fails that way with that probability, instead of being
+# sent. Latency is injected by the StubApi instead: the request is sent and
+# answered late. A seed makes the sequence of faults repeatable.
+class FaultProfile:
+    # Each fault is answered after DELAY_MS, except hang which never is.
+    DELAY_MS = 200
+
+    STUB_FAULTS = ['latency']
+
+    FAULTS = {
+        'drop': (None, QNetworkReply.NetworkError.RemoteHostClosedError, {}, b''),
+        'server_error': (500, QNetworkReply.NetworkError.InternalServerError, {}, b'{"error": "Injected fault"}'),
+        'unavailable': (503, QNetworkReply.NetworkError.ServiceUnavailableError, {}, b''),
+        'validation': (422, QNetworkReply.NetworkError.UnknownContentError, {}, b'{"error": "Injected fault"}'),
+        'rate_limit': (429, QNetworkReply.NetworkError.UnknownContentError, {b'Retry-After': b'2'}, b''),
+        'truncated': (200, QNetworkReply.NetworkError.NoError, {}, b'{"id": 1, "calibre_metadata_d'),
+        'hang': None
+    }
+
+    def __init__(self, rates, seed=None):
+        self.rates = rates
+        self.random = Random(seed)
+
+    def __str__(self):
+        return ','.join('{}={}'.format(fault, rate) for fault, rate in sorted(self.rates.items()))
+
+    @classmethod
+    def parse(cls, spec, seed=None):
+        rates = {}
+        for item in spec.split(','):
+            fault, _, rate = item.partition('=')
+            fault = fault.strip()
+            if fault not in cls.FAULTS and fault not in cls.STUB_FAULTS:
+                raise ValueError('Unknown fault: {}'.format(fault))
+            rates[fault] = float(rate)
+        return cls(rates, seed)
+
+    def pick(self):
+        value = self.random.random()
+        for fault, rate in sorted(self.rates.items()):
+            if fault in self.STUB_FAULTS:
+                continue
+            if value < rate:
+                return fault
+            value -= rate
+        return None
+
+
+# Network access manager answering some requests with an injected fault.
+class FaultInjectingNetworkAccessManager(QNetworkAccessManager):
+    def __init__(self, profile, parent=None):
+        QNetworkAccessManager.__init__(self, parent)
+
+        self.profile = profile
+        self.injected = {}
+
+    def createRequest(self, op, req, outgoing_data=None):
+        fault = self.profile.pick()
+        if fault is None:
+            return QNetworkAccessManager.createRequest(self, op, req, outgoing_data)
+
+        self.injected[fault] = self.injected.get(fault, 0) + 1
+        return FaultReply(self, op, req, fault)
+
+
+class FaultReply(QNetworkReply):
+    def __init__(self, parent, op, req, fault):
+        QNetworkReply.__init__(self, parent)
+
+        self.setRequest(req)
+        self.setUrl(req.url())
+        self.setOperation(op)
+        self.open(QIODeviceBase.OpenModeFlag.ReadOnly | QIODeviceBase.OpenModeFlag.Unbuffered)
+
+        self.fault = fault
+        self.body = b''
+        self.offset = 0
+
+        if FaultProfile.FAULTS[fault] is not None:
+            QTimer.singleShot(FaultProfile.DELAY_MS, self.respond)
+
+    def respond(self):
+        if self.isFinished():
+            return
+
+        status, error, headers, body = FaultProfile.FAULTS[self.fault]
+        if status is not None:
+            self.setAttribute(QNetworkRequest.Attribute.HttpStatusCodeAttribute, status)
+        for name, value in headers.items():
+            self.setRawHeader(name, value)
+        self.body = body
+
+        if error != QNetworkReply.NetworkError.NoError:
+            self.setError(error, 'Injected fault: {}'.format(self.fault))
+            self.errorOccurred.emit(error)
+        if body:
+            self.readyRead.emit()
+        self.finish()
+
+    def finish(self):
+        self.setFinished(True)
+        self.finished.emit()
+
+    def abort(self):
+        if self.isFinished():
+            return
+        self.setError(QNetworkReply.NetworkError.OperationCanceledError, 'Operation canceled')
+        self.errorOccurred.emit(QNetworkReply.NetworkError.OperationCanceledError)
+        self.finish()
+
+    def isSequential(self):
+        return True
+
+    def bytesAvailable(self):
+        return len(self.body) - self.offset + QNetworkReply.bytesAvailable(self)
+
+    def readData(self, maxlen):
+        chunk = self.body[self.offset:self.offset + maxlen]
+        self.offset += len(chunk)
+        return chunk
+
+
+# Checks the promises a sync run makes about every book it was given.
+# Violations are logged and kept in the run's metrics.
+class SyncInvariants:
+    SUCCESS = ['uploaded', 'updated', 'skipped']
+    TERMINAL = SUCCESS + ['failed', 'duplicate', 'planned']
+
+    def __init__(self):
+        self.states = {}
+        self.successes = {}
+        self.violations = []
+
+    def record(self, book_id, state):
+        if state in self.SUCCESS:
+            self.successes[book_id] = self.successes.get(book_id, 0) + 1
+            if self.successes[book_id] == 2:
+                self.violations.append('book {} succeeded more than once'.format(book_id))
+        self.states[book_id] = state
+
+    def check_identifier(self, book_id, bookfusion_id, confirmed=True):
+        # confirmed tells whether the server has a book of that id.
+        if not bookfusion_id or not str(bookfusion_id).strip() or str(bookfusion_id) == 'None':
+            self.violations.append('book {} got an empty identifier'.format(book_id))
+        elif not confirmed:
+            self.violations.append('book {} got identifier {} the server does not have'.format(book_id, bookfusion_id))
+        elif self.states.get(book_id) not in ('started', 'retrying'):
+            self.violations.append('book {} got an identifier while {}'.format(book_id, self.states.get(book_id)))
+
+    def check_complete(self, canceled):
+        # A canceled run leaves books unfinished on purpose.
+        if canceled:
+            return self.violations
+
+        for book_id, state in sorted(self.states.items()):
+            if state not in self.TERMINAL:
+                self.violations.append('book {} ended while {}'.format(book_id, state))
+        return self.violations
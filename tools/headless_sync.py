@@ -0,0 +1,170 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+# Runs a sync of a library without the GUI, the way the sync dialog does: a
+# check of every book, then an UploadManager for the valid ones. Shared by the
+# scripts in tools/, which run under calibre-debug after
+# `calibre-customize -b .`.
+
+from os import path
+from random import Random
+from time import monotonic
+import shutil
+import tempfile
+
+from calibre.customize.ui import initialized_plugins
+from calibre.ebooks.metadata.book.base import Metadata
+from calibre.library import db as open_library
+from PyQt5.Qt import QCoreApplication, QObject, QThread, QTimer, pyqtSignal
+
+list(initialized_plugins())
+
+from calibre_plugins.bookfusion.check_worker import CheckWorker  # noqa: E402
+from calibre_plugins.bookfusion.config import prefs  # noqa: E402
+from calibre_plugins.bookfusion.logger import Logger  # noqa: E402
+from calibre_plugins.bookfusion.upload_manager import UploadManager  # noqa: E402
+
+
+class HeadlessSync(QObject):
+    finished = pyqtSignal()
+
+    def __init__(self, db, logger, reupload=False, manager_class=UploadManager, **manager_args):
+        QObject.__init__(self)
+
+        self.db = db
+        self.logger = logger
+        self.reupload = reupload
+        self.manager_class = manager_class
+        self.manager_args = manager_args
+        self.limits = None
+        self.valid_ids = []
+        self.error = None
+        self.manager = None
+        self.started_at = None
+        self.elapsed = None
+        self.counts = {'uploaded': 0, 'updated': 0, 'skipped': 0, 'failed': 0, 'duplicate': 0}
+
+    def start(self):
+        self.started_at = monotonic()
+        self.check_thread = QThread(self)
+
+        self.check_worker = CheckWorker(self.db, self.logger, list(self.db.all_book_ids()))
+        self.check_worker.finished.connect(self.check_thread.quit)
+        self.check_worker.finished.connect(self.finish_check)
+        self.check_worker.limitsAvailable.connect(self.apply_limits)
+        self.check_worker.resultsAvailable.connect(self.apply_results)
+        self.check_worker.aborted.connect(self.abort)
+        self.check_worker.moveToThread(self.check_thread)
+
+        self.check_thread.started.connect(self.check_worker.start)
+        self.check_thread.start()
+
+    def apply_limits(self, limits):
+        self.limits = limits
+
+    def apply_results(self, books_count, valid_ids):
+        self.valid_ids = valid_ids
+
+    def abort(self, error):
+        self.error = error
+
+    def finish_check(self):
+        self.check_thread.wait()
+        if self.error or not self.valid_ids:
+            self.error = self.error or 'No supported books to sync.'
+            self.finish()
+            return
+
+        book_ids = self.valid_ids
+        if self.limits['total_books']:
+            book_ids = book_ids[:self.limits['total_books']]
+
+        self.manager = self.manager_class(
+            self.db, self.logger, book_ids, self.reupload, self.limits, **self.manager_args
+        )
+        self.manager.uploaded.connect(lambda book_id: self.count('uploaded'))
+        self.manager.updated.connect(lambda book_id: self.count('updated'))
+        self.manager.skipped.connect(lambda book_id: self.count('skipped'))
+        self.manager.failed.connect(lambda book_id, msg, category: self.count('failed'))
+        self.manager.duplicate.connect(lambda book_id, primary_id, size: self.count('duplicate'))
+        self.manager.aborted.connect(self.abort)
+        self.manager.finished.connect(self.finish)
+        self.manager.start()
+
+    def count(self, key):
+        self.counts[key] += 1
+
+    def finish(self):
+        self.elapsed = monotonic() - self.started_at
+        self.finished.emit()
+
+    def summary(self):
+        if self.error:
+            return self.error
+        return '{uploaded} uploaded, {updated} updated, {skipped} skipped, {failed} failed, ' \
+            '{duplicate} duplicate'.format(**self.counts)
+
+    def run(self, deadline=None):
+        # Returns whether the sync finished within deadline seconds.
+        app = QCoreApplication.instance() or QCoreApplication([])
+        self.finished.connect(app.quit)
+        if deadline is not None:
+            timer = QTimer(self)
+            timer.setSingleShot(True)
+            timer.timeout.connect(app.quit)
+            timer.start(int(deadline * 1000))
+            self.finished.connect(timer.stop)
+        QTimer.singleShot(0, self.start)
+        app.exec_()
+        return self.elapsed is not None
+
+
+def open_sync(library_path, reupload=False, manager_class=UploadManager, **manager_args):
+    # Returns the library and a HeadlessSync of it; close the library when
+    # done.
+    legacy_db = open_library(library_path)
+    logger = Logger(path.join(library_path, 'bookfusion_sync.log'))
+    return legacy_db, HeadlessSync(legacy_db.new_api, logger, reupload, manager_class, **manager_args)
+
+
+def use_stub(stub, **settings):
+    # Points the plugin at a StubApi. Only for a calibre config directory of
+    # its own, see the Makefile.
+    prefs['api_key'] = 'stub'
+    prefs['api_base'] = stub.url
+    for key, value in settings.items():
+        prefs[key] = value
+
+
+def make_library(library_path, count, size, seed=1):
+    # Creates a library of count TXT books of random bytes, of size bytes and
+    # one more for every book before it, so that no two books are taken for
+    # duplicates and hashed up front. Authors are picked at random, so the
+    # book ids do not follow the folders.
+    rand = Random(seed)
+    legacy_db = open_library(library_path)
+    db = legacy_db.new_api
+    files_dir = tempfile.mkdtemp(prefix='bookfusion_books_')
+    try:
+        for start in range(0, count, 100):
+            books = []
+            for index in range(start, min(count, start + 100)):
+                metadata = Metadata('Book {}'.format(index), ['Author {:04d}'.format(rand.randrange(count))])
+                file_path = path.join(files_dir, '{}.txt'.format(index))
+                with open(file_path, 'wb') as f:
+                    block = bytes(rand.getrandbits(8) for _ in range(64))
+                    f.write((block * ((size + index) // 64 + 1))[:size + index])
+                books.append((metadata, {'txt': file_path}))
+            db.add_books(books)
+    finally:
+        shutil.rmtree(files_dir)
+        legacy_db.close()
+
+
+def copy_library(template_path):
+    # A copy of a library made by make_library, for a run that writes to it;
+    # remove it when done.
+    library_path = tempfile.mkdtemp(prefix='bookfusion_library_')
+    shutil.rmtree(library_path)
+    shutil.copytree(template_path, library_path)
+    return library_path
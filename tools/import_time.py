@@ -0,0 +1,92 @@
+from __future__ import print_function
+
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+# Prints how long each plugin module takes to import, so the plugin's share of
+# calibre startup can be compared before and after a change.
+#
+# Usage (after `calibre-customize -b .`):
+#
+#     calibre-debug tools/import_time.py
+#
+# Calibre and Qt modules are imported up front so that only the plugin's own
+# cost is measured. Modules are imported leaf first, so every row shows the
+# time spent in that module alone.
+
+import importlib
+import sys
+import time
+
+from calibre.customize.ui import initialized_plugins
+import calibre.gui2.actions  # noqa: F401
+import PyQt5.Qt  # noqa: F401
+
+STARTUP_MODULES = ['ui']
+
+MODULES = [
+    'config',
+    'logger',
+    'api',
+    'book_format',
+    'reply_timeout',
+    'check_worker',
+    'failed_queue',
+    'isbn_cache',
+    'check_cache',
+    'hashing_file',
+    'delta_upload',
+    'multipart_body',
+    'bandwidth_limiter',
+    'update_batch',
+    'upload_worker',
+    'metrics',
+    'profiler',
+    'sync_plan',
+    'sync_queue',
+    'worker_budget',
+    'sync_stages',
+    'sync_trace',
+    'sync_session',
+    'upload_manager',
+    'library_sync',
+    'sync_service',
+    'shard_worker',
+    'sharded_sync',
+    'intro',
+    'sync',
+    'main',
+]
+
+
+def import_module(name):
+    start = time.perf_counter()
+    importlib.import_module('calibre_plugins.bookfusion.' + name)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    list(initialized_plugins())
+
+    startup = 0
+    print('Loaded at calibre startup (genesis):')
+    for name in STARTUP_MODULES:
+        elapsed = import_module(name)
+        startup += elapsed
+        print('  {:>8.2f} ms  {}'.format(elapsed, name))
+
+    deferred = 0
+    print('Loaded on first use of the sync actions:')
+    for name in MODULES:
+        if 'calibre_plugins.bookfusion.' + name in sys.modules:
+            print('  {:>8}     {} (already loaded at startup)'.format('-', name))
+            continue
+        elapsed = import_module(name)
+        deferred += elapsed
+        print('  {:>8.2f} ms  {}'.format(elapsed, name))
+
+    print('Startup total:  {:.2f} ms'.format(startup))
+    print('Deferred total: {:.2f} ms'.format(deferred))
+
+
+main()
@@ -0,0 +1,154 @@
+from __future__ import print_function
+
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+# Soak test of the sync engine: uploads a synthetic library of thousands of
+# books to a StubApi the way the sync dialog does, once per fault profile,
+# with faults injected into the requests of the upload phase, and checks the
+# promises the run makes about every book (see SyncInvariants): every book
+# ends in one terminal state, no identifier is written that the server did not
+# confirm, and the run terminates within the deadline.
+#
+# Usage (see `make soak`):
+#
+#     calibre-debug tools/soak.py -- [--books 2000] [--seed 1] PROFILE...
+#
+# A PROFILE is e.g. drop=0.02,server_error=0.05,rate_limit=0.02,latency=0.05.
+# Books/s, bytes/s and the faults injected are printed for each profile,
+# along with any violated invariants. Exits with 1 if any invariant was
+# violated.
+
+from argparse import ArgumentParser
+from os import path
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from fault_injection import FaultProfile, FaultInjectingNetworkAccessManager, SyncInvariants  # noqa: E402
+from headless_sync import copy_library, make_library, open_sync, use_stub  # noqa: E402
+from stub_api import StubApi  # noqa: E402
+
+from calibre_plugins.bookfusion.sync_session import SyncSession  # noqa: E402
+from calibre_plugins.bookfusion.upload_manager import UploadManager  # noqa: E402
+
+# Short enough for hung requests to be retried within the deadline, longer
+# than a latency spike.
+TIMEOUT = 5
+
+
+# UploadManager with a session of its own, whose network access manager
+# injects faults, and the invariants of the run watched.
+class SoakManager(UploadManager):
+    def __init__(self, db, logger, book_ids, reupload, limits, profile, stub):
+        UploadManager.__init__(self, db, logger, book_ids, reupload, limits)
+
+        self.profile = profile
+        self.stub = stub
+
+        # Connected before run() so that a failure is recorded before the
+        # retry it schedules.
+        self.invariants = SyncInvariants()
+        self.started.connect(lambda book_id: self.invariants.record(book_id, 'started'))
+        self.uploaded.connect(lambda book_id: self.invariants.record(book_id, 'uploaded'))
+        self.updated.connect(lambda book_id: self.invariants.record(book_id, 'updated'))
+        self.skipped.connect(lambda book_id: self.invariants.record(book_id, 'skipped'))
+        self.failed.connect(lambda book_id, msg, category: self.invariants.record(book_id, 'failed'))
+        self.retryScheduled.connect(lambda book_id, msg, delay: self.invariants.record(book_id, 'retrying'))
+        self.duplicate.connect(lambda book_id, primary_id, size: self.invariants.record(book_id, 'duplicate'))
+
+    def start(self):
+        self.session = SyncSession(self)
+        self.session.network = FaultInjectingNetworkAccessManager(self.profile, self)
+        self.owns_stages = True
+        self.logger.info('Fault injection: {}'.format(self.profile))
+        UploadManager.start(self)
+
+    def write_identifier(self, book_id, bookfusion_id):
+        confirmed = self.stub.find(str(bookfusion_id))[1] is not None
+        self.invariants.check_identifier(book_id, bookfusion_id, confirmed)
+        UploadManager.write_identifier(self, book_id, bookfusion_id)
+
+    def save_metrics(self, canceled=False):
+        if self.metrics is not None:
+            violations = self.invariants.check_complete(canceled)
+            for violation in violations:
+                self.logger.info('Invariant violated: {}'.format(violation))
+            self.metrics.record_faults(str(self.profile), self.network.injected, violations)
+        UploadManager.save_metrics(self, canceled)
+
+
+def run_profile(template_path, spec, seed, latency_ms, deadline):
+    profile = FaultProfile.parse(spec, seed)
+    library_path = copy_library(template_path)
+    stub = StubApi(seed=seed).start()
+    stub.latency = profile.rates.get('latency', 0)
+    stub.latency_ms = latency_ms
+    try:
+        use_stub(stub, request_timeout=TIMEOUT, stall_timeout=TIMEOUT, update_metadata=False, trace=False)
+        legacy_db, sync = open_sync(library_path, manager_class=SoakManager, profile=profile, stub=stub)
+        sync.logger.info('Start soak: faults={}; seed={}'.format(profile, seed))
+        finished = sync.run(deadline)
+        if not finished and sync.manager is not None:
+            sync.manager.cancel()
+        legacy_db.close()
+    finally:
+        stub.stop()
+        shutil.rmtree(library_path)
+
+    faults = sync.manager.metrics.faults if sync.manager and sync.manager.metrics else None
+    violations = list(faults['violations']) if faults else []
+    if not finished:
+        violations.append('the run did not terminate within {}s'.format(deadline))
+    elif sync.error:
+        violations.append('the run aborted: {}'.format(sync.error))
+
+    print('{}:'.format(profile))
+    print('  {}'.format(sync.summary()))
+    if finished:
+        print('  {:.1f}s, {:.1f} books/s, {:.0f} KB/s'.format(
+            sync.elapsed, sum(sync.counts.values()) / sync.elapsed, stub.received / 1024 / sync.elapsed
+        ))
+    injected = dict(faults['injected'] if faults else {})
+    if stub.delayed:
+        injected['latency'] = stub.delayed
+    print('  faults injected: {}'.format(injected))
+    for violation in violations:
+        print('  invariant violated: {}'.format(violation))
+    return not violations
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ['--']:
+        args = args[1:]
+
+    parser = ArgumentParser(prog='calibre-debug tools/soak.py --')
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=16384, help='size of each book file in bytes')
+    parser.add_argument('--seed', type=int, default=1, help='makes the sequence of faults repeatable')
+    parser.add_argument('--latency-ms', type=int, default=2000, help='delay of a latency spike')
+    parser.add_argument('--deadline', type=int, default=1800, help='seconds each run may take')
+    parser.add_argument('profiles', nargs='+', help='e.g. drop=0.02,server_error=0.05,latency=0.05')
+    args = parser.parse_args(args)
+
+    # Profiles are parsed up front so a typo does not wait for the library.
+    for spec in args.profiles:
+        FaultProfile.parse(spec)
+
+    template_path = tempfile.mkdtemp(prefix='bookfusion_soak_')
+    try:
+        print('Creating {} books...'.format(args.books))
+        make_library(template_path, args.books, args.size)
+        results = [
+            run_profile(template_path, spec, args.seed, args.latency_ms, args.deadline) for spec in args.profiles
+        ]
+    finally:
+        shutil.rmtree(template_path)
+
+    sys.exit(0 if all(results) else 1)
+
+
+main()
@@ -0,0 +1,454 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+# Local stand-in for the BookFusion API, for the checks in tools/ to run real
+# syncs without the real server. It keeps the books uploaded to it in memory
+# and answers the requests of the check, upload and update paths:
+#
+#   GET  /limits
+#   GET  /uploads?isbn=...             (never finds anything)
+#   GET  /uploads/<id or digest>
+#   POST /uploads/init                  (uploads go to POST /storage)
+#   POST /uploads/finalize
+#   PUT  /uploads/<id>
+#   POST /uploads/batch_update          (unless batch_update is False)
+#   GET  /uploads/<id>/signature        (with keep_files)
+#   PUT  /uploads/<id>/delta            (with keep_files)
+#
+# Uploads are checked against the digest given at init or finalize, and
+# refused with a 422 if it does not match. With digest_on_finalize in limits,
+# init does not need a digest, and a finalize whose digest matches a book the
+# stub has answers with that book instead of adding another one.
+#
+# With keep_files, the stub keeps the files of the books, answers with their
+# signature and applies deltas to them, see delta_upload.py. A delta whose
+# result does not match the digest sent with it is refused with a 422; the
+# first delta_conflicts deltas are answered with a 409, as if the file had
+# changed on the server since its signature was sent. Without keep_files both
+# answer with a 404.
+#
+# Faults are set per route, e.g. 'POST /uploads/init': hang holds the first
+# requests of a route without ever answering them, stall_body stops reading
+# their body, so the client's upload makes no more progress. Batch updates of
+# the books in rejected get a 422 result; the first failed_batches batches
+# fail as a whole with a 500. A latency share of all requests is answered
+# latency_ms late, as in a latency spike.
+#
+# Checks are answered with an ETag and a Last-Modified, and with an empty 304
+# when the If-None-Match or If-Modified-Since they were sent with still matches
+# the book.
+#
+# Runs in threads of its own; point prefs['api_base'] at url.
+
+from email.parser import BytesParser
+from email.policy import HTTP
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from threading import Event, Lock, Thread
+from urllib.parse import urlsplit
+import json
+import re
+import struct
+import uuid
+
+
+SIGNATURE_BLOCK_SIZE = 4096
+
+# Every change to a book moves its Last-Modified a second on from this time,
+# so that no two versions of a book share one.
+EPOCH = 1767225600
+
+
+def book_digest(data):
+    # The digest the plugin computes for a book file, see hashing_file.py.
+    h = sha256()
+    zeros = bytes(65536)
+    count = len(data) + 1
+    while count > 0:
+        h.update(zeros[:min(count, len(zeros))])
+        count -= len(zeros)
+    h.update(data)
+    return h.hexdigest()
+
+
+def signature(data, block_size):
+    # Weak rsync checksum and shortened SHA-256 of every whole block.
+    blocks = []
+    for offset in range(0, len(data) - block_size + 1, block_size):
+        block = data[offset:offset + block_size]
+        a = sum(block) & 0xffff
+        b = sum((block_size - i) * byte for i, byte in enumerate(block)) & 0xffff
+        blocks.append([a | (b << 16), sha256(block).hexdigest()[:16]])
+    return {'block_size': block_size, 'blocks': blocks}
+
+
+def apply_delta(old, delta, block_size):
+    # Raises ValueError for a delta that does not fit old.
+    out = bytearray()
+    pos = 0
+    while pos < len(delta):
+        kind = delta[pos:pos + 1]
+        if kind == b'C':
+            start, count = struct.unpack('>II', delta[pos + 1:pos + 9])
+            if (start + count) * block_size > len(old):
+                raise ValueError('Copy past the end: {}+{}'.format(start, count))
+            out += old[start * block_size:(start + count) * block_size]
+            pos += 9
+        elif kind == b'D':
+            length, = struct.unpack('>I', delta[pos + 1:pos + 5])
+            out += delta[pos + 5:pos + 5 + length]
+            pos += 5 + length
+        else:
+            raise ValueError('Unknown record: {!r}'.format(kind))
+    return bytes(out)
+
+
+class StubApi:
+    def __init__(self, limits=None, seed=None):
+        self.limits = {'filesize': 100 * 1048576, 'total_books': 0, 'message': ''}
+        self.limits.update(limits or {})
+
+        self.lock = Lock()
+        self.books = {}
+        self.next_id = 1
+        self.counts = {}
+        self.hang = {}
+        self.stall_body = {}
+        self.batch_update = True
+        self.rejected = set()
+        self.failed_batches = 0
+        self.latency = 0
+        self.latency_ms = 2000
+        self.delayed = 0
+        self.random = Random(seed)
+        self.received = 0
+        self.uploads = {}
+        self.keep_files = False
+        self.delta_conflicts = 0
+        self.delta_mismatches = 0
+        self.version = 0
+        self.not_modified = 0
+        self.stopped = Event()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        # Lets go of requests held by a fault.
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_book(self, digest, metadata_digest=None, data=None):
+        # A book already on the server; returns its id.
+        with self.lock:
+            bookfusion_id = str(self.next_id)
+            self.next_id += 1
+            self.books[bookfusion_id] = {
+                'digest': digest, 'calibre_metadata_digest': metadata_digest,
+                'data': data if self.keep_files else None
+            }
+            self.touch(self.books[bookfusion_id])
+            return bookfusion_id
+
+    def touch(self, book):
+        # Marks book as changed; called with the lock held.
+        self.version += 1
+        book['modified'] = EPOCH + self.version
+
+    def count(self, route):
+        with self.lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+    def take_fault(self, faults, route):
+        # Whether this request of route gets the fault.
+        with self.lock:
+            if faults.get(route, 0) > 0:
+                faults[route] -= 1
+                return True
+            return False
+
+    def take_latency(self):
+        # Seconds this request is held before it is answered.
+        with self.lock:
+            if self.random.random() >= self.latency:
+                return 0
+            self.delayed += 1
+            return self.latency_ms / 1000
+
+    def find(self, key):
+        with self.lock:
+            if key in self.books:
+                return key, self.books[key]
+            for bookfusion_id, book in self.books.items():
+                if book['digest'] == key:
+                    return bookfusion_id, book
+            return None, None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [
+        ('GET', r'/limits', 'limits'),
+        ('GET', r'/uploads', 'search'),
+        ('GET', r'/uploads/([^/]+)/signature', 'signature'),
+        ('GET', r'/uploads/([^/]+)', 'check'),
+        ('POST', r'/uploads/init', 'init'),
+        ('POST', r'/storage', 'storage'),
+        ('POST', r'/uploads/finalize', 'finalize'),
+        ('PUT', r'/uploads/([^/]+)/delta', 'delta'),
+        ('PUT', r'/uploads/([^/]+)', 'update'),
+        ('POST', r'/uploads/batch_update', 'batch_update'),
+    ]
+
+    @property
+    def stub(self):
+        return self.server.stub
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        for route_method, pattern, name in self.ROUTES:
+            match = re.fullmatch(pattern, url.path) if route_method == method else None
+            if match:
+                break
+        else:
+            self.read_body()
+            self.respond(404, {'error': 'Not found'})
+            return
+
+        route = '{} {}'.format(method, pattern.replace('([^/]+)', '<id>'))
+        self.stub.count(route)
+
+        if self.stub.take_fault(self.stub.stall_body, route):
+            self.stub.stopped.wait()
+            self.close_connection = True
+            return
+        body = self.read_body()
+        if self.stub.take_fault(self.stub.hang, route):
+            self.stub.stopped.wait()
+            self.close_connection = True
+            return
+        delay = self.stub.take_latency()
+        if delay:
+            self.stub.stopped.wait(delay)
+
+        getattr(self, 'handle_' + name)(match.group(1) if match.groups() else None, body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def parts(self, body):
+        message = BytesParser(policy=HTTP).parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode('ascii') + b'\r\n\r\n' + body
+        )
+        for part in message.iter_parts():
+            yield part.get_param('name', header='content-disposition'), part
+
+    def fields(self, body):
+        # The text parts of a multipart/form-data body.
+        fields = {}
+        for name, part in self.parts(body):
+            if part.get_filename() is None:
+                fields.setdefault(name, []).append(part.get_payload(decode=True).decode('utf-8'))
+        return fields
+
+    def files(self, body):
+        # The file parts of a multipart/form-data body.
+        return dict(
+            (name, part.get_payload(decode=True)) for name, part in self.parts(body) if part.get_filename() is not None
+        )
+
+    def respond(self, status, data=None, headers=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        if data is not None:
+            self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_limits(self, key, body):
+        self.respond(200, self.stub.limits)
+
+    def handle_search(self, key, body):
+        self.respond(200, [])
+
+    def handle_check(self, key, body):
+        bookfusion_id, book = self.stub.find(key)
+        if book is None:
+            self.respond(404, {'error': 'Not found'})
+            return
+
+        with self.stub.lock:
+            data = {'id': bookfusion_id, 'calibre_metadata_digest': book['calibre_metadata_digest']}
+            modified = book['modified']
+        headers = {
+            'ETag': '"{}"'.format(sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:16]),
+            'Last-Modified': formatdate(modified, usegmt=True)
+        }
+        if self.not_modified(headers['ETag'], modified):
+            with self.stub.lock:
+                self.stub.not_modified += 1
+            self.respond(304, headers=headers)
+        else:
+            self.respond(200, data, headers)
+
+    def not_modified(self, etag, modified):
+        # If-None-Match wins over If-Modified-Since, as with any HTTP server.
+        if self.headers.get('If-None-Match'):
+            return etag in [tag.strip() for tag in self.headers['If-None-Match'].split(',')]
+        if self.headers.get('If-Modified-Since'):
+            try:
+                return parsedate_to_datetime(self.headers['If-Modified-Since']).timestamp() >= modified
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def handle_init(self, key, body):
+        fields = self.fields(body)
+        if 'digest' not in fields and not self.stub.limits.get('digest_on_finalize'):
+            self.respond(422, {'error': 'Digest is missing'})
+            return
+        self.respond(200, {'url': self.stub.url + '/storage', 'params': {'key': uuid.uuid4().hex}})
+
+    def handle_storage(self, key, body):
+        fields = self.fields(body)
+        data = self.files(body).get('file', b'')
+        with self.stub.lock:
+            self.stub.received += len(body)
+            self.stub.uploads[fields['key'][0]] = (book_digest(data), data)
+        self.respond(204)
+
+    def handle_finalize(self, key, body):
+        fields = self.fields(body)
+        digest = fields['digest'][0]
+        with self.stub.lock:
+            uploaded_digest, data = self.stub.uploads.pop(fields['key'][0], (None, None))
+        if uploaded_digest != digest:
+            self.respond(422, {'error': 'Digest mismatch'})
+            return
+
+        bookfusion_id = None
+        if self.stub.limits.get('digest_on_finalize'):
+            bookfusion_id, book = self.stub.find(digest)
+        if bookfusion_id is None:
+            bookfusion_id = self.stub.add_book(
+                digest, fields.get('metadata[calibre_metadata_digest]', [None])[0], data
+            )
+        self.respond(200, {'id': bookfusion_id})
+
+    def handle_update(self, key, body):
+        bookfusion_id, book = self.stub.find(key)
+        if book is None:
+            self.respond(404, {'error': 'Not found'})
+            return
+
+        fields = self.fields(body)
+        data = self.files(body).get('file')
+        with self.stub.lock:
+            book['calibre_metadata_digest'] = fields.get('metadata[calibre_metadata_digest]', [None])[0]
+            self.stub.touch(book)
+            if data is not None:
+                self.stub.received += len(body)
+                book['digest'] = book_digest(data)
+                book['data'] = data if self.stub.keep_files else None
+        self.respond(200, {'id': bookfusion_id})
+
+    def handle_signature(self, key, body):
+        bookfusion_id, book = self.stub.find(key)
+        if book is None or book['data'] is None:
+            self.respond(404, {'error': 'Not found'})
+            return
+        self.respond(200, signature(book['data'], SIGNATURE_BLOCK_SIZE))
+
+    def handle_delta(self, key, body):
+        bookfusion_id, book = self.stub.find(key)
+        if book is None or book['data'] is None:
+            self.respond(404, {'error': 'Not found'})
+            return
+        with self.stub.lock:
+            conflict = self.stub.delta_conflicts > 0
+            if conflict:
+                self.stub.delta_conflicts -= 1
+        if conflict:
+            self.respond(409, {'error': 'The file changed since its signature'})
+            return
+
+        fields = self.fields(body)
+        try:
+            data = apply_delta(book['data'], self.files(body).get('delta', b''), SIGNATURE_BLOCK_SIZE)
+        except (ValueError, struct.error) as e:
+            data = None
+            error = str(e)
+        if data is not None and book_digest(data) != fields['digest'][0]:
+            data = None
+            error = 'Digest mismatch'
+        if data is None:
+            with self.stub.lock:
+                self.stub.delta_mismatches += 1
+            self.respond(422, {'error': error})
+            return
+
+        with self.stub.lock:
+            self.stub.received += len(body)
+            book['digest'] = fields['digest'][0]
+            book['data'] = data
+            book['calibre_metadata_digest'] = fields.get('metadata[calibre_metadata_digest]', [None])[0]
+            self.stub.touch(book)
+        self.respond(200, {'id': bookfusion_id})
+
+    def handle_batch_update(self, key, body):
+        if not self.stub.batch_update:
+            self.respond(404, {'error': 'Not found'})
+            return
+        with self.stub.lock:
+            fail = self.stub.failed_batches > 0
+            if fail:
+                self.stub.failed_batches -= 1
+        if fail:
+            self.respond(500, {'error': 'Internal server error'})
+            return
+
+        fields = self.fields(body)
+        results = []
+        index = 0
+        while 'updates[{}][id]'.format(index) in fields:
+            prefix = 'updates[{}]'.format(index)
+            bookfusion_id, book = self.stub.find(fields[prefix + '[id]'][0])
+            if book is None:
+                results.append({'id': fields[prefix + '[id]'][0], 'status': 404, 'error': 'Not found'})
+            elif bookfusion_id in self.stub.rejected:
+                results.append({'id': bookfusion_id, 'status': 422, 'error': 'Title is invalid'})
+            else:
+                with self.stub.lock:
+                    book['calibre_metadata_digest'] = fields.get(
+                        prefix + '[metadata][calibre_metadata_digest]', [None]
+                    )[0]
+                    self.stub.touch(book)
+                results.append({'id': bookfusion_id, 'status': 200})
+            index += 1
+        self.respond(200, {'results': results})
@@ -4,7 +4,6 @@ __license__ = 'GPL v3'
 from PyQt5.Qt import QMenu
 
 from calibre.gui2.actions import InterfaceAction
-from calibre_plugins.bookfusion.main import MainDialog
 
 
 class InterfacePlugin(InterfaceAction):
@@ -14,6 +13,9 @@ class InterfacePlugin(InterfaceAction):
                    'Sync your books to the BookFusion platform', None)
 
     def genesis(self):
+        self.dialog = None
+        self.service = None
+
         self.sync_selected_action = self.create_action(
             spec=('Sync selected books', None, None, None),
             attr='Sync selected books'
@@ -26,9 +28,16 @@ class InterfacePlugin(InterfaceAction):
         )
         self.sync_all_action.triggered.connect(self.sync_all)
 
+        self.retry_failed_action = self.create_action(
+            spec=('Retry failed books', None, None, None),
+            attr='Retry failed books'
+        )
+        self.retry_failed_action.triggered.connect(self.retry_failed)
+
         self.menu = QMenu(self.gui)
         self.menu.addAction(self.sync_selected_action)
         self.menu.addAction(self.sync_all_action)
+        self.menu.addAction(self.retry_failed_action)
         self.menu.aboutToShow.connect(self.update_menu)
 
         self.qaction.setMenu(self.menu)
@@ -41,20 +50,88 @@ class InterfacePlugin(InterfaceAction):
     def sync_selected(self):
         self.show_dialog()
 
-    def show_dialog(self, is_sync_selected=True):
+    def retry_failed(self):
+        book_ids = self.failed_book_ids()
+        if len(book_ids) > 0:
+            self.show_dialog(book_ids=book_ids)
+
+    def sync_service(self):
+        # Created on first use, and kept for the rest of the calibre session.
+        if self.service is None:
+            from calibre_plugins.bookfusion.sync_service import SyncService
+            self.service = SyncService(self.gui)
+        return self.service
+
+    def sync_books(self, book_ids):
+        # For other plugins: syncs books of the current library in the
+        # background, e.g.
+        #
+        #   self.gui.iactions['BookFusion Plugin'].sync_books(book_ids)
+        #
+        # Returns False if the plugin is not configured yet.
+        return self.sync_service().sync_books(book_ids)
+
+    def failed_book_ids(self):
+        # Books recorded as failed by earlier syncs of the current library
+        # that are still in it.
+        from calibre_plugins.bookfusion.failed_queue import FailedQueue
+
+        db = self.gui.current_db
+        all_book_ids = db.new_api.all_book_ids()
+        return [book_id for book_id in FailedQueue(db.library_path).book_ids() if book_id in all_book_ids]
+
+    def show_dialog(self, is_sync_selected=True, book_ids=None):
+        # Imported here rather than at module level so that the sync engine
+        # (network, hashing, workers) is only loaded once the user actually
+        # opens the dialog, keeping it out of calibre's startup path.
+        from calibre_plugins.bookfusion.main import MainDialog
+
         base_plugin_object = self.interface_action_base_plugin
         do_user_config = base_plugin_object.do_user_config
 
-        rows = self.gui.library_view.selectionModel().selectedRows()
-        selected_book_ids = []
-        for row in rows:
-            selected_book_ids.append(self.gui.library_view.model().db.id(row.row()))
-
-        MainDialog(self.gui, do_user_config, selected_book_ids, is_sync_selected).show()
+        if book_ids is None:
+            selected_book_ids = list(self.gui.library_view.get_selected_ids())
+        else:
+            selected_book_ids = book_ids
+
+        # While a sync is running, syncing selected books pushes them to the
+        # front of its queue instead of opening a second dialog.
+        if self.dialog is not None and self.dialog.isVisible() and self.dialog.sync.is_syncing():
+            if is_sync_selected and len(selected_book_ids) > 0:
+                self.dialog.sync.enqueue(selected_book_ids)
+            self.dialog.raise_()
+            self.dialog.activateWindow()
+            return
+
+        service = self.sync_service()
+        self.dialog = MainDialog(self.gui, do_user_config, selected_book_ids, is_sync_selected, service)
+
+        # A sync going on in the background is shown instead, with the books
+        # selected meanwhile added to it; one still being checked is shown once
+        # it starts.
+        if service.is_running():
+            if is_sync_selected and len(selected_book_ids) > 0:
+                service.sync_books(selected_book_ids)
+            if service.manager is not None:
+                self.dialog.sync.attach_run(service.manager)
+            else:
+                self.dialog.sync.wait_for_run()
+
+        self.dialog.show()
 
     def update_menu(self):
-        rows = self.gui.library_view.selectionModel().selectedRows()
-        self.sync_selected_action.setEnabled(len(rows) > 0)
+        self.sync_selected_action.setEnabled(self.gui.library_view.selectionModel().hasSelection())
+        self.retry_failed_action.setEnabled(len(self.failed_book_ids()) > 0)
+
+    def library_changed(self, db):
+        # A sync cannot go on once calibre has closed its library.
+        if self.service is not None:
+            self.service.cancel()
+
+    def shutting_down(self):
+        if self.service is not None:
+            self.service.shutdown()
+        return True
 
     def apply_settings(self):
         None
@@ -0,0 +1,182 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QObject, QTimer, pyqtSignal, QNetworkReply, QFile, QIODeviceBase
+from time import monotonic
+import json
+
+from calibre_plugins.bookfusion.config import prefs
+from calibre_plugins.bookfusion import api
+from calibre_plugins.bookfusion.failed_queue import FailedQueue
+from calibre_plugins.bookfusion.multipart_body import MultipartBody
+from calibre_plugins.bookfusion.reply_timeout import ReplyTimeout
+
+
+def nested_name(prefix, name):
+    # nested_name('updates[0]', 'metadata[title]') == 'updates[0][metadata][title]'
+    head, sep, rest = name.partition('[')
+    return '{}[{}]{}{}'.format(prefix, head, sep, rest)
+
+
+# Metadata-only updates of a run, sent to the server size books at a time with
+# one POST to /uploads/batch_update rather than one PUT per book. Used when
+# the server lists batch_update, the most books it takes at once, in its
+# limits.
+#
+# Workers hand their books over with add() and go on to the next one. A batch
+# is sent once it is full, or when no book was added for FLUSH_DELAY seconds.
+# The response holds a result per book:
+#
+#   {"results": [{"id": "<bookfusion id>", "status": 200}, ...]}
+#
+# Books the server rejected as invalid fail as they would on their own; any
+# other book of the batch is handed back with fallback to be updated by
+# itself, and so are all books of a batch that failed as a whole. A server
+# without the endpoint turns batching off for the rest of the run.
+class UpdateBatch(QObject):
+    updated = pyqtSignal(int)
+    failed = pyqtSignal(int, str, str)
+    fallback = pyqtSignal(int)
+    drained = pyqtSignal()
+    aborted = pyqtSignal(str)
+
+    FLUSH_DELAY = 2
+
+    DISABLE_ERRORS = [
+        QNetworkReply.NetworkError.ContentNotFoundError,
+        QNetworkReply.NetworkError.ContentOperationNotPermittedError,
+        QNetworkReply.NetworkError.OperationNotImplementedError
+    ]
+
+    def __init__(self, manager, size):
+        QObject.__init__(self, manager)
+
+        self.size = size
+        self.logger = manager.logger
+        self.network = manager.network
+        self.stages = manager.stages
+        self.metrics = manager.metrics
+        self.throughput = manager.throughput
+        self.enabled = True
+        self.canceled = False
+        self.books = []
+        self.replies = set()
+        self.sending = 0
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+    def add(self, book_id, bookfusion_id, parts, cover_path):
+        # parts are the (name, value) pairs of the book's metadata; the cover
+        # file is removed once the batch has been sent.
+        self.books.append((book_id, bookfusion_id, parts, cover_path))
+        if len(self.books) >= self.size:
+            self.flush()
+        else:
+            self.timer.start(self.FLUSH_DELAY * 1000)
+
+    def is_empty(self):
+        return not self.books and not self.sending
+
+    def flush(self):
+        self.timer.stop()
+        while self.books and not self.canceled:
+            books, self.books = self.books[:self.size], self.books[self.size:]
+            self.sending += 1
+            self.stages.api.acquire(lambda books=books: self.send(books))
+
+    def send(self, books):
+        if self.canceled:
+            self.stages.api.release()
+            self.sending -= 1
+            self.remove_covers(books)
+            return
+
+        req = api.build_request('/uploads/batch_update')
+        body = MultipartBody()
+        for index, (book_id, bookfusion_id, parts, cover_path) in enumerate(books):
+            prefix = 'updates[{}]'.format(index)
+            body.add_part(nested_name(prefix, 'id'), bookfusion_id)
+            for name, value in parts:
+                body.add_part(nested_name(prefix, name), value)
+            if cover_path:
+                cover = QFile(cover_path, body)
+                cover.open(QIODeviceBase.OpenModeFlag.ReadOnly)
+                body.add_part(nested_name(prefix, 'metadata[cover]'), cover)
+        body.prepare(req)
+
+        self.logger.info('Batch update: book_ids={}'.format([book[0] for book in books]))
+        started = monotonic()
+        reply = self.network.post(req, body)
+        body.setParent(reply)
+        timeout = ReplyTimeout(reply, prefs['request_timeout'], prefs['stall_timeout'])
+        self.replies.add(reply)
+        reply.finished.connect(lambda: self.complete(reply, timeout, books, started))
+
+    def complete(self, reply, timeout, books, started):
+        self.stages.api.release()
+        self.replies.discard(reply)
+        self.sending -= 1
+        self.remove_covers(books)
+        reply.deleteLater()
+
+        error = reply.error()
+        if timeout.reason is not None:
+            self.logger.info('Batch update: {} timeout'.format(timeout.reason))
+            error = QNetworkReply.NetworkError.TimeoutError
+
+        if error == QNetworkReply.NetworkError.NoError:
+            elapsed = monotonic() - started
+            self.metrics.record_latency('batch_update', elapsed)
+            self.throughput.record_request(elapsed)
+        else:
+            self.metrics.record_error(getattr(error, 'name', None) or str(error))
+
+        if self.canceled:
+            return
+
+        if error == QNetworkReply.NetworkError.AuthenticationRequiredError:
+            self.logger.info('Batch update: AuthenticationRequiredError')
+            self.aborted.emit('Invalid API key.')
+            return
+
+        results = None
+        if error == QNetworkReply.NetworkError.NoError:
+            resp = reply.readAll()
+            self.logger.info('Batch update response: {}'.format(resp))
+            try:
+                results = dict((str(result['id']), result) for result in json.loads(resp.data())['results'])
+            except (ValueError, KeyError, TypeError) as e:
+                self.logger.info('Batch update: {}'.format(e))
+        elif error in self.DISABLE_ERRORS:
+            self.logger.info('Batch update: {}, updating books one by one'.format(error))
+            self.enabled = False
+        else:
+            self.logger.info('Batch update: {}'.format(error))
+
+        for book_id, bookfusion_id, parts, cover_path in books:
+            result = results.get(bookfusion_id) if results is not None else None
+            status = result.get('status') if result is not None else None
+            if isinstance(status, int) and 200 <= status < 300:
+                self.updated.emit(book_id)
+            elif status == 422:
+                self.failed.emit(book_id, result.get('error') or 'Validation failed', FailedQueue.VALIDATION)
+            else:
+                self.fallback.emit(book_id)
+
+        if self.is_empty():
+            self.drained.emit()
+
+    def remove_covers(self, books):
+        for book_id, bookfusion_id, parts, cover_path in books:
+            if cover_path:
+                QFile.remove(cover_path)
+
+    def cancel(self):
+        self.canceled = True
+        self.timer.stop()
+        self.remove_covers(self.books)
+        self.books = []
+        for reply in list(self.replies):
+            reply.abort()
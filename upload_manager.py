@@ -1,86 +1,690 @@
 __copyright__ = '2020, BookFusion <legal@bookfusion.com>'
 __license__ = 'GPL v3'
 
-from PyQt5.Qt import QObject, pyqtSignal, QThread, QNetworkAccessManager
+from PyQt5.Qt import QObject, pyqtSignal, QThread, QTimer
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from os import path
+from os.path import getsize
+from time import monotonic
 
 from calibre_plugins.bookfusion.config import prefs
 from calibre_plugins.bookfusion.book_format import BookFormat
+from calibre_plugins.bookfusion.check_cache import CheckCache
+from calibre_plugins.bookfusion.failed_queue import FailedQueue
+from calibre_plugins.bookfusion.metrics import SyncMetrics
+from calibre_plugins.bookfusion.sync_plan import SyncPlan, Throughput
+from calibre_plugins.bookfusion.sync_queue import SyncQueue
+from calibre_plugins.bookfusion.sync_session import SyncSession
+from calibre_plugins.bookfusion.sync_stages import SyncStages
+from calibre_plugins.bookfusion.sync_trace import SyncTrace
+from calibre_plugins.bookfusion.update_batch import UpdateBatch
 from calibre_plugins.bookfusion.upload_worker import UploadWorker
 
 
 class UploadManager(QObject):
     finished = pyqtSignal()
-    readyForNext = pyqtSignal()
+    readyForNext = pyqtSignal(int)
+    enqueueRequested = pyqtSignal(list)
+    cancelRequested = pyqtSignal()
+    intakeRequested = pyqtSignal(list)
+    intakeClosed = pyqtSignal()
     progress = pyqtSignal(int)
     uploadProgress = pyqtSignal(int, int, int)
     started = pyqtSignal(int)
     uploaded = pyqtSignal(int)
     updated = pyqtSignal(int)
     skipped = pyqtSignal(int)
-    failed = pyqtSignal(int, str)
+    failed = pyqtSignal(int, str, str)
+    retryScheduled = pyqtSignal(int, str, int)
+    stalled = pyqtSignal(int, int)
+    duplicate = pyqtSignal(int, int, int)
+    planned = pyqtSignal(int, str)
+    planAvailable = pyqtSignal(object)
+    libraryFinished = pyqtSignal(str, str)
     aborted = pyqtSignal(str)
 
-    def __init__(self, db, logger, book_ids, reupload):
+    RECENT_INTERVAL = timedelta(days=1)
+
+    # How often the watchdog looks for workers that stopped making progress,
+    # and after how long without progress a worker is reported when no
+    # timeouts are configured.
+    WATCHDOG_INTERVAL = 30
+    STUCK_AFTER = 300
+
+    def __init__(self, db, logger, book_ids, reupload, limits, selected_book_ids=(), dry_run=False, plan=None,
+                 library_paths=(), streaming=False):
         QObject.__init__(self)
 
+        # Other threads cancel the run with cancelRequested, so it is
+        # canceled in the thread it runs in.
+        self.cancelRequested.connect(self.cancel)
+
         self.db = db
         self.logger = logger
         self.pending_book_ids = book_ids
+        self.selected_book_ids = set(selected_book_ids)
         self.reupload = reupload
+        self.limits = limits
+        self.digest_on_finalize = bool(limits.get('digest_on_finalize'))
+        self.delta_upload = bool(limits.get('delta_upload'))
+        self.disk_order = prefs['disk_order']
         self.canceled = False
+        self.done = False
         self.api_key = prefs['api_key']
 
-        self.finished_count = 0
+        self.queue = SyncQueue()
+        # Every book taken into the run, counted against the account's book
+        # limit when more are enqueued.
+        self.run_book_ids = set()
+        # Books of the other libraries synced alongside this one, counted
+        # against the same limit.
+        self.library_book_count = 0
+        self.idle = set()
+        self.holding = set()
         self.workers = []
+        self.digests = {}
+        self.formats = {}
+
+        # A streaming run starts with the first books a check found and is
+        # given the others with intakeRequested as the check goes on. It does
+        # not complete before intakeClosed.
+        self.intake_open = streaming
+
+        # Books to upload by file size, and digests of those with colliding
+        # sizes, for finding duplicates among books added later.
+        self.by_size = {}
+        self.size_digests = {}
+        # Sets of books waiting to be looked at for duplicates, with the
+        # callback each is handed on to; the first one is being hashed.
+        self.collapse_requests = deque()
+        self.colliding = []
+        self.collapse_started = None
+        self.unhashed = set()
+
+        # A dry run checks every book against the server and records what a
+        # real run would do in dry_run_plan. A real run given a plan trusts
+        # it instead of checking the books again.
+        self.dry_run = dry_run
+        self.dry_run_plan = SyncPlan(reupload) if dry_run else None
+        self.plan = plan
+        if plan is not None:
+            for book_id, entry in plan.books.items():
+                if entry['digest']:
+                    self.digests[book_id] = entry['digest']
+
+        # Other libraries synced alongside this one. They share this
+        # manager's network access manager, bandwidth limiter, worker budget
+        # and stages, so the configured thread counts apply to all of them.
+        self.library_paths = library_paths
+        self.libraries = []
+
+        # Number of managers, e.g. in separate processes, sharing the
+        # configured bandwidth limit.
+        self.bandwidth_shares = 1
+
+        # Given by the sync service to reuse its connections and caches,
+        # otherwise created by start().
+        self.session = None
+        self.network = None
+        self.limiter = None
+        self.budget = None
+        self.stages = None
+        self.isbn_cache = None
+        self.owns_stages = False
+        self.metrics = None
+        self.failures = None
+        self.check_cache = None
+
+        # Books failed with a transient error wait here until their retry is
+        # due. The run does not complete while any are waiting.
+        self.retry_counts = {}
+        self.deferred = set()
+
+        # Book each busy worker is syncing, watched for stalls.
+        self.active = {}
+        self.reported = set()
+        self.watchdog = None
+
+        # Timeline of the run, only kept if tracing is enabled. trace_pid
+        # tells the processes of a sharded sync apart.
+        self.trace = None
+        self.trace_pid = 0
+        self.queued_at = {}
+        self.active_since = {}
+
+        # Metadata-only updates sent in batches, if the server takes them.
+        # Books a batch handed back are updated one by one.
+        self.batch = None
+        self.unbatched = set()
 
     def start(self):
+        if self.session is None:
+            self.session = SyncSession(self, self.bandwidth_shares)
+            self.owns_stages = True
+        self.session.lend(self)
+
+        if self.library_paths:
+            from calibre_plugins.bookfusion.library_sync import LibrarySync
+
+        for library_path in self.library_paths:
+            library = LibrarySync(self, library_path)
+            library.finished.connect(self.finish_library)
+            self.libraries.append(library)
+            library.start()
+
+        self.run()
+
+    def run(self):
+        # Expects network, limiter, budget, stages and isbn_cache to be set.
         self.readyForNext.connect(self.sync)
+        self.enqueueRequested.connect(self.enqueue)
+        self.intakeRequested.connect(self.intake)
+        self.intakeClosed.connect(self.close_intake)
+
+        self.throughput = Throughput()
+        if prefs['trace']:
+            self.trace = SyncTrace(path.dirname(self.logger.path), self.trace_pid)
+        self.metrics = SyncMetrics(path.dirname(self.logger.path), SyncStages.worker_count(), self.dry_run)
+        self.check_cache = CheckCache(path.dirname(self.logger.path), self.api_key)
+        self.uploaded.connect(lambda book_id: self.metrics.count('uploaded'))
+        self.updated.connect(lambda book_id: self.metrics.count('updated'))
+        self.skipped.connect(lambda book_id: self.metrics.count('skipped'))
+        self.failed.connect(lambda book_id, msg, category: self.metrics.count('failed'))
+        self.duplicate.connect(lambda book_id, primary_id, size: self.metrics.count('duplicate'))
+
+        # A dry run does not sync anything, so it leaves the failed books as
+        # they are.
+        if not self.dry_run:
+            self.failures = FailedQueue(path.dirname(self.logger.path))
+            self.uploaded.connect(self.failures.resolve)
+            self.updated.connect(self.failures.resolve)
+            self.skipped.connect(self.failures.resolve)
+            self.failed.connect(self.record_failure)
+            self.uploaded.connect(self.forget_book)
+            self.updated.connect(self.forget_book)
+            self.skipped.connect(self.forget_book)
+
+        batch_size = self.limits.get('batch_update') or 0
+        if batch_size > 1 and not self.reupload and not self.dry_run and prefs['update_metadata']:
+            self.batch = UpdateBatch(self, batch_size)
+            self.batch.updated.connect(self.updated)
+            self.batch.failed.connect(self.failed)
+            self.batch.fallback.connect(self.unbatch)
+            self.batch.drained.connect(self.maybe_complete)
+            self.batch.aborted.connect(self.abort)
+
+        self.watchdog = QTimer(self)
+        self.watchdog.timeout.connect(self.check_workers)
+        self.watchdog.start(self.WATCHDOG_INTERVAL * 1000)
 
-        self.network = QNetworkAccessManager(self)
         self.count = 0
+        self.collapse_duplicates(self.pending_book_ids, self.start_workers)
+
+    def start_workers(self, book_ids):
+        # Once the duplicates among the books the run started with are known.
+        self.pending_book_ids = book_ids
+        self.push(book_ids)
 
-        for index in range(prefs['threads']):
-            worker = UploadWorker(index, self.reupload, self.db, self.logger, self.network)
+        for index in range(SyncStages.worker_count()):
+            worker = UploadWorker(index, self)
             worker.readyForNext.connect(self.sync)
             worker.uploadProgress.connect(self.uploadProgress)
             worker.uploaded.connect(self.uploaded)
             worker.updated.connect(self.updated)
             worker.skipped.connect(self.skipped)
             worker.failed.connect(self.failed)
+            worker.planned.connect(self.add_to_plan)
             worker.aborted.connect(self.abort)
             self.workers.append(worker)
+            if self.trace is not None:
+                self.trace.name_worker(index)
             self.logger.info('starting worker %s' % index)
             worker.start()
 
+    def collapse_duplicates(self, book_ids, callback):
+        # Books without a BookFusion id will be uploaded. If several of them
+        # share the same file, only the first one is kept in the queue and the
+        # others are reported as duplicates of it. Only files with colliding
+        # sizes are hashed, in the hash pool; their digests are reused by the
+        # workers. Books added to a streaming run are compared with the books
+        # before them too, so one set of books is looked at after the other.
+        # Calls callback with book_ids without the duplicates.
+        self.collapse_requests.append((book_ids, callback))
+        if len(self.collapse_requests) == 1:
+            self.find_duplicates()
+
+    def find_duplicates(self):
+        book_ids, callback = self.collapse_requests[0]
+        started = monotonic()
+        all_identifiers = self.db.all_field_for('identifiers', book_ids)
+
+        sizes = set()
+        for book_id in book_ids:
+            if all_identifiers[book_id].get('bookfusion'):
+                continue
+
+            book_format = BookFormat(self.db, book_id, prefs['preferred_format'])
+            if not book_format.file_path:
+                continue
+            try:
+                size = getsize(book_format.file_path)
+            except OSError:
+                # Left to the worker to report.
+                continue
+            self.by_size.setdefault(size, []).append((book_id, book_format.file_path, book_format.fmt))
+            sizes.add(size)
+
+        colliding = [
+            (book_id, file_path, size, fmt)
+            for size in sizes if len(self.by_size[size]) > 1
+            for book_id, file_path, fmt in self.by_size[size]
+        ]
+
+        # With disk order the files are read in the order of their folders;
+        # the books' own order still decides which one of a group is kept.
+        unhashed = {}
+        for book_id, file_path, size, fmt in sorted(colliding, key=lambda book: book[1]) if self.disk_order else colliding:
+            if book_id not in self.size_digests:
+                if self.digests.get(book_id):
+                    self.size_digests[book_id] = self.digests[book_id]
+                else:
+                    unhashed[book_id] = file_path
+
+        self.colliding = colliding
+        self.collapse_started = started
+        self.unhashed = set(unhashed)
+        if not unhashed:
+            self.finish_duplicates()
+            return
+
+        for book_id, file_path in unhashed.items():
+            self.stages.hashing.submit(file_path, lambda digest, book_id=book_id: self.add_size_digest(book_id, digest))
+
+    def add_size_digest(self, book_id, digest):
+        # A file that cannot be read is not a duplicate of anything.
+        if self.canceled:
+            return
+        self.size_digests[book_id] = digest
+        self.unhashed.discard(book_id)
+        if not self.unhashed:
+            self.finish_duplicates()
+
+    def finish_duplicates(self):
+        if self.canceled:
+            return
+
+        book_ids, callback = self.collapse_requests[0]
+        added_ids = set(book_ids)
+        groups = {}
+        for book_id, file_path, size, fmt in self.colliding:
+            digest = self.size_digests[book_id]
+            if digest is None:
+                continue
+            if book_id in added_ids:
+                self.digests[book_id] = digest
+            groups.setdefault(digest, []).append((book_id, size, fmt))
+
+        if self.trace is not None:
+            self.trace.span(SyncTrace.MANAGER, 'Find duplicates', self.collapse_started, books=len(book_ids))
+
+        duplicate_ids = set()
+        bytes_saved = 0
+        for digest, books in groups.items():
+            if len(books) < 2:
+                continue
+
+            primary_id = books[0][0]
+            self.logger.info('Duplicate files: digest={}; book_ids={}'.format(digest, [b[0] for b in books]))
+            for book_id, size, fmt in books[1:]:
+                # Books added before were reported already.
+                if book_id not in added_ids:
+                    continue
+                duplicate_ids.add(book_id)
+                bytes_saved += size
+                if self.dry_run:
+                    self.dry_run_plan.add(book_id, SyncPlan.DUPLICATE, fmt, size, digest=digest)
+                self.duplicate.emit(book_id, primary_id, size)
+
+        if duplicate_ids:
+            self.logger.info('Duplicate files: books={}; bytes_saved={}'.format(len(duplicate_ids), bytes_saved))
+            book_ids = [book_id for book_id in book_ids if book_id not in duplicate_ids]
+
+        callback(book_ids)
+        self.collapse_requests.popleft()
+        if self.collapse_requests:
+            self.find_duplicates()
+        else:
+            self.maybe_complete()
+
     def cancel(self):
+        # Only the first call of a run that has not finished yet counts.
+        if self.canceled or self.is_finished():
+            return
+
         self.canceled = True
+        if self.budget:
+            # The budget is kept for the next run, so the slots of workers
+            # that will not ask for another book are given back here.
+            self.budget.cancel(self)
+            for index in self.holding:
+                self.budget.release()
+            self.holding.clear()
         for worker in self.workers:
             worker.cancel()
+        if self.batch is not None:
+            self.batch.cancel()
+        for library in self.libraries:
+            library.cancel()
+        self.save_trace()
+        self.save_metrics(canceled=True)
+        self.save_failures()
+        self.save_check_cache()
+        self.close_stages()
         self.finished.emit()
 
+    def push(self, book_ids, priority=None):
+        # Selected books go first, then books modified recently, then books
+        # already on BookFusion (metadata updates or skips), then new uploads.
+        # With disk order, books of the same priority are synced in the order
+        # of their folders in the library, so book files are read with as few
+        # seeks as possible.
+        all_identifiers = self.db.all_field_for('identifiers', book_ids)
+        all_last_modified = self.db.all_field_for('last_modified', book_ids)
+        all_paths = self.db.all_field_for('path', book_ids) if self.disk_order else {}
+        recent = datetime.now(timezone.utc) - self.RECENT_INTERVAL
+
+        self.run_book_ids.update(book_ids)
+        for book_id in book_ids:
+            if priority is not None:
+                book_priority = priority
+            elif book_id in self.selected_book_ids:
+                book_priority = SyncQueue.SELECTED
+            elif all_last_modified[book_id] and all_last_modified[book_id] >= recent:
+                book_priority = SyncQueue.RECENT
+            elif all_identifiers[book_id].get('bookfusion'):
+                book_priority = SyncQueue.UPDATE
+            else:
+                book_priority = SyncQueue.UPLOAD
+            self.queue.push(book_id, book_priority, all_paths.get(book_id))
+            if self.trace is not None:
+                self.queued_at[book_id] = (monotonic(), book_priority)
+
+    def enqueue(self, book_ids):
+        # Adds books to a running sync ahead of the books already queued.
+        if self.done or self.canceled:
+            return
+
+        self.logger.info('Enqueue books: book_ids={}'.format(book_ids))
+
+        # These books did not go through CheckWorker, so the account limits
+        # are applied here. Books past the book limit are left out, as they
+        # are at the start of a run.
+        book_ids = self.within_total_books(book_ids)
+        valid_ids = []
+        for book_id in book_ids:
+            book_format = BookFormat(self.db, book_id, prefs['preferred_format'])
+            try:
+                size = getsize(book_format.file_path) if book_format.file_path else 0
+            except OSError:
+                # Left to the worker to report.
+                size = 0
+            if size > self.limits['filesize']:
+                self.failed.emit(book_id, 'filesize exceeded', FailedQueue.FILESIZE)
+            else:
+                valid_ids.append(book_id)
+        self.push(valid_ids, SyncQueue.SELECTED)
+        self.wake_idle()
+
+    def within_total_books(self, book_ids):
+        total_books = self.limits['total_books']
+        if not total_books:
+            return book_ids
+
+        room = max(0, total_books - len(self.run_book_ids) - self.library_book_count)
+        new_ids = [book_id for book_id in book_ids if book_id not in self.run_book_ids]
+        left_out = set(new_ids[room:])
+        if left_out:
+            self.logger.info('Total books exceeded: book_ids={}'.format(sorted(left_out)))
+        return [book_id for book_id in book_ids if book_id not in left_out]
+
+    def take_library_books(self, book_ids):
+        # The books of another library synced alongside this one that are
+        # within what is left of the account's book limit, which are then
+        # counted against it.
+        total_books = self.limits['total_books']
+        if total_books:
+            book_ids = book_ids[:max(0, total_books - len(self.run_book_ids) - self.library_book_count)]
+        self.library_book_count += len(book_ids)
+        return book_ids
+
+    def intake(self, book_ids):
+        # More books found by the check of a streaming run, queued as they
+        # would have been at the start.
+        if self.done or self.canceled:
+            return
+
+        self.logger.info('Intake books: book_ids={}'.format(book_ids))
+        book_ids = self.within_total_books(book_ids)
+        self.collapse_duplicates(book_ids, self.take_intake)
+
+    def take_intake(self, book_ids):
+        if self.done or self.canceled:
+            return
+        self.push(book_ids)
+        self.wake_idle()
+
+    def close_intake(self):
+        self.logger.info('Intake closed')
+        self.intake_open = False
+        self.maybe_complete()
+
+    def wake_idle(self):
+        for index in sorted(self.idle):
+            if len(self.queue) == 0:
+                break
+            self.idle.discard(index)
+            self.sync(index)
+
     def sync(self, index):
-        if len(self.pending_book_ids) == 0:
-            self.finished_count += 1
-            if self.finished_count == len(self.workers):
-                self.finished.emit()
+        # Worker index is ready for its next book.
+        book_id = self.active.pop(index, None)
+        if self.trace is not None and book_id is not None:
+            self.trace.span(SyncTrace.worker_tid(index), 'Book', self.active_since.pop(index), book_id=book_id)
+
+        if index in self.holding:
+            self.holding.remove(index)
+            self.budget.release()
+
+        if self.canceled:
+            return
+
+        if len(self.queue) == 0:
+            self.go_idle(index)
+        elif self.budget.acquire(self, index):
+            self.sync_next(index)
+
+    def resume(self, index):
+        # The budget handed a slot over to worker index.
+        if self.canceled or len(self.queue) == 0:
+            self.budget.release()
+            if not self.canceled:
+                self.go_idle(index)
+        else:
+            self.sync_next(index)
+
+    def go_idle(self, index):
+        self.idle.add(index)
+        self.maybe_complete()
+
+    def maybe_complete(self):
+        # Books still in a batch are sent before the run completes.
+        if len(self.idle) < len(self.workers) or self.deferred or self.intake_open or self.collapse_requests or \
+                self.done or self.canceled:
             return
+        if self.batch is not None and not self.batch.is_empty():
+            self.batch.flush()
+            return
+        self.done = True
+        self.complete()
+
+    def unbatch(self, book_id):
+        self.logger.info('Update book by itself: book_id={}'.format(book_id))
+        self.unbatched.add(book_id)
+        self.push([book_id], SyncQueue.UPDATE)
+        self.wake_idle()
+
+    def sync_next(self, index):
+        self.holding.add(index)
 
-        self.progress.emit(self.count)
-        self.count += 1
+        book_id = self.queue.pop()
+
+        if self.trace is not None and book_id in self.queued_at:
+            queued_at, priority = self.queued_at.pop(book_id)
+            self.trace.async_span('Queue wait', book_id, queued_at, book_id=book_id, priority=priority)
+
+        # Retried books were already counted on their first attempt, and so
+        # were books handed back by a batch.
+        if book_id not in self.retry_counts and book_id not in self.unbatched:
+            self.progress.emit(self.count)
+            self.count += 1
 
-        book_id = self.pending_book_ids.pop()
         self.logger.info('Upload book: book_id={}; title={}'.format(book_id, self.db.get_proxy_metadata(book_id).title))
 
         book_format = BookFormat(self.db, book_id, prefs['preferred_format'])
 
         if book_format.file_path:
+            self.formats[book_id] = book_format.fmt
             self.started.emit(book_id)
             worker = self.workers[index]
+            self.active[index] = book_id
+            self.active_since[index] = monotonic()
             worker.syncRequested.emit(book_id, book_format.file_path)
         else:
-            self.failed.emit(book_id, 'unsupported format')
+            self.failed.emit(book_id, 'unsupported format', FailedQueue.FORMAT)
             self.readyForNext.emit(index)
 
+    def check_workers(self):
+        # Timeouts abort stuck requests; this catches workers stuck anywhere
+        # else, and reports each stall once.
+        if self.canceled or self.done:
+            return
+
+        stuck_after = 2 * max(prefs['request_timeout'], prefs['stall_timeout']) or self.STUCK_AFTER
+        now = monotonic()
+        for index, book_id in self.active.items():
+            # Waiting for a stage slot or a digest is not being stuck.
+            if self.workers[index].waiting:
+                continue
+            seconds = int(now - self.workers[index].last_activity)
+            if seconds >= stuck_after and (index, book_id) not in self.reported:
+                self.reported.add((index, book_id))
+                self.logger.info('Worker stuck: worker={}; book_id={}; seconds={}'.format(index, book_id, seconds))
+                self.stalled.emit(book_id, seconds)
+
+    def record_failure(self, book_id, msg, category):
+        self.failures.record(book_id, msg, category)
+
+        retries = self.retry_counts.get(book_id, 0)
+        if self.canceled or not FailedQueue.is_transient(category) or retries >= FailedQueue.MAX_RETRIES:
+            return
+
+        delay = FailedQueue.retry_delay(retries)
+        self.retry_counts[book_id] = retries + 1
+        self.deferred.add(book_id)
+        self.logger.info('Retry book later: book_id={}; delay={}s'.format(book_id, delay))
+        self.retryScheduled.emit(book_id, msg, delay)
+        QTimer.singleShot(delay * 1000, lambda: self.retry(book_id))
+
+    def forget_book(self, book_id):
+        # Nothing about a synced book is needed for the rest of the run.
+        self.digests.pop(book_id, None)
+        self.formats.pop(book_id, None)
+        self.retry_counts.pop(book_id, None)
+        self.unbatched.discard(book_id)
+
+    def retry(self, book_id):
+        self.deferred.discard(book_id)
+        if self.canceled or self.done:
+            return
+
+        self.logger.info('Retry book: book_id={}'.format(book_id))
+        self.push([book_id], SyncQueue.UPLOAD)
+        self.wake_idle()
+
+    def add_to_plan(self, book_id, entry):
+        self.dry_run_plan.add(
+            book_id, entry['action'], self.formats.get(book_id), entry['size'], entry['transfer_size'],
+            entry['bookfusion_id'], entry['metadata_digest'], entry['digest']
+        )
+        self.planned.emit(book_id, entry['action'])
+
+    def complete(self):
+        self.watchdog.stop()
+        if self.dry_run:
+            self.planAvailable.emit(self.dry_run_plan)
+        else:
+            self.save_throughput()
+        self.save_trace()
+        self.save_metrics()
+        self.save_failures()
+        self.save_check_cache()
+        self.maybe_finish()
+
+    def write_identifier(self, book_id, bookfusion_id):
+        identifiers = self.db.get_proxy_metadata(book_id).identifiers
+        identifiers['bookfusion'] = bookfusion_id
+        self.db.set_field('identifiers', {book_id: identifiers})
+
+    def save_throughput(self):
+        self.throughput.save()
+
+    def save_trace(self):
+        if self.trace is None:
+            return
+        self.trace.save()
+        self.logger.info('Sync trace: {}'.format(self.trace.file_path))
+
+    def save_metrics(self, canceled=False):
+        if self.metrics is None:
+            return
+        self.logger.info('Sync metrics: {}'.format(self.metrics.to_record(canceled)))
+        self.metrics.save(prefs['metrics_textfile_dir'], canceled)
+
+    def save_failures(self):
+        if self.failures is None:
+            return
+        if len(self.failures) > 0:
+            self.logger.info('Failed books: {}'.format(self.failures.book_ids()))
+        self.failures.save()
+
+    def save_check_cache(self):
+        if self.check_cache is not None:
+            self.check_cache.save()
+
+    def finish_library(self, library_path, summary):
+        self.libraryFinished.emit(library_path, summary)
+        self.maybe_finish()
+
+    def is_finished(self):
+        return self.done and all(library.done for library in self.libraries)
+
+    def maybe_finish(self):
+        if self.canceled:
+            return
+        if self.is_finished():
+            self.close_stages()
+            self.finished.emit()
+
+    def close_stages(self):
+        # Only the manager that created them; libraries synced alongside it
+        # share them.
+        if self.owns_stages:
+            self.session.close()
+
     def abort(self, msg):
+        # Every worker may run into the same error; the first one aborts.
+        if self.canceled or self.is_finished():
+            return
         self.cancel()
         self.aborted.emit(msg)
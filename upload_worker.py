@@ -2,13 +2,21 @@ __copyright__ = '2018, BookFusion <legal@bookfusion.com>'
 __license__ = 'GPL v3'
 
 from PyQt5.Qt import QObject, pyqtSignal, QNetworkRequest, QUrl, QNetworkReply, \
-    QHttpMultiPart, QHttpPart, QFile, QFileInfo, QIODeviceBase
-from os import path
+    QHttpMultiPart, QHttpPart, QFile, QFileInfo, QIODevice, QIODeviceBase, QTimer
+from os import path, remove
 from hashlib import sha256
+from time import monotonic
 import json
 
 from calibre_plugins.bookfusion.config import prefs
 from calibre_plugins.bookfusion import api
+from calibre_plugins.bookfusion import delta_upload
+from calibre_plugins.bookfusion.failed_queue import FailedQueue
+from calibre_plugins.bookfusion.hashing_file import HashingFile, update_zeros
+from calibre_plugins.bookfusion.multipart_body import MultipartBody, form_data_disposition
+from calibre_plugins.bookfusion.reply_timeout import ReplyTimeout
+from calibre_plugins.bookfusion.sync_plan import SyncPlan
+from calibre_plugins.bookfusion.sync_trace import SyncTrace
 
 
 class UploadWorker(QObject):
@@ -18,21 +26,96 @@ class UploadWorker(QObject):
     uploaded = pyqtSignal(int)
     updated = pyqtSignal(int)
     skipped = pyqtSignal(int)
-    failed = pyqtSignal(int, str)
+    failed = pyqtSignal(int, str, str)
+    planned = pyqtSignal(int, dict)
     aborted = pyqtSignal(str)
 
-    def __init__(self, index, reupload, db, logger, network):
+    RETRY_ERRORS = [
+        QNetworkReply.NetworkError.ConnectionRefusedError,
+        QNetworkReply.NetworkError.RemoteHostClosedError,
+        QNetworkReply.NetworkError.HostNotFoundError,
+        QNetworkReply.NetworkError.TimeoutError,
+        QNetworkReply.NetworkError.TemporaryNetworkFailureError
+    ]
+
+    SERVER_ERRORS = [
+        QNetworkReply.NetworkError.InternalServerError,
+        QNetworkReply.NetworkError.ServiceUnavailableError,
+        QNetworkReply.NetworkError.UnknownServerError
+    ]
+
+    # A request answered with 429 is sent again after the server's
+    # Retry-After, or RATE_LIMIT_DELAY seconds if it gives none, up to
+    # MAX_RATE_LIMITS times in a row. Longer delays fail the book instead.
+    RATE_LIMIT_DELAY = 5
+    MAX_RATE_LIMIT_DELAY = 300
+    MAX_RATE_LIMITS = 3
+
+    # A delta is only sent if it is at most this share of the book file.
+    MAX_DELTA_RATIO = 0.5
+
+    # Answers to a delta meaning the server cannot apply it, e.g. as it has no
+    # signature of the book file or its copy changed since; the whole file is
+    # sent instead.
+    DELTA_FALLBACK_ERRORS = [
+        QNetworkReply.NetworkError.ContentNotFoundError,
+        QNetworkReply.NetworkError.ContentConflictError,
+        QNetworkReply.NetworkError.ContentGoneError,
+        QNetworkReply.NetworkError.ContentOperationNotPermittedError,
+        QNetworkReply.NetworkError.OperationNotImplementedError
+    ]
+
+    PHASES = {
+        'Upload check': 'check',
+        'Upload init': 'init',
+        'Upload': 'transfer',
+        'Upload finalize': 'finalize',
+        'Update': 'update',
+        'Update signature': 'signature',
+        'Update delta': 'update'
+    }
+
+    def __init__(self, index, manager):
         QObject.__init__(self)
 
         self.index = index
-        self.reupload = reupload
-        self.db = db
-        self.logger = logger
-        self.network = network
+        self.reupload = manager.reupload
+        self.digest_on_finalize = manager.digest_on_finalize
+        self.delta_upload = manager.delta_upload
+        self.dry_run = manager.dry_run
+        self.plan = manager.plan
+        self.db = manager.db
+        self.logger = manager.logger
+        self.network = manager.network
+        self.digests = manager.digests
+        self.limiter = manager.limiter
+        self.throughput = manager.throughput
+        self.metrics = manager.metrics
+        self.stages = manager.stages
+        self.isbn_cache = manager.isbn_cache
+        self.check_cache = manager.check_cache
+        self.write_identifier = manager.write_identifier
+        self.trace = manager.trace
+        self.batch = manager.batch
+        self.unbatched = manager.unbatched
+        self.gates = []
+        self.waiting = False
         self.reply = None
+        self.reply_timeout = None
+        self.req_body = None
+        self.file = None
+        self.cover = None
+        self.delta_path = None
+        self.searching_isbn = None
         self.canceled = False
 
+        self.request_timeout = prefs['request_timeout']
+        self.stall_timeout = prefs['stall_timeout']
+        self.last_activity = monotonic()
+
         self.retries = 0
+        self.rate_limits = 0
+        self.retry_after = 0
 
     def start(self):
         self.syncRequested.connect(self.sync)
@@ -42,72 +125,182 @@ class UploadWorker(QObject):
         self.canceled = True
         if self.reply:
             self.reply.abort()
+        # The ISBN cache is kept for the next run, so a search this worker
+        # will not finish is given up, waking the workers waiting for it.
+        if self.searching_isbn is not None:
+            isbn, self.searching_isbn = self.searching_isbn, None
+            self.isbn_cache.forget(isbn)
 
     def sync(self, book_id, file_path):
         self.log_info('Sync: book_id={}'.format(book_id))
 
         self.book_id = book_id
         self.file_path = file_path
+        self.digest = self.digests.get(book_id)
+        self.isbn = None
+        self.bookfusion_id = None
+        self.bytes_read = 0
+        self.last_activity = monotonic()
 
         self.check()
 
     def check(self):
-        self.digest = None
+        # A plan from a dry run already holds the server's answer.
+        entry = self.plan.get(self.book_id) if self.plan else None
+        if entry is not None:
+            self.log_info('Upload check: planned action={}'.format(entry['action']))
+            result = None
+            if entry['bookfusion_id']:
+                result = {'id': entry['bookfusion_id'], 'calibre_metadata_digest': entry['calibre_metadata_digest']}
+                self.set_bookfusion_id(result['id'])
+            self.proceed(result)
+            return
 
         identifiers = self.db.get_proxy_metadata(self.book_id).identifiers
         if identifiers.get('bookfusion'):
+            self.bookfusion_id = identifiers['bookfusion']
             self.is_search_req = False
             self.req = api.build_request('/uploads/' + identifiers['bookfusion'])
             self.log_info('Upload check: bookfusion={}'.format(identifiers['bookfusion']))
         elif identifiers.get('isbn'):
+            self.isbn = identifiers['isbn']
+            self.waiting = True
+            self.lookup_started = monotonic()
+            if self.isbn_cache.lookup(self.isbn, self.complete_isbn_lookup, self.retry_isbn_lookup):
+                return
+            self.waiting = False
+            self.searching_isbn = self.isbn
+            self.metrics.record_lookup('isbn', False)
+
             self.is_search_req = True
-            self.req = api.build_request('/uploads', {'isbn': identifiers['isbn']})
-            self.log_info('Upload check: isbn={}'.format(identifiers['isbn']))
+            self.req = api.build_request('/uploads', {'isbn': self.isbn})
+            self.log_info('Upload check: isbn={}'.format(self.isbn))
         else:
-            self.calculate_digest()
+            # A book without an identifier is most likely new. If the server
+            # takes the digest at finalize time, it is not read up front just
+            # for the check: it is uploaded right away, hashed as it is sent,
+            # and the server matches the digest against the books it has at
+            # finalize.
+            if self.digest is None and self.digest_on_finalize and not self.dry_run:
+                self.log_info('Upload check: no identifier, digest sent at finalize')
+                self.proceed(None)
+                return
+
+            if self.digest is None:
+                self.hash(self.check)
+                return
 
             self.is_search_req = False
             self.req = api.build_request('/uploads/' + self.digest)
             self.log_info('Upload check: digest={}'.format(self.digest))
 
-        self.reply = self.network.get(self.req)
-        self.reply.finished.connect(self.complete_check)
+        self.check_cache.prepare(self.req)
+        self.enter(self.stages.api, self.send_check)
+
+    def send_check(self):
+        self.send(self.network.get(self.req), self.complete_check)
+
+    def complete_isbn_lookup(self, result):
+        self.waiting = False
+        self.last_activity = monotonic()
+        if self.canceled:
+            return
+
+        self.metrics.record_lookup('isbn', True)
+        self.trace_span('ISBN lookup', self.lookup_started, cached=True)
+        self.log_info('Upload check: isbn={}; cached={}'.format(self.isbn, result))
+
+        if result is None:
+            self.proceed(None)
+            return
+
+        # The book found is checked like one with an identifier, which gets
+        # its current metadata digest.
+        self.is_search_req = False
+        self.req = api.build_request('/uploads/' + str(result['id']))
+        self.check_cache.prepare(self.req)
+        self.enter(self.stages.api, self.send_check)
+
+    def retry_isbn_lookup(self):
+        # The search this worker was waiting for failed.
+        self.waiting = False
+        self.last_activity = monotonic()
+        self.trace_span('ISBN lookup', self.lookup_started, cached=False)
+        if not self.canceled:
+            self.check()
 
     def complete_check(self):
         abort = False
         skip = False
+        retry = False
+        rate_limited = False
+        resend = False
         update = False
         result = None
 
-        error = self.reply.error()
+        error = self.reply_error('Upload check')
+        not_modified = error == QNetworkReply.NetworkError.NoError and self.http_status() == 304
+        cached = self.check_cache.hit(self.req) if not_modified else None
         if error == QNetworkReply.NetworkError.AuthenticationRequiredError:
             abort = True
             self.aborted.emit('Invalid API key.')
             self.log_info('Upload check: AuthenticationRequiredError')
+        elif not_modified and cached is None:
+            # The cached response was dropped since the check was made
+            # conditional, so it is sent again without conditions.
+            resend = True
+            self.check_cache.forget(self.req)
+            self.log_info('Upload check: not modified, but no longer cached')
         elif error == QNetworkReply.NetworkError.NoError:
-            resp = self.reply.readAll()
+            resp = self.reply.readAll().data()
+            if not_modified:
+                resp = cached
+                self.metrics.record_lookup('check', True)
+                self.log_info('Upload check: not modified')
+            else:
+                self.check_cache.put(self.req, self.reply, resp)
+                self.metrics.record_lookup('check', False)
             self.log_info('Upload check response: {}'.format(resp))
 
-            if self.is_search_req:
-                results = json.loads(resp.data())
-                if len(results) > 0:
-                    result = results[0]
-            else:
-                result = json.loads(resp.data())
+            try:
+                if self.is_search_req:
+                    results = json.loads(resp)
+                    if len(results) > 0:
+                        result = results[0]
+                else:
+                    result = json.loads(resp)
+            except ValueError as e:
+                skip = True
+                self.log_info('Upload check: {}'.format(e))
+                self.failed.emit(self.book_id, 'Cannot parse the server response', FailedQueue.RESPONSE)
 
             if result is not None:
-                self.set_bookfusion_id(result['id'])
+                if not self.dry_run:
+                    self.set_bookfusion_id(result['id'])
                 update = True
         elif error == QNetworkReply.NetworkError.ContentNotFoundError:
+            self.check_cache.forget(self.req)
+            self.metrics.record_lookup('check', False)
             self.log_info('Upload check: ContentNotFoundError')
-        elif error == QNetworkReply.NetworkError.InternalServerError:
-            self.log_info('Upload check: InternalServerError')
-            resp = self.reply.readAll()
-            self.log_info('Upload check response: {}'.format(resp))
-        elif error == QNetworkReply.NetworkError.UnknownServerError:
-            self.log_info('Upload check: UnknownServerError')
+        elif error in self.SERVER_ERRORS:
+            # Not knowing whether the book is on BookFusion is not the same as
+            # it not being there, so the book is retried later rather than
+            # uploaded again.
+            skip = True
+            self.log_info('Upload check: {}'.format(error))
             resp = self.reply.readAll()
             self.log_info('Upload check response: {}'.format(resp))
+            self.failed.emit(self.book_id, 'Server error', FailedQueue.SERVER)
+        elif error in self.RETRY_ERRORS:
+            retry = True
+            self.log_info('Upload check: {}'.format(error))
+        elif error == QNetworkReply.NetworkError.UnknownContentError and self.http_status() == 429:
+            self.log_info('Upload check: Too Many Requests')
+            if self.rate_limited():
+                rate_limited = True
+            else:
+                skip = True
+                self.failed.emit(self.book_id, 'Too many requests', FailedQueue.SERVER)
         elif error == QNetworkReply.NetworkError.OperationCanceledError:
             abort = True
             self.log_info('Upload check: OperationCanceledError')
@@ -116,33 +309,100 @@ class UploadWorker(QObject):
             self.aborted.emit('Error {}.'.format(error))
             self.log_info('Upload check error: {}'.format(error))
 
-        self.reply.deleteLater()
-        self.reply = None
+        # Only a search the server answered is cached, whatever it found.
+        if self.is_search_req and not resend:
+            if (error == QNetworkReply.NetworkError.NoError and not skip) or \
+               error == QNetworkReply.NetworkError.ContentNotFoundError:
+                self.isbn_cache.put(self.isbn, result)
+            else:
+                self.isbn_cache.forget(self.isbn)
+            self.searching_isbn = None
+
+        self.record_reply('Upload check', error)
+
+        self.release_reply()
+
+        if resend:
+            self.req = self.check_cache.unconditional(self.req)
+            self.enter(self.stages.api, self.send_check)
+            return
+        elif rate_limited:
+            self.check()
+            return
+        elif retry:
+            if self.can_retry(error):
+                self.check()
+                return
+            abort = True
+        else:
+            self.retries = 0
+            self.rate_limits = 0
 
         if not abort:
             if skip:
                 self.readyForNext.emit(self.index)
             else:
-                self.metadata_digest = self.get_metadata_digest()
-                if not result is None and self.metadata_digest == result['calibre_metadata_digest'] and not self.reupload:
-                    self.skipped.emit(self.book_id)
-                    self.readyForNext.emit(self.index)
-                else:
-                    if update:
-                        self.update()
-                    else:
-                        self.init_upload()
+                self.proceed(result if update else None)
+
+    def proceed(self, result):
+        self.metadata_digest = self.get_metadata_digest()
+
+        if self.dry_run:
+            self.plan_book(result)
+        elif not result is None and self.metadata_digest == result['calibre_metadata_digest'] and not self.reupload:
+            self.skipped.emit(self.book_id)
+            self.readyForNext.emit(self.index)
+        elif not result is None:
+            self.update()
+        else:
+            self.init_upload()
+
+    def plan_book(self, result):
+        # Mirrors the decisions of proceed() and update() without sending
+        # anything.
+        size = path.getsize(self.file_path)
+        transfer_size = 0
+
+        if result is None:
+            action = SyncPlan.UPLOAD
+            transfer_size = size
+        elif self.metadata_digest == result['calibre_metadata_digest'] and not self.reupload:
+            action = SyncPlan.SKIP
+        elif not prefs['update_metadata'] and not self.reupload:
+            action = SyncPlan.SKIP
+        else:
+            action = SyncPlan.UPDATE
+            if self.reupload:
+                transfer_size = size
+
+        self.planned.emit(self.book_id, {
+            'action': action,
+            'size': size,
+            'transfer_size': transfer_size,
+            'bookfusion_id': str(result['id']) if result is not None else None,
+            'metadata_digest': result['calibre_metadata_digest'] if result is not None else None,
+            'digest': self.digest
+        })
+        self.readyForNext.emit(self.index)
 
     def init_upload(self):
-        self.calculate_digest()
+        # If the server accepts the digest at finalize time, a digest that is
+        # not known yet is computed while the file is uploaded instead of
+        # reading the whole file up front.
+        if self.digest is None and not self.digest_on_finalize:
+            self.hash(self.init_upload)
+            return
+
+        self.enter(self.stages.api, self.send_init_upload)
 
+    def send_init_upload(self):
         self.req = api.build_request('/uploads/init')
         self.req_body = QHttpMultiPart(QHttpMultiPart.ContentType.FormDataType)
-        self.req_body.append(self.build_req_part('filename', path.basename(self.file_path)))
-        self.req_body.append(self.build_req_part('digest', self.digest))
+        self.append_req_part('filename', path.basename(self.file_path))
+        if self.digest is not None:
+            self.append_req_part('digest', self.digest)
 
-        self.reply = self.network.post(self.req, self.req_body)
-        self.reply.finished.connect(self.complete_init_upload)
+        self.send(self.network.post(self.req, self.req_body), self.complete_init_upload, self.req_body)
 
     def complete_init_upload(self):
         resp, retry, abort = self.complete_req('Upload init', return_json = True)
@@ -162,25 +422,39 @@ class UploadWorker(QObject):
             self.readyForNext.emit(self.index)
 
     def upload(self):
-        self.file = QFile(self.file_path)
+        self.enter(self.stages.transfer, self.send_upload, reads_file=True)
+
+    def send_upload(self):
+        if self.digest is None:
+            self.file = HashingFile(self.file_path)
+        else:
+            self.file = QFile(self.file_path)
         self.file.open(QIODeviceBase.OpenModeFlag.ReadOnly)
 
         self.req = QNetworkRequest(QUrl(self.upload_url))
 
-        self.req_body = QHttpMultiPart(QHttpMultiPart.ContentType.FormDataType)
+        self.req_body = MultipartBody(self.limiter)
         for key, value in self.upload_params.items():
             self.log_info('{}={}'.format(key, value))
-            self.req_body.append(self.build_req_part(key, value))
-        self.req_body.append(self.build_req_part('file', self.file))
+            self.append_req_part(key, value)
+        self.append_req_part('file', self.file)
+        self.req_body.prepare(self.req)
 
-        self.reply = self.network.post(self.req, self.req_body)
-        self.reply.finished.connect(self.complete_upload)
+        self.send(self.network.post(self.req, self.req_body), self.complete_upload, self.req_body, transfer=True)
         self.reply.uploadProgress.connect(self.upload_progress)
 
     def complete_upload(self):
+        self.req_body.close()
+
         if self.file:
             self.file.close()
 
+            if isinstance(self.file, HashingFile):
+                self.bytes_read += self.file.bytes_read
+                self.digest = self.file.digest()
+            else:
+                self.bytes_read += self.file.size()
+
         resp, retry, abort = self.complete_req('Upload')
 
         if retry:
@@ -191,20 +465,27 @@ class UploadWorker(QObject):
             return
 
         if resp is not None:
-            self.finalize_upload()
+            self.log_info('Upload read: file_size={}; bytes_read={}'.format(
+                path.getsize(self.file_path), self.bytes_read
+            ))
+            # Falls back to reading the file again if the upload body was not
+            # read through in one pass.
+            self.hash(self.finalize_upload)
         else:
             self.readyForNext.emit(self.index)
 
     def finalize_upload(self):
+        self.enter(self.stages.api, self.send_finalize_upload)
+
+    def send_finalize_upload(self):
         self.req = api.build_request('/uploads/finalize')
 
         self.req_body = QHttpMultiPart(QHttpMultiPart.ContentType.FormDataType)
-        self.req_body.append(self.build_req_part('key', self.upload_params['key']))
-        self.req_body.append(self.build_req_part('digest', self.digest))
+        self.append_req_part('key', self.upload_params['key'])
+        self.append_req_part('digest', self.digest)
         self.append_metadata_req_parts()
 
-        self.reply = self.network.post(self.req, self.req_body)
-        self.reply.finished.connect(self.complete_finalize_upload)
+        self.send(self.network.post(self.req, self.req_body), self.complete_finalize_upload, self.req_body)
 
     def complete_finalize_upload(self):
         self.clean_metadata_req()
@@ -220,6 +501,9 @@ class UploadWorker(QObject):
 
         if resp is not None:
             self.set_bookfusion_id(resp['id'])
+            # Other books with the same ISBN are now found by a search.
+            if self.isbn:
+                self.isbn_cache.put(self.isbn, {'id': resp['id']})
             self.uploaded.emit(self.book_id)
 
         self.readyForNext.emit(self.index)
@@ -230,26 +514,180 @@ class UploadWorker(QObject):
             self.readyForNext.emit(self.index)
             return
 
-        identifiers = self.db.get_proxy_metadata(self.book_id).identifiers
-        if not identifiers.get('bookfusion') and not self.reupload:
+        if not self.bookfusion_id and not self.reupload:
             self.skipped.emit(self.book_id)
             self.readyForNext.emit(self.index)
             return
 
-        self.req = api.build_request('/uploads/' + identifiers['bookfusion'])
-        self.req_body = QHttpMultiPart(QHttpMultiPart.ContentType.FormDataType)
+        # Metadata-only updates go in a batch if the server takes them, unless
+        # the book came back from one.
+        if not self.reupload and self.batch is not None and self.batch.enabled and \
+                self.book_id not in self.unbatched:
+            self.log_info('Update: batched')
+            cover_path = self.db.cover(self.book_id, as_path=True)
+            self.batch.add(self.book_id, self.bookfusion_id, list(self.metadata_parts()), cover_path)
+            self.readyForNext.emit(self.index)
+            return
+
+        if self.reupload and self.delta_upload and self.bookfusion_id and \
+                path.getsize(self.file_path) <= delta_upload.MAX_FILE_SIZE:
+            self.enter(self.stages.api, self.send_fetch_signature)
+        elif self.reupload:
+            self.enter(self.stages.transfer, self.send_update, reads_file=True)
+        else:
+            self.enter(self.stages.api, self.send_update)
+
+    def send_fetch_signature(self):
+        self.req = api.build_request('/uploads/' + self.bookfusion_id + '/signature')
+        self.send(self.network.get(self.req), self.complete_fetch_signature)
+
+    def complete_fetch_signature(self):
+        # Without a usable signature of the uploaded file, e.g. from a server
+        # that has none for files uploaded before it kept them, the whole
+        # file is sent. Errors that are not about the signature come up again
+        # with that request.
+        error = self.reply_error('Update signature')
+        signature = None
+        if error == QNetworkReply.NetworkError.NoError:
+            resp = self.reply.readAll()
+            try:
+                signature = json.loads(resp.data())
+                if not signature.get('blocks') or signature['block_size'] <= 0:
+                    signature = None
+            except (ValueError, AttributeError, KeyError, TypeError) as e:
+                self.log_info('Update signature: {}'.format(e))
+        else:
+            self.log_info('Update signature: {}'.format(error))
+
+        self.record_reply('Update signature', error)
+        self.release_reply()
+
+        if self.canceled:
+            return
+
+        if signature is None:
+            self.enter(self.stages.transfer, self.send_update, reads_file=True)
+            return
+
+        self.log_info('Update signature: block_size={}; blocks={}'.format(
+            signature['block_size'], len(signature['blocks'])
+        ))
+        # The server checks the file it puts together against the digest.
+        self.hash(lambda: self.make_delta(signature))
+
+    def make_delta(self, signature):
+        # The delta is computed in the hash pool, like digests.
+        self.waiting = True
+        started = monotonic()
+        file_path = self.file_path
+
+        def submit():
+            self.stages.hashing.submit_call(
+                lambda: delta_upload.file_delta(file_path, signature, self.MAX_DELTA_RATIO),
+                lambda delta_path: self.complete_delta(delta_path, started)
+            )
+
+        if self.stages.disk is not None:
+            self.stages.disk.acquire(submit)
+        else:
+            submit()
+
+    def complete_delta(self, delta_path, started):
+        if self.stages.disk is not None:
+            self.stages.disk.release()
+
+        self.waiting = False
+        self.last_activity = monotonic()
+        self.trace_span('Delta', started)
+
+        if self.canceled:
+            if delta_path is not None:
+                remove(delta_path)
+            return
+
+        if delta_path is None:
+            self.log_info('Delta: not smaller than {:.0%} of the file'.format(self.MAX_DELTA_RATIO))
+            self.enter(self.stages.transfer, self.send_update, reads_file=True)
+            return
+
+        self.delta_path = delta_path
+        self.log_info('Delta: file_size={}; delta_size={}'.format(
+            path.getsize(self.file_path), path.getsize(delta_path)
+        ))
+        self.enter(self.stages.transfer, self.send_delta_update)
+
+    def send_delta_update(self):
+        self.req = api.build_request('/uploads/' + self.bookfusion_id + '/delta')
+
+        self.req_body = MultipartBody(self.limiter)
+        self.file = QFile(self.delta_path)
+        self.file.open(QIODeviceBase.OpenModeFlag.ReadOnly)
+        self.append_req_part('delta', self.file)
+        self.append_req_part('digest', self.digest)
+        self.append_metadata_req_parts()
+        self.req_body.prepare(self.req)
 
+        self.send(self.network.put(self.req, self.req_body), self.complete_delta_update, self.req_body, transfer=True)
+        self.reply.uploadProgress.connect(self.upload_progress)
+
+    def complete_delta_update(self):
+        self.req_body.close()
+        self.file.close()
+        self.clean_metadata_req()
+
+        delta_size = path.getsize(self.delta_path)
+        remove(self.delta_path)
+        self.delta_path = None
+
+        error = self.reply_error('Update delta')
+        if error in self.DELTA_FALLBACK_ERRORS and not self.canceled:
+            self.log_info('Update delta: {}, sending the whole file'.format(error))
+            self.record_reply('Update delta', error)
+            self.release_reply()
+            self.enter(self.stages.transfer, self.send_update, reads_file=True)
+            return
+
+        resp, retry, abort = self.complete_req('Update delta')
+
+        if retry:
+            self.update()
+            return
+
+        if abort:
+            return
+
+        if resp is not None:
+            self.metrics.record_delta(path.getsize(self.file_path), delta_size)
+            self.updated.emit(self.book_id)
+
+        self.readyForNext.emit(self.index)
+
+    def send_update(self):
+        self.req = api.build_request('/uploads/' + self.bookfusion_id)
+
+        # Only requests carrying a book file go through the bandwidth limiter;
+        # metadata-only updates are sent as they are.
         if self.reupload:
+            self.req_body = MultipartBody(self.limiter)
             self.file = QFile(self.file_path)
             self.file.open(QIODeviceBase.OpenModeFlag.ReadOnly)
-            self.req_body.append(self.build_req_part('file', self.file))
+            self.append_req_part('file', self.file)
+        else:
+            self.req_body = QHttpMultiPart(QHttpMultiPart.ContentType.FormDataType)
 
         self.append_metadata_req_parts()
 
-        self.reply = self.network.put(self.req, self.req_body)
-        self.reply.finished.connect(self.complete_update)
+        if isinstance(self.req_body, MultipartBody):
+            self.req_body.prepare(self.req)
+
+        self.send(self.network.put(self.req, self.req_body), self.complete_update, self.req_body,
+                  transfer=self.reupload)
 
     def complete_update(self):
+        if isinstance(self.req_body, MultipartBody):
+            self.req_body.close()
+            self.file.close()
+
         self.clean_metadata_req()
 
         resp, retry, abort = self.complete_req('Update')
@@ -266,9 +704,147 @@ class UploadWorker(QObject):
 
         self.readyForNext.emit(self.index)
 
+    def send(self, reply, slot, body=None, transfer=False):
+        # Requests carrying a book file may take any time as long as they make
+        # progress, so only the stall timeout applies to them. The request
+        # body is deleted along with the reply.
+        self.reply = reply
+        if body is not None:
+            body.setParent(reply)
+        self.reply_started = monotonic()
+        self.last_activity = self.reply_started
+        self.reply_timeout = ReplyTimeout(reply, 0 if transfer else self.request_timeout, self.stall_timeout)
+        self.reply.finished.connect(self.leave_stage)
+        self.reply.finished.connect(slot)
+
+    def enter(self, stage, callback, reads_file=False):
+        # callback sends the stage's request once a slot of the stage is free,
+        # and of the disk readers too if the request carries the book file;
+        # the slots are given back as soon as the reply has finished. After a
+        # 429 the slots are only asked for once Retry-After has passed.
+        gates = [stage]
+        if reads_file and self.stages.disk is not None:
+            gates.append(self.stages.disk)
+
+        self.waiting = True
+        self.stage_requested = monotonic()
+        if self.retry_after:
+            delay, self.retry_after = self.retry_after, 0
+            QTimer.singleShot(delay * 1000, lambda: self.acquire(gates, [], callback))
+            return
+        self.acquire(gates, [], callback)
+
+    def acquire(self, gates, held, callback):
+        # Gates are always taken in the same order, stage first, so workers
+        # never wait for each other's slots in a cycle.
+        if len(held) < len(gates):
+            gate = gates[len(held)]
+            gate.acquire(lambda: self.acquire(gates, held + [gate], callback))
+            return
+        self.run_stage(held, callback)
+
+    def run_stage(self, gates, callback):
+        self.waiting = False
+        self.last_activity = monotonic()
+        self.trace_span('Wait for {} slot'.format('+'.join(gate.name for gate in gates)), self.stage_requested)
+
+        if self.canceled:
+            for gate in gates:
+                gate.release()
+            return
+
+        self.gates = gates
+        callback()
+
+    def leave_stage(self):
+        for gate in self.gates:
+            gate.release()
+        self.gates = []
+
+    def hash(self, callback):
+        # The digest is computed in the hash pool, and callback called once it
+        # is known.
+        if self.digest is not None:
+            callback()
+            return
+
+        self.waiting = True
+        started = monotonic()
+        if self.stages.disk is not None:
+            self.stages.disk.acquire(lambda: self.submit_hash(callback, started))
+        else:
+            self.submit_hash(callback, started)
+
+    def submit_hash(self, callback, started):
+        self.stages.hashing.submit(self.file_path, lambda digest: self.complete_hash(digest, callback, started))
+
+    def complete_hash(self, digest, callback, started):
+        if self.stages.disk is not None:
+            self.stages.disk.release()
+
+        self.waiting = False
+        self.last_activity = monotonic()
+        self.trace_span('Digest', started)
+
+        if self.canceled:
+            return
+
+        if digest is None:
+            self.log_info('Digest: cannot read {}'.format(self.file_path))
+            self.failed.emit(self.book_id, 'Cannot read the book file', FailedQueue.FILE)
+            self.readyForNext.emit(self.index)
+            return
+
+        self.digest = digest
+        self.digests[self.book_id] = digest
+        self.bytes_read += path.getsize(self.file_path)
+
+        callback()
+
+    def reply_error(self, tag):
+        # A reply aborted by its timeout is retried like one that timed out on
+        # the network level.
+        if self.reply_timeout.reason is not None:
+            self.log_info('{}: {} timeout'.format(tag, self.reply_timeout.reason))
+            return QNetworkReply.NetworkError.TimeoutError
+        return self.reply.error()
+
+    def release_reply(self):
+        # The reply takes the request body with it. Files the body read were
+        # closed already; dropping them here means nothing of a request is
+        # kept until the worker's next request replaces it.
+        self.reply.deleteLater()
+        self.reply = None
+        self.req_body = None
+        self.file = None
+
+    def http_status(self):
+        return self.reply.attribute(QNetworkRequest.Attribute.HttpStatusCodeAttribute)
+
+    def record_reply(self, tag, error):
+        self.trace_span(tag, self.reply_started, error=getattr(error, 'name', None) or str(error))
+
+        if error != QNetworkReply.NetworkError.NoError:
+            self.metrics.record_error(getattr(error, 'name', None) or str(error))
+            return
+
+        elapsed = monotonic() - self.reply_started
+        self.metrics.record_latency(self.PHASES[tag], elapsed)
+
+        if tag in ('Upload', 'Update', 'Update delta') and isinstance(self.req_body, MultipartBody):
+            self.metrics.record_bytes(self.req_body.size())
+            self.throughput.record_transfer(self.req_body.size(), elapsed)
+        else:
+            self.throughput.record_request(elapsed)
+
     def upload_progress(self, sent, total):
+        self.last_activity = monotonic()
         self.uploadProgress.emit(self.book_id, sent, total)
 
+    def trace_span(self, name, started, **args):
+        if self.trace is not None:
+            self.trace.span(SyncTrace.worker_tid(self.index), name, started, book_id=self.book_id, **args)
+
     def log_info(self, msg):
         self.logger.info('[worker-{}] {}'.format(self.index, msg))
 
@@ -311,7 +887,7 @@ class UploadWorker(QObject):
 
         cover_path = self.db.cover(self.book_id, as_path=True)
         if cover_path:
-            h.update(bytes(path.getsize(cover_path)))
+            update_zeros(h, path.getsize(cover_path))
             h.update(b'\0')
             with open(cover_path, 'rb') as file:
                 block = file.read(65536)
@@ -321,7 +897,8 @@ class UploadWorker(QObject):
 
         return h.hexdigest()
 
-    def append_metadata_req_parts(self):
+    def metadata_parts(self):
+        # The book's metadata as (name, value) pairs, without the cover.
         metadata = self.db.get_proxy_metadata(self.book_id)
         language = next(iter(metadata.languages), None)
         summary = metadata.comments
@@ -330,71 +907,87 @@ class UploadWorker(QObject):
         if issued_on == '0101-01-01':
             issued_on = None
 
-        self.req_body.append(self.build_req_part('metadata[calibre_metadata_digest]', self.metadata_digest))
-        self.req_body.append(self.build_req_part('metadata[title]', metadata.title))
+        yield 'metadata[calibre_metadata_digest]', self.metadata_digest
+        yield 'metadata[title]', metadata.title
         if summary:
-            self.req_body.append(self.build_req_part('metadata[summary]', summary))
+            yield 'metadata[summary]', summary
         if language:
-            self.req_body.append(self.build_req_part('metadata[language]', language))
+            yield 'metadata[language]', language
         if isbn:
-            self.req_body.append(self.build_req_part('metadata[isbn]', isbn))
+            yield 'metadata[isbn]', isbn
         if issued_on:
-            self.req_body.append(self.build_req_part('metadata[issued_on]', issued_on))
+            yield 'metadata[issued_on]', issued_on
 
         for series_item in self.get_series(metadata):
-            self.req_body.append(self.build_req_part('metadata[series][][title]', series_item['title']))
+            yield 'metadata[series][][title]', series_item['title']
             if series_item['index'] is not None:
-                self.req_body.append(self.build_req_part('metadata[series][][index]', str(series_item['index'])))
+                yield 'metadata[series][][index]', str(series_item['index'])
 
         for author in metadata.authors:
-            self.req_body.append(self.build_req_part('metadata[author_list][]', author))
+            yield 'metadata[author_list][]', author
         for tag in metadata.tags:
-            self.req_body.append(self.build_req_part('metadata[tag_list][]', tag))
+            yield 'metadata[tag_list][]', tag
 
         bookshelves = self.get_bookshelves(metadata)
         if bookshelves is not None:
-            self.req_body.append(self.build_req_part('metadata[bookshelves][]', ''))
+            yield 'metadata[bookshelves][]', ''
             for bookshelf in bookshelves:
-                self.req_body.append(self.build_req_part('metadata[bookshelves][]', bookshelf))
+                yield 'metadata[bookshelves][]', bookshelf
+
+    def append_metadata_req_parts(self):
+        for name, value in self.metadata_parts():
+            self.append_req_part(name, value)
 
         cover_path = self.db.cover(self.book_id, as_path=True)
         if cover_path:
             self.cover = QFile(cover_path)
             self.cover.open(QIODeviceBase.OpenModeFlag.ReadOnly)
-            self.req_body.append(self.build_req_part('metadata[cover]', self.cover))
+            self.append_req_part('metadata[cover]', self.cover)
         else:
             self.cover = None
 
     def clean_metadata_req(self):
         if self.cover:
             self.cover.remove()
+            self.cover = None
+
+    def append_req_part(self, name, value):
+        # Files are deleted along with the body that reads them.
+        if isinstance(value, QIODevice):
+            value.setParent(self.req_body)
+
+        if isinstance(self.req_body, MultipartBody):
+            self.req_body.add_part(name, value)
+        else:
+            self.req_body.append(self.build_req_part(name, value))
 
     def build_req_part(self, name, value):
         part = QHttpPart()
         part.setHeader(QNetworkRequest.KnownHeaders.ContentTypeHeader, None)
-        if isinstance(value, QFile):
-            filename = QFileInfo(value).fileName()
+        if isinstance(value, QIODevice):
+            filename = QFileInfo(value.fileName()).fileName()
             part.setHeader(
                 QNetworkRequest.KnownHeaders.ContentDispositionHeader,
-                'form-data; name="{}"; filename="{}"'.format(self.escape_quotes(name), self.escape_quotes(filename))
+                form_data_disposition(name, filename)
             )
             part.setBodyDevice(value)
         else:
             part.setHeader(
                 QNetworkRequest.KnownHeaders.ContentDispositionHeader,
-                'form-data; name="{}"'.format(self.escape_quotes(name))
+                form_data_disposition(name)
             )
             part.setBody(value.encode('utf-8'))
         return part
 
     def complete_req(self, tag, return_json = False):
         retry = False
+        rate_limited = False
         abort = False
 
         if self.canceled:
             abort = True
 
-        error = self.reply.error()
+        error = self.reply_error(tag)
         resp = None
         if error == QNetworkReply.NetworkError.AuthenticationRequiredError:
             abort = True
@@ -409,28 +1002,29 @@ class UploadWorker(QObject):
                 except ValueError as e:
                     resp = None
                     self.log_info('{}: {}'.format(tag, e))
-                    self.failed.emit(self.book_id, 'Cannot parse the server response')
+                    self.failed.emit(self.book_id, 'Cannot parse the server response', FailedQueue.RESPONSE)
         elif error == QNetworkReply.NetworkError.UnknownContentError:
-            if self.reply.attribute(QNetworkRequest.Attribute.HttpStatusCodeAttribute) == 422:
+            status = self.http_status()
+            if status == 422:
                 err_resp = self.reply.readAll()
                 self.log_info('{} response: {}'.format(tag, err_resp))
                 msg = json.loads(err_resp.data())['error']
-                self.failed.emit(self.book_id, msg)
+                self.failed.emit(self.book_id, msg, FailedQueue.VALIDATION)
+            elif status == 429:
+                self.log_info('{}: Too Many Requests'.format(tag))
+                if self.rate_limited():
+                    rate_limited = True
+                else:
+                    self.failed.emit(self.book_id, 'Too many requests', FailedQueue.SERVER)
             else:
                 self.log_info('{}: UnknownContentError'.format(tag))
-        elif error == QNetworkReply.NetworkError.InternalServerError:
-            self.log_info('{}: InternalServerError'.format(tag))
-            err_resp = self.reply.readAll()
-            self.log_info('{} response: {}'.format(tag, err_resp))
-        elif error == QNetworkReply.NetworkError.UnknownServerError:
-            self.log_info('{}: UnknownServerError'.format(tag))
+                self.failed.emit(self.book_id, 'Request rejected (HTTP {})'.format(status), FailedQueue.REQUEST)
+        elif error in self.SERVER_ERRORS:
+            self.log_info('{}: {}'.format(tag, error))
             err_resp = self.reply.readAll()
             self.log_info('{} response: {}'.format(tag, err_resp))
-        elif error == QNetworkReply.NetworkError.ConnectionRefusedError or \
-             error == QNetworkReply.NetworkError.RemoteHostClosedError or \
-             error == QNetworkReply.NetworkError.HostNotFoundError or \
-             error == QNetworkReply.NetworkError.TimeoutError or \
-             error == QNetworkReply.NetworkError.TemporaryNetworkFailureError:
+            self.failed.emit(self.book_id, 'Server error', FailedQueue.SERVER)
+        elif error in self.RETRY_ERRORS:
             retry = True
             self.log_info('{}: {}'.format(tag, error))
         elif error == QNetworkReply.NetworkError.OperationCanceledError:
@@ -441,44 +1035,59 @@ class UploadWorker(QObject):
             self.aborted.emit('Error {}.'.format(error))
             self.log_info('{} error: {}'.format(tag, error))
 
-        self.reply.deleteLater()
-        self.reply = None
+        self.record_reply(tag, error)
 
-        if retry:
-            self.retries += 1
+        self.release_reply()
 
-            if self.retries > 2:
-                self.retries = 0
-                self.aborted.emit('Error {}.'.format(error))
-                retry = False
-            else:
+        if rate_limited:
+            retry = not self.canceled
+        elif retry:
+            retry = self.can_retry(error)
+            if retry:
                 abort = False
         else:
             self.retries = 0
+            self.rate_limits = 0
 
         return (resp, retry, abort)
 
-    def calculate_digest(self):
-        if self.digest is not None:
-            return
+    def can_retry(self, error):
+        # After three attempts the network is assumed to be down and the
+        # whole sync is aborted.
+        self.retries += 1
+        self.metrics.record_retry()
 
-        h = sha256()
-        h.update(bytes(path.getsize(self.file_path)))
-        h.update(b'\0')
-        with open(self.file_path, 'rb') as file:
-            block = file.read(65536)
-            while len(block) > 0:
-                h.update(block)
-                block = file.read(65536)
-        self.digest = h.hexdigest()
+        if self.retries > 2:
+            self.retries = 0
+            self.failed.emit(self.book_id, 'Network error', FailedQueue.NETWORK)
+            self.aborted.emit('Error {}.'.format(error))
+            return False
+        return True
+
+    def rate_limited(self):
+        # Returns True if the request is to be sent again after retry_after.
+        self.rate_limits += 1
+        self.metrics.record_retry()
+
+        try:
+            delay = int(self.reply.rawHeader(b'Retry-After').data().decode('ascii'))
+        except ValueError:
+            # Missing, or given as an HTTP date.
+            delay = self.RATE_LIMIT_DELAY
 
-    def escape_quotes(self, value):
-        return value.replace('"', '\\"')
+        if self.rate_limits > self.MAX_RATE_LIMITS or delay > self.MAX_RATE_LIMIT_DELAY:
+            self.rate_limits = 0
+            return False
+
+        self.log_info('Rate limited: retry_after={}s'.format(delay))
+        self.retry_after = max(delay, 1)
+        return True
 
     def set_bookfusion_id(self, bookfusion_id):
-        identifiers = self.db.get_proxy_metadata(self.book_id).identifiers
-        identifiers['bookfusion'] = str(bookfusion_id)
-        self.db.set_field('identifiers', {self.book_id: identifiers})
+        self.bookfusion_id = str(bookfusion_id)
+        started = monotonic()
+        self.write_identifier(self.book_id, self.bookfusion_id)
+        self.trace_span('Write identifier', started)
 
     def get_bookshelves(self, metadata):
         bookshelves_custom_column = prefs['bookshelves_custom_column']
@@ -0,0 +1,33 @@
+__copyright__ = '2026, BookFusion <legal@bookfusion.com>'
+__license__ = 'GPL v3'
+
+from PyQt5.Qt import QTimer
+from collections import deque
+
+
+# Caps the number of books being synced at once across every UploadManager
+# sharing it, e.g. when several libraries are synced together. Workers wait for
+# a slot in the order they asked for one, whichever manager they belong to.
+class WorkerBudget:
+    def __init__(self, slots):
+        self.free = slots
+        self.waiting = deque()
+
+    def acquire(self, manager, index):
+        # Returns True if a slot was taken. Otherwise manager.resume(index) is
+        # called later, once a slot has been handed over to that worker.
+        if self.free > 0:
+            self.free -= 1
+            return True
+        self.waiting.append((manager, index))
+        return False
+
+    def release(self):
+        if self.waiting:
+            manager, index = self.waiting.popleft()
+            QTimer.singleShot(0, lambda: manager.resume(index))
+        else:
+            self.free += 1
+
+    def cancel(self, manager):
+        self.waiting = deque(entry for entry in self.waiting if entry[0] is not manager)